@@ -0,0 +1,139 @@
+import logging
+import sqlite3
+import threading
+from collections import Counter
+
+# stay well under SQLite's limit on bound parameters per statement
+MAX_IDS_PER_UPDATE = 500
+
+
+class AckBuffer(threading.Thread):
+    """
+    AckBuffer class for batching delivery acknowledgements
+
+    Message ids acknowledged by clients are collected in memory and marked delivered together,
+    with one UPDATE ... WHERE message_id IN (...) per flush instead of one UPDATE per message.
+    A flush happens every `flush_interval_ms`, or sooner once `max_pending` ids are waiting.
+    """
+
+    def __init__(
+        self,
+        db_path,
+        flush_interval_ms=50,
+        max_pending=1000,
+        timeout=5.0,
+        counters=None,
+    ):
+        """
+        Parameters:
+        ----------
+        db_path : str
+            path to the sqlite database file
+        flush_interval_ms : float
+            how often pending acknowledgements are written
+        max_pending : int
+            number of pending ids that triggers an early flush
+        timeout : float
+            seconds to wait on a locked database before raising
+        counters : UndeliveredCounters
+            optional per-user counts to decrement (and persist) for delivered messages
+        """
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.counters = counters
+
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._conn = None
+
+    def add(self, message_ids):
+        """
+        Queue message ids to be marked as delivered.
+
+        Parameters:
+        ----------
+        message_ids : iterable of int
+            ids of messages the client has received
+        """
+        with self._lock:
+            self._pending.update(message_ids)
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Mark all pending ids as delivered in a single transaction.
+
+        Returns:
+        ----------
+        int
+            number of messages that changed from undelivered to delivered
+        """
+        with self._flush_lock:
+            with self._lock:
+                message_ids = sorted(self._pending)
+                self._pending = set()
+            if not message_ids:
+                return 0
+
+            if self._conn is None:
+                self._conn = sqlite3.connect(
+                    self.db_path, timeout=self.timeout, check_same_thread=False
+                )
+
+            # recipients of the messages that actually changed state
+            delivered = Counter()
+            try:
+                for start in range(0, len(message_ids), MAX_IDS_PER_UPDATE):
+                    chunk = message_ids[start : start + MAX_IDS_PER_UPDATE]
+                    placeholders = ",".join("?" * len(chunk))
+                    cursor = self._conn.execute(
+                        f"UPDATE messages SET delivered=1 WHERE message_id IN ({placeholders}) AND delivered=0 RETURNING recipient",
+                        chunk,
+                    )
+                    delivered.update(row[0] for row in cursor.fetchall())
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Error flushing {len(message_ids)} acks: {e}")
+                self._conn.rollback()
+                # keep the ids so the next flush retries them
+                self.add(message_ids)
+                return 0
+
+            updated = sum(delivered.values())
+            logging.info(f"Marked {updated} messages as delivered.")
+
+            if self.counters is not None:
+                for recipient, n in delivered.items():
+                    self.counters.add(recipient, -n)
+                try:
+                    self.counters.persist(self._conn)
+                except sqlite3.Error as e:
+                    logging.error(f"Error persisting undelivered counts: {e}")
+            return updated
+
+    def stop(self):
+        """
+        Stop the flush thread, writing anything still pending.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        self.join()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                self.flush()
+            self.flush()
+        finally:
+            if self._conn is not None:
+                self._conn.close()
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import time
+import traceback
+from concurrent import futures
+
+import grpc
+
+import chat_pb2
+import chat_pb2_grpc
+from metrics import action_name, log_every
+from outbound import EMPTY, OutboundQueue
+from server import (
+    ChatServiceServicer,
+    Session,
+    config,
+    host,
+    metrics_log_interval,
+    outbound_block_timeout,
+    outbound_policy,
+    outbound_queue_size,
+    port,
+    stream_reap_interval,
+)
+
+# threads for storage calls, shared by every stream
+db_workers = config["server_config"].get("aio_db_workers", 16)
+
+# An idle stream here costs a task and a queue, not a thread, so the limits of the threaded
+# server do not apply. 0 for no limit on streams or on RPCs in flight.
+aio_max_streams = config["server_config"].get("aio_max_streams", 0)
+aio_maximum_concurrent_rpcs = config["server_config"].get("aio_maximum_concurrent_rpcs", 0)
+
+
+class LoopQueue(OutboundQueue):
+    """
+    LoopQueue class, an OutboundQueue read by a coroutine
+
+    Handlers on executor threads put responses through the event loop, so the queue is
+    only changed on the loop thread and the stream can await it. It stands in for the
+    OutboundQueue of the threaded server in a Session, so the action handlers are shared
+    unchanged between the two servers. The "block" policy cannot hold up the loop, so a
+    full queue drops the new response straight away.
+    """
+
+    def __init__(self, loop, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = loop
+        self._ready = asyncio.Event()
+
+    def _put(self, response):
+        super().put(response, block=False)
+        self._ready.set()
+
+    def put(self, response, block=True):
+        # safe from any thread
+        self.loop.call_soon_threadsafe(self._put, response)
+
+    def _close(self):
+        super().close()
+        self._ready.set()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _finish(self):
+        super().finish()
+        self._ready.set()
+
+    def finish(self):
+        self.loop.call_soon_threadsafe(self._finish)
+
+    async def get(self):
+        while (response := self.get_nowait()) is EMPTY:
+            self._ready.clear()
+            await self._ready.wait()
+        return response
+
+
+class AioChatServiceServicer(ChatServiceServicer):
+    """
+    AioChatServiceServicer class, the chat servicer for the grpc.aio server
+
+    Each Chat stream is a coroutine rather than two OS threads, so an idle client costs a
+    task and a queue. Requests still run through the handler registry of
+    ChatServiceServicer, one at a time per stream, on a bounded thread pool, since the
+    storage engines block.
+    """
+
+    def __init__(
+        self,
+        store=None,
+        max_workers=16,
+        max_streams=None,
+        auth=None,
+        compression=None,
+        compression_min_bytes=None,
+    ):
+        """
+        Parameters:
+        ----------
+        store : MessageStore
+            storage engine to use, by default the one named in config.json
+        max_workers : int
+            threads that run handlers (and so hold database connections)
+        max_streams : int
+            most Chat streams open at once, 0 for no limit, by default aio_max_streams
+            from config.json
+        auth : AuthPool
+            password hashing pool, by default sized from config.json
+        compression : str
+            "none", "gzip" or "deflate" for large responses, by default from config.json
+        compression_min_bytes : int
+            smallest serialized response that is compressed, by default from config.json
+        """
+        super().__init__(
+            store,
+            aio_max_streams if max_streams is None else max_streams,
+            auth=auth,
+            compression=compression,
+            compression_min_bytes=compression_min_bytes,
+        )
+        # pooled connections are per thread and stay with these workers, so
+        # the sqlite pool_size should be at least max_workers
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def new_queue(self):
+        return LoopQueue(
+            asyncio.get_running_loop(),
+            maxsize=outbound_queue_size,
+            policy=outbound_policy,
+            block_timeout=outbound_block_timeout,
+            stats=self.outbound_stats,
+        )
+
+    async def unary(self, action, request, context, handler):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            self.executor, self.run_unary, action, request, handler
+        )
+        if response is None:
+            await context.abort(
+                grpc.StatusCode.INTERNAL,
+                f"Error handling {action_name(action)}",
+            )
+        self.compress_unary(context, response)
+        return response
+
+    async def CheckUsername(self, request, context):
+        return await self.unary(
+            chat_pb2.CHECK_USERNAME, request, context, self.handle_check_username
+        )
+
+    async def Login(self, request, context):
+        return await self.unary(chat_pb2.LOGIN, request, context, self.handle_unary_login)
+
+    async def LoadChat(self, request, context):
+        return await self.unary(chat_pb2.LOAD_CHAT, request, context, self.handle_load_chat)
+
+    async def Chat(self, request_iterator, context):
+        """
+        Chat function for AioChatServiceServicer, unique to each client.
+
+        Parameters:
+        ----------
+        request_iterator : async iterator
+            iterator of requests from client
+        context : grpc.aio.ServicerContext
+            used to end the stream with an error status
+        """
+        loop = asyncio.get_running_loop()
+        session = Session(self.new_queue(), context)
+        if not self.admit_stream(session):
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, self.full_message())
+
+        # wakes the response loop below however the RPC ends
+        context.add_done_callback(lambda _: session.queue.close())
+        self.start_compression(context)
+
+        async def handle_requests():
+            try:
+                async for req in request_iterator:
+                    self.wire.record("in", req)
+                    await loop.run_in_executor(self.executor, self.dispatch, session, req)
+            except Exception:
+                logging.error(f"Error handling requests: {traceback.format_exc()}")
+            finally:
+                if session.username and self.disconnect(session.username, session):
+                    logging.info(f"{session.username} disconnected.")
+                # the client stopped sending, end the response stream once the
+                # responses already queued are sent
+                session.queue.finish()
+
+        reader = asyncio.create_task(handle_requests())
+        try:
+            while True:
+                response = await session.queue.get()
+                if response is None:
+                    break
+                size, compressed = self.compress_next(context, response)
+                yield response
+                session.last_active = time.monotonic()
+                session.bytes_sent += self.wire.record("out", response, size, compressed)
+
+            if session.queue.overflowed:
+                await context.abort(
+                    grpc.StatusCode.RESOURCE_EXHAUSTED,
+                    "Too many responses waiting, the client is not reading them.",
+                )
+        finally:
+            # the client went away while responses were still expected
+            reader.cancel()
+            self.end_stream(session)
+
+
+async def serve():
+    """
+    Main loop for the asyncio server.
+    """
+    # no worker is held per stream here, only the configured stream and RPC limits apply
+    server = grpc.aio.server(maximum_concurrent_rpcs=aio_maximum_concurrent_rpcs or None)
+    servicer = AioChatServiceServicer(max_workers=db_workers)
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    server.add_insecure_port(f"{host}:{port}")
+    await server.start()
+    logging.info(f"Asyncio server started on port {port}")
+    if metrics_log_interval:
+        log_every(
+            metrics_log_interval,
+            servicer.metrics,
+            servicer.wire,
+            servicer.outbound_stats,
+            servicer.fanout,
+            servicer.auth,
+            servicer,
+        )
+    servicer.start_reaper(stream_reap_interval)
+    try:
+        await server.wait_for_termination()
+    finally:
+        await server.stop(0)
+        servicer.fanout.stop()
+        servicer.auth.close()
+        servicer.executor.shutdown()
+        servicer.store.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
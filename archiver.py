@@ -0,0 +1,196 @@
+import logging
+import sqlite3
+import sys
+import threading
+
+# PRAGMA auto_vacuum value for INCREMENTAL
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class Archiver(threading.Thread):
+    """
+    Archiver class for moving old delivered messages out of the hot messages table
+
+    Delivered messages older than `max_age_s` are copied into messages_archive and deleted
+    from messages, `chunk_size` at a time, each chunk in its own short write transaction.
+    Freed pages are then handed back with PRAGMA incremental_vacuum so the file does not keep
+    growing. LOAD_CHAT, DELETE_MESSAGE and DELETE_ACCOUNT read and delete through both tables.
+    Undelivered messages are never archived, so the undelivered counts are unaffected.
+    """
+
+    def __init__(
+        self,
+        db_path,
+        max_age_s=30 * 24 * 3600,
+        chunk_size=500,
+        interval_s=60,
+        vacuum_pages=100,
+        pause_ms=10,
+        timeout=5.0,
+    ):
+        """
+        Parameters:
+        ----------
+        db_path : str
+            path to the sqlite database file
+        max_age_s : float
+            age in seconds after which a delivered message is archived
+        chunk_size : int
+            messages looked at per write transaction
+        interval_s : float
+            seconds between archival runs
+        vacuum_pages : int
+            free pages released after each chunk
+        pause_ms : float
+            sleep between chunks, so other writers get the lock
+        timeout : float
+            seconds to wait on a locked database before raising
+        """
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.max_age_s = max_age_s
+        self.chunk_size = chunk_size
+        self.interval = interval_s
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause_ms / 1000
+        self.timeout = timeout
+
+        self.messages_archived = 0
+        self._stopped = threading.Event()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.db_path, timeout=self.timeout, check_same_thread=False
+            )
+            # transactions are started explicitly with BEGIN IMMEDIATE
+            self._conn.isolation_level = None
+        return self._conn
+
+    def archive_chunk(self, after_id=0):
+        """
+        Archive the old delivered messages among the next `chunk_size` messages.
+
+        Messages are visited in message_id order, which is also the order they were sent in,
+        so the walk can stop at the first message that is too new.
+
+        Parameters:
+        ----------
+        after_id : int
+            only look at messages with a greater message_id
+
+        Returns:
+        ----------
+        tuple
+            (number archived, last message_id looked at or None when done)
+        """
+        conn = self._connection()
+        rows = conn.execute(
+            "SELECT message_id, delivered, time < datetime('now', ?) FROM messages WHERE message_id>? ORDER BY message_id LIMIT ?",
+            (f"-{int(self.max_age_s)} seconds", after_id, self.chunk_size),
+        ).fetchall()
+
+        message_ids = []
+        done = len(rows) < self.chunk_size
+        for message_id, delivered, old in rows:
+            if not old:
+                done = True
+                break
+            if delivered:
+                message_ids.append(message_id)
+
+        archived = 0
+        if message_ids:
+            placeholders = ",".join("?" * len(message_ids))
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # delivered is checked again inside the transaction
+                conn.execute(
+                    f"INSERT OR IGNORE INTO messages_archive SELECT * FROM messages WHERE message_id IN ({placeholders}) AND delivered=1",
+                    message_ids,
+                )
+                archived = conn.execute(
+                    f"DELETE FROM messages WHERE message_id IN ({placeholders}) AND delivered=1",
+                    message_ids,
+                ).rowcount
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            # hand back some of the pages the delete freed, outside the transaction
+            conn.execute(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})").fetchall()
+            self.messages_archived += archived
+
+        if done or not rows:
+            return archived, None
+        return archived, rows[-1][0]
+
+    def archive(self) -> int:
+        """
+        Archive every old delivered message, one chunk at a time.
+
+        Returns:
+        ----------
+        int
+            number of messages archived
+        """
+        total = 0
+        after_id = 0
+        while after_id is not None and not self._stopped.is_set():
+            archived, after_id = self.archive_chunk(after_id)
+            total += archived
+            if after_id is not None:
+                self._stopped.wait(self.pause)
+        if total:
+            logging.info(f"Archived {total} messages from {self.db_path}.")
+        return total
+
+    def stop(self):
+        """
+        Stop the archival thread after the chunk in progress.
+        """
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self.archive()
+                except sqlite3.Error as e:
+                    logging.error(f"Error archiving messages: {e}")
+                self._stopped.wait(self.interval)
+        finally:
+            if self._conn is not None:
+                self._conn.close()
+
+
+def enable_incremental_vacuum(db_path):
+    """
+    Switch an existing database to auto_vacuum=INCREMENTAL.
+
+    New databases get this when they are created. An older database needs one full VACUUM,
+    which rewrites the whole file, so this is run by hand while the server is stopped.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.isolation_level = None
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            print(f"{db_path} already uses incremental vacuum")
+            return
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        print(f"Enabled incremental vacuum on {db_path}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    # python archiver.py [db_path] [--enable-vacuum]
+    args = [arg for arg in sys.argv[1:] if arg != "--enable-vacuum"]
+    db_path = args[0] if args else "data/messenger.db"
+    if "--enable-vacuum" in sys.argv:
+        enable_incremental_vacuum(db_path)
+    print(f"Archived {Archiver(db_path).archive()} messages")
@@ -0,0 +1,183 @@
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+
+ALGORITHM = "pbkdf2_sha256"
+SALT_BYTES = 16
+
+
+class AuthBusy(Exception):
+    """
+    Raised when the auth pool already has max_pending hashes waiting.
+    """
+
+
+class AuthUnavailable(AuthBusy):
+    """
+    Raised when a hash timed out or the pool's worker processes died. Handlers treat it
+    like AuthBusy and refuse the request.
+    """
+
+
+def hash_password(password, iterations, salt=None) -> str:
+    """
+    Hash a password with a random salt.
+
+    Parameters:
+    ----------
+    password : str
+        password as the client sent it
+    iterations : int
+        PBKDF2 rounds, the cost of one hash
+    salt : bytes
+        salt to use, a new random one by default
+
+    Returns:
+    ----------
+    str
+        "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>"
+    """
+    salt = salt if salt is not None else os.urandom(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"{ALGORITHM}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password, stored) -> bool:
+    """
+    Check a password against a stored hash, salted or an unsalted sha256 from older servers.
+    """
+    if not stored.startswith(ALGORITHM + "$"):
+        # legacy hash, a bare sha256 hex digest
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored)
+
+    _, iterations, salt, _ = stored.split("$")
+    candidate = hash_password(password, int(iterations), bytes.fromhex(salt))
+    return hmac.compare_digest(candidate, stored)
+
+
+def needs_rehash(stored, iterations) -> bool:
+    """
+    Whether a stored hash is legacy or was made with a different cost than `iterations`.
+    """
+    if not stored.startswith(ALGORITHM + "$"):
+        return True
+    return int(stored.split("$")[1]) != iterations
+
+
+class AuthPool:
+    """
+    AuthPool class, hashes and checks passwords off the stream threads
+
+    The hashing runs in `workers` processes, so it neither holds the GIL nor takes a handler
+    thread's CPU time. At most `max_pending` hashes can be queued or running; beyond that
+    requests fail fast with AuthBusy, so a burst of logins cannot build an unbounded backlog.
+    With `workers` 0 the hashing runs on the calling thread.
+    """
+
+    def __init__(self, workers=2, iterations=200_000, max_pending=64, timeout=30.0):
+        """
+        Parameters:
+        ----------
+        workers : int
+            hashing processes, 0 to hash on the calling thread
+        iterations : int
+            PBKDF2 rounds for new hashes, older hashes are upgraded on login
+        max_pending : int
+            most hashes waiting or running at once
+        timeout : float
+            seconds a caller waits for its hash
+        """
+        self.iterations = iterations
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+        self.workers = workers
+        self._pool = self._new_pool() if workers else None
+
+    def _new_pool(self):
+        # spawned, a forked child would inherit the server's gRPC threads
+        return futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def _replace_pool(self, broken):
+        """
+        Start a new pool in place of one whose worker processes died, once.
+        """
+        with self._lock:
+            if self._pool is not broken:
+                return
+            logging.error("Auth worker processes died, starting new ones.")
+            self._pool = self._new_pool()
+        broken.shutdown(wait=False)
+
+    def _done(self, _):
+        with self._lock:
+            self.pending -= 1
+
+    def _run(self, fn, *args):
+        if self._pool is None:
+            return fn(*args)
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise AuthBusy(f"{self.pending} password hashes already waiting")
+            self.pending += 1
+        pool = self._pool
+        try:
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool as e:
+            self._done(None)
+            self._replace_pool(pool)
+            raise AuthUnavailable("auth worker processes died") from e
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError as e:
+            raise AuthUnavailable(f"no hash within {self.timeout}s") from e
+        except BrokenProcessPool as e:
+            self._replace_pool(pool)
+            raise AuthUnavailable("auth worker processes died") from e
+
+    def hash(self, password) -> str:
+        """
+        Hash a new password at the configured cost.
+        """
+        return self._run(hash_password, password, self.iterations)
+
+    def verify(self, password, stored) -> bool:
+        """
+        Check a password against its stored hash.
+        """
+        return self._run(verify_password, password, stored)
+
+    def needs_rehash(self, stored) -> bool:
+        return needs_rehash(stored, self.iterations)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def snapshot(self) -> dict:
+        """
+        Get the number of hashes waiting or running and how many were refused.
+        """
+        with self._lock:
+            return {"pending": self.pending, "rejected": self.rejected}
+
+    def log_snapshot(self):
+        s = self.snapshot()
+        logging.info(f"auth: pending={s['pending']} rejected={s['rejected']}")
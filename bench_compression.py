@@ -0,0 +1,193 @@
+import argparse
+import random
+import socket
+import statistics
+import threading
+import time
+from concurrent import futures
+
+import grpc
+
+import chat_pb2
+import chat_pb2_grpc
+from auth import AuthPool
+from server import ChatServiceServicer, compression_min_bytes_default
+from storage import create_store
+
+# text that compresses about as well as chat messages do
+WORDS = (
+    "the a to and of you i it is that in we for on are this with be have just what "
+    "so can will meet at tomorrow lunch ok sounds good thanks see later message chat"
+).split()
+
+
+class Relay(threading.Thread):
+    """
+    Relay class, a TCP proxy in front of a server that counts the bytes it forwards
+
+    Clients connect to `port` instead of the server. Everything gRPC puts on the socket is
+    counted, HTTP/2 framing and headers included, after any compression.
+    """
+
+    def __init__(self, target_port):
+        super().__init__(daemon=True)
+        self.target = ("127.0.0.1", target_port)
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.to_client = 0
+        self.to_server = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target)
+            for src, dst, direction in (
+                (client, upstream, "to_server"),
+                (upstream, client, "to_client"),
+            ):
+                threading.Thread(
+                    target=self._pump, args=(src, dst, direction), daemon=True
+                ).start()
+
+    def _pump(self, src, dst, direction):
+        try:
+            while data := src.recv(65536):
+                # counted before it is passed on, so it is in by the time the client has it
+                with self._lock:
+                    setattr(self, direction, getattr(self, direction) + len(data))
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (src, dst):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def close(self):
+        self.listener.close()
+
+
+def make_text(n_chars, rng):
+    words = []
+    length = 0
+    while length < n_chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:n_chars]
+
+
+def run(mode, message_chars, page_size, rounds, min_bytes):
+    """
+    Time LoadChat pages against an in-process server with one compression mode.
+
+    Parameters:
+    ----------
+    mode : str
+        "none", "gzip" or "deflate"
+    message_chars : int
+        length of every message on the page
+    page_size : int
+        messages per LoadChat page
+    rounds : int
+        LoadChat calls timed
+    min_bytes : int
+        compression threshold of the server
+
+    Returns:
+    ----------
+    tuple
+        (one page, whether it was sent compressed, bytes received per call through a
+        relay, latencies in seconds)
+    """
+    servicer = ChatServiceServicer(
+        store=create_store({"engine": "memory"}),
+        auth=AuthPool(workers=0, iterations=1000),
+        compression=mode,
+        compression_min_bytes=min_bytes,
+    )
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    relay = Relay(port)
+    relay.start()
+    channel = grpc.insecure_channel(f"127.0.0.1:{relay.port}")
+    stub = chat_pb2_grpc.ChatServiceStub(channel)
+
+    rng = random.Random(message_chars)
+    for username in ("foo", "bar"):
+        servicer.store.create_user(username, "p")
+    for _ in range(page_size):
+        servicer.store.send_message("bar", "foo", make_text(message_chars, rng))
+
+    request = chat_pb2.ChatRequest(username="foo", user2="bar", page_size=page_size)
+    # warm up the channel and the server
+    page = stub.LoadChat(request, timeout=10)
+
+    latencies = []
+    received = relay.to_client
+    for _ in range(rounds):
+        start = time.perf_counter()
+        stub.LoadChat(request, timeout=10)
+        latencies.append(time.perf_counter() - start)
+    received = (relay.to_client - received) / rounds
+
+    channel.close()
+    relay.close()
+    server.stop(0)
+    servicer.fanout.stop()
+    servicer.store.close()
+    return page, servicer.compresses(page.ByteSize()), received, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare response bytes and LoadChat latency with and without compression."
+    )
+    parser.add_argument("--sizes", default="16,64,256,1024,4096", help="message lengths")
+    parser.add_argument("--page-size", type=int, default=50, help="messages per page")
+    parser.add_argument("--rounds", type=int, default=200, help="calls timed per case")
+    parser.add_argument("--mode", default="gzip", choices=["gzip", "deflate"])
+    parser.add_argument("--min-bytes", type=int, default=compression_min_bytes_default)
+    parser.add_argument(
+        "--link-kbps",
+        type=float,
+        default=256,
+        help="link speed used to estimate transfer time on a constrained connection",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"page of {args.page_size} messages, {args.mode} above {args.min_bytes} bytes, "
+        f"{args.rounds} calls, transfer estimated at {args.link_kbps:g} kbit/s"
+    )
+    # "on wire" is measured on the socket, per call, with HTTP/2 framing and headers
+    print(
+        f"{'chars':>6} {'mode':>7} {'bytes':>8} {'on wire':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'link ms':>8}"
+    )
+    for chars in [int(s) for s in args.sizes.split(",")]:
+        for mode in ("none", args.mode):
+            page, compressed, wire, latencies = run(
+                mode, chars, args.page_size, args.rounds, args.min_bytes
+            )
+            size = page.ByteSize()
+            latencies.sort()
+            p50 = statistics.median(latencies) * 1000
+            p95 = latencies[int(0.95 * (len(latencies) - 1))] * 1000
+            link = wire * 8 / args.link_kbps
+            print(
+                f"{chars:>6} {mode if compressed else 'none':>7} {size:>8} {wire:>8.0f} "
+                f"{p50:>8.2f} {p95:>8.2f} {link:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
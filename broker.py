@@ -0,0 +1,222 @@
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+# Frames are a 4 byte length, then a 1 byte kind, a 2 byte username length, the username and
+# the serialized ChatResponse (if any).
+ONLINE = b"O"
+OFFLINE = b"F"
+ROUTE = b"R"
+BROADCAST = b"B"
+
+_LENGTH = struct.Struct(">I")
+_NAME = struct.Struct(">H")
+
+
+def send_frame(sock, kind, username="", payload=b""):
+    name = username.encode()
+    body = kind + _NAME.pack(len(name)) + name + payload
+    sock.sendall(_LENGTH.pack(len(body)) + body)
+
+
+def _recv_exactly(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("Broker connection closed.")
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    """
+    Read one frame. Returns (kind, username, payload).
+    """
+    (length,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    body = _recv_exactly(sock, length)
+    (name_length,) = _NAME.unpack_from(body, 1)
+    start = 1 + _NAME.size
+    username = body[start : start + name_length].decode()
+    return body[:1], username, body[start + name_length :]
+
+
+class Broker(threading.Thread):
+    """
+    Broker class, routes chat traffic between the worker processes of one host
+
+    Listens on a Unix socket. Each worker process connects once and tells the broker which
+    users are connected to it (ONLINE/OFFLINE). A ROUTE frame is forwarded to the worker
+    holding its user, a BROADCAST frame to every other worker.
+    """
+
+    def __init__(self, socket_path):
+        super().__init__(daemon=True)
+        self.socket_path = socket_path
+        # username -> socket of the worker the user is connected to
+        self.owners = {}
+        self.workers = set()
+        self.routed = 0
+        self._send_locks = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(socket_path)
+        self._server.listen()
+
+    def _send(self, conn, kind, username, payload):
+        try:
+            with self._send_locks[conn]:
+                send_frame(conn, kind, username, payload)
+        except (OSError, KeyError):
+            # the worker went away, its reader thread cleans up
+            pass
+
+    def _serve_worker(self, conn):
+        try:
+            while True:
+                kind, username, payload = recv_frame(conn)
+                if kind == ONLINE:
+                    with self._lock:
+                        self.owners[username] = conn
+                elif kind == OFFLINE:
+                    with self._lock:
+                        # the user may have logged in on another worker since
+                        if self.owners.get(username) is conn:
+                            del self.owners[username]
+                elif kind == ROUTE:
+                    with self._lock:
+                        target = self.owners.get(username)
+                    if target is not None and target is not conn:
+                        self._send(target, ROUTE, username, payload)
+                        # one reader thread per worker, all of them count here
+                        with self._lock:
+                            self.routed += 1
+                elif kind == BROADCAST:
+                    with self._lock:
+                        targets = [w for w in self.workers if w is not conn]
+                    for target in targets:
+                        self._send(target, BROADCAST, username, payload)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self._lock:
+                self.workers.discard(conn)
+                self._send_locks.pop(conn, None)
+                for username in [u for u, c in self.owners.items() if c is conn]:
+                    del self.owners[username]
+            conn.close()
+
+    def run(self):
+        while not self._stopped:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                break
+            with self._lock:
+                self.workers.add(conn)
+                self._send_locks[conn] = threading.Lock()
+            threading.Thread(target=self._serve_worker, args=(conn,), daemon=True).start()
+
+    def stop(self):
+        self._stopped = True
+        self._server.close()
+        with self._lock:
+            for conn in list(self.workers):
+                conn.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class BrokerClient:
+    """
+    BrokerClient class, a worker process's connection to the Broker
+
+    Reports the users connected to this worker and sends responses meant for users on other
+    workers. Frames from the broker are handed to `on_route(username, response)` and
+    `on_broadcast(response)` on a reader thread.
+    """
+
+    def __init__(self, socket_path, on_route, on_broadcast, connect_timeout=10.0):
+        """
+        Parameters:
+        ----------
+        socket_path : str
+            Unix socket the broker listens on
+        on_route : callable
+            called with (username, ChatResponse) for a user connected to this worker
+        on_broadcast : callable
+            called with a ChatResponse broadcast by another worker
+        connect_timeout : float
+            seconds to wait for the broker to come up
+        """
+        # imported here so the broker process does not need the generated code
+        import chat_pb2
+
+        self._parse = chat_pb2.ChatResponse.FromString
+        self.on_route = on_route
+        self.on_broadcast = on_broadcast
+        self._lock = threading.Lock()
+
+        deadline = time.monotonic() + connect_timeout
+        while True:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self._sock.connect(socket_path)
+                break
+            except OSError:
+                self._sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _send(self, kind, username="", response=None):
+        payload = response.SerializeToString() if response is not None else b""
+        try:
+            with self._lock:
+                send_frame(self._sock, kind, username, payload)
+        except OSError as e:
+            logging.error(f"Error sending to broker: {e}")
+
+    def online(self, username):
+        self._send(ONLINE, username)
+
+    def offline(self, username):
+        self._send(OFFLINE, username)
+
+    def route(self, username, response):
+        """
+        Send a response to a user connected to another worker, dropped if nobody has them.
+        """
+        self._send(ROUTE, username, response)
+
+    def broadcast(self, response):
+        """
+        Send a response to the users of every other worker.
+        """
+        self._send(BROADCAST, response=response)
+
+    def _read(self):
+        try:
+            while True:
+                kind, username, payload = recv_frame(self._sock)
+                try:
+                    if kind == ROUTE:
+                        self.on_route(username, self._parse(payload))
+                    elif kind == BROADCAST:
+                        self.on_broadcast(self._parse(payload))
+                except Exception as e:
+                    logging.error(f"Error handling a frame from the broker: {e}")
+        except (ConnectionError, OSError):
+            logging.error("Lost the connection to the broker.")
+
+    def close(self):
+        self._sock.close()
@@ -39,18 +39,54 @@ class ChatServiceStub(object):
                 request_serializer=chat__pb2.ChatRequest.SerializeToString,
                 response_deserializer=chat__pb2.ChatResponse.FromString,
                 _registered_method=True)
+        self.CheckUsername = channel.unary_unary(
+                '/chat.ChatService/CheckUsername',
+                request_serializer=chat__pb2.ChatRequest.SerializeToString,
+                response_deserializer=chat__pb2.ChatResponse.FromString,
+                _registered_method=True)
+        self.Login = channel.unary_unary(
+                '/chat.ChatService/Login',
+                request_serializer=chat__pb2.ChatRequest.SerializeToString,
+                response_deserializer=chat__pb2.ChatResponse.FromString,
+                _registered_method=True)
+        self.LoadChat = channel.unary_unary(
+                '/chat.ChatService/LoadChat',
+                request_serializer=chat__pb2.ChatRequest.SerializeToString,
+                response_deserializer=chat__pb2.ChatResponse.FromString,
+                _registered_method=True)
 
 
 class ChatServiceServicer(object):
     """Missing associated documentation comment in .proto file."""
 
     def Chat(self, request_iterator, context):
-        """A single bidirectional stream for all chat operations.
+        """Bidirectional stream for pushed PINGs and every other chat operation.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def CheckUsername(self, request, context):
+        """Request/response operations as their own calls, so they run in parallel with the
+        stream and each other and can carry deadlines. The action field is ignored.
         """
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def Login(self, request, context):
+        """returns a session_token, RESUME the Chat stream with it to receive PINGs
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def LoadChat(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -59,6 +95,21 @@ def add_ChatServiceServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.ChatRequest.FromString,
                     response_serializer=chat__pb2.ChatResponse.SerializeToString,
             ),
+            'CheckUsername': grpc.unary_unary_rpc_method_handler(
+                    servicer.CheckUsername,
+                    request_deserializer=chat__pb2.ChatRequest.FromString,
+                    response_serializer=chat__pb2.ChatResponse.SerializeToString,
+            ),
+            'Login': grpc.unary_unary_rpc_method_handler(
+                    servicer.Login,
+                    request_deserializer=chat__pb2.ChatRequest.FromString,
+                    response_serializer=chat__pb2.ChatResponse.SerializeToString,
+            ),
+            'LoadChat': grpc.unary_unary_rpc_method_handler(
+                    servicer.LoadChat,
+                    request_deserializer=chat__pb2.ChatRequest.FromString,
+                    response_serializer=chat__pb2.ChatResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'chat.ChatService', rpc_method_handlers)
@@ -96,3 +147,84 @@ class ChatService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def CheckUsername(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/CheckUsername',
+            chat__pb2.ChatRequest.SerializeToString,
+            chat__pb2.ChatResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def Login(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/Login',
+            chat__pb2.ChatRequest.SerializeToString,
+            chat__pb2.ChatResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def LoadChat(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/LoadChat',
+            chat__pb2.ChatRequest.SerializeToString,
+            chat__pb2.ChatResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
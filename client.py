@@ -1,7 +1,9 @@
+import itertools
 import os
 import queue
 import sys
 import threading
+import time
 import tkinter as tk
 import json
 import logging
@@ -10,6 +12,7 @@ import grpc
 
 import chat_pb2
 import chat_pb2_grpc
+from metrics import WireStats
 
 # log to a file
 log_file = "logs/client.log"
@@ -30,11 +33,40 @@ if not os.path.exists(log_file):
 # A thread-safe queue for outgoing ChatRequests.
 outgoing_queue = queue.Queue()
 
+# serialized sizes of the requests sent ("out") and responses received ("in"), per action
+wire_stats = WireStats()
 
-def request_generator():
-    """Yield ChatRequests from the outgoing_queue."""
-    while True:
-        req = outgoing_queue.get()
+# number of messages requested per LOAD_CHAT page
+page_size = 50
+
+# seconds between attempts to RESUME a dropped stream
+reconnect_delay = 1.0
+
+# deadline in seconds for the unary calls (CheckUsername, Login, LoadChat)
+unary_timeout = 10.0
+
+
+def request_generator(first=None, done=None):
+    """
+    Yield ChatRequests from the outgoing_queue.
+
+    Parameters
+    ----------
+    first : chat_pb2.ChatRequest
+        Request sent before anything queued, the RESUME of a new stream.
+    done : threading.Event
+        Set when the stream has ended, so this generator stops taking requests
+        meant for the next one.
+    """
+    if first is not None:
+        wire_stats.record("out", first)
+        yield first
+    while done is None or not done.is_set():
+        try:
+            req = outgoing_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        wire_stats.record("out", req)
         yield req
 
 
@@ -73,9 +105,26 @@ class ClientUI:
 
         self.credentials = None
 
+        # token from LOGIN/REGISTER to RESUME a dropped stream with, and the seq of the
+        # last PING received
+        self.session_token = None
+        self.last_seq = 0
+
+        # requests waiting for a response, request_id -> what the response applies to,
+        # so several sends, loads and deletes can be in flight at once
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        self.pending_lock = threading.Lock()
+
+        # responses from the Chat stream and from unary calls, as (request, response), all
+        # processed by one thread so the UI state is never changed from two at once. A
+        # response of None means the unary call for request failed.
+        self.incoming = queue.Queue()
+        threading.Thread(target=self.process_incoming, daemon=True).start()
+
         # start connection
-        # Start a background thread to process server responses.
-        threading.Thread(target=self.handle_responses, daemon=True).start()
+        # Start a background thread to receive server responses.
+        threading.Thread(target=self.keep_connected, daemon=True).start()
 
         # setup first screen
         self.setup_user_entry()
@@ -85,9 +134,17 @@ class ClientUI:
         # online users
         self.users = []
 
+        # user list kept across logins as (username, users, version) so logging back in
+        # only needs the changes since then
+        self.users_cache = (None, [], 0)
+
         # current messages in conversation
         self.loaded_messages = []
 
+        # cursor for the next older page of the conversation, 0 if none
+        self.chat_cursor = 0
+        self.loading_older = False
+
         # incoming pings
         self.incoming_pings = []
 
@@ -100,155 +157,359 @@ class ClientUI:
 
         # run the tkinter main loop
         self.root.mainloop()
+        wire_stats.log_snapshot()
 
-    def handle_responses(self):
+    def keep_connected(self):
+        """
+        Run the chat stream, and when it drops, open a new one and RESUME the session on it.
+        Before login there is nothing to resume, the new stream starts plain. Gives up if
+        the server is full.
+        """
+        first = None
+        while True:
+            done = threading.Event()
+            retry = self.handle_responses(request_generator(first, done))
+            done.set()
+            if not retry:
+                return
+
+            time.sleep(reconnect_delay)
+            if not self.session_token:
+                # a unary Login can still succeed, its RESUME waits in outgoing_queue
+                logging.info("Reconnecting the chat stream")
+                first = None
+                continue
+
+            logging.info(f"Resuming session of {self.credentials}")
+            owner, _, users_version = self.users_cache
+            first = chat_pb2.ChatRequest(
+                action=chat_pb2.RESUME,
+                session_token=self.session_token,
+                last_seq=self.last_seq,
+                users_version=users_version if owner == self.credentials else 0,
+            )
+
+    def handle_responses(self, requests):
         """
         Constantly check for responses from the server and process them.
+
+        Parameters
+        ----------
+        requests : iterator
+            The requests to send on this stream.
+
+        Returns
+        -------
+        bool
+            Whether the session can be resumed on a new stream.
         """
         try:
-            responses = self.stub.Chat(request_generator())
+            responses = self.stub.Chat(requests)
             for resp in responses:
-                logging.info(f'Size of response: {sys.getsizeof(resp)}')
-                action = resp.action
-                if action == chat_pb2.CHECK_USERNAME:
-                    # destroy current screen
-                    self.destroy_user_entry()
-                    # if the username exists, go to login
-                    # if not, go to register
-                    if not resp.result:
-                        self.setup_login()
-                    else:
-                        self.setup_register()
-                elif action == chat_pb2.LOGIN:
-                    # if login successful, update users and go to undelivered
-                    # if not, go to login with failed
-                    if resp.result:
-                        self.users = list(resp.users)
-                        self.n_undelivered = resp.n_undelivered
-                        self.credentials = self.login_entry.get()
-                        self.login_frame.destroy()
-                        self.setup_undelivered()
-                    else:
-                        self.login_frame.destroy()
-                        self.setup_login(failed=True)
-                elif action == chat_pb2.REGISTER:
-                    # if successful login, update users and go to main
-                    # if not, go to register with failed
-                    if resp.result:
-                        self.users = list(resp.users)
-                        self.credentials = self.register_entry.get()
-                        self.register_frame.destroy()
-                        self.setup_main()
-                    else:
-                        self.register_username_exists_label.pack()
-                elif action == chat_pb2.LOAD_CHAT:
-                    # load the chat for the connected user
-                    # format messages correctly
-                    messages = []
-
-                    for cm in resp.messages:
-                        messages.append(
-                            (cm.sender, cm.recipient, cm.message, cm.message_id)
-                        )
+                wire_stats.record("in", resp)
+                self.incoming.put((None, resp))
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+                # the server refused this connection, it is at its client limit
+                logging.error(f"Server is full: {e.details()}")
+                return False
+            logging.error(f"Error receiving response: {e}")
+        return True
 
-                    self.loaded_messages = messages
-                    self.rerender_messages()
-                elif action == chat_pb2.SEND_MESSAGE:
-                    # a message was sent currently to the user
-                    self.loaded_messages.append(
-                        (
-                            self.credentials,
-                            self.connected_to,
-                            self.chat_entry.get(),
-                            resp.message_id,
-                        )
+    def process_incoming(self):
+        """
+        Process responses from the Chat stream and unary calls in the order they arrive.
+        """
+        while True:
+            request, resp = self.incoming.get()
+            try:
+                if resp is None:
+                    self.unary_failed(request)
+                else:
+                    self.process_response(resp)
+            except Exception as e:
+                logging.error(f"Error processing response: {e}")
+
+    def process_response(self, resp):
+        """
+        Process one response, from the Chat stream or a unary call.
+
+        Parameters
+        ----------
+        resp : chat_pb2.ChatResponse
+            The response to process.
+        """
+        action = resp.action
+        # what the request was for, empty for pushed responses
+        details = self.pop_pending(resp.request_id)
+        if action == chat_pb2.CHECK_USERNAME:
+            # destroy current screen
+            self.destroy_user_entry()
+            # if the username exists, go to login
+            # if not, go to register
+            if not resp.result:
+                self.setup_login()
+            else:
+                self.setup_register()
+        elif action == chat_pb2.LOGIN:
+            # if login successful, update users and go to undelivered
+            # if not, go to login with failed
+            if resp.result:
+                self.credentials = self.login_entry.get()
+                self.session_token = resp.session_token
+                self.last_seq = 0
+                self.update_users(resp)
+                self.n_undelivered = resp.n_undelivered
+                self.send_attach_request()
+                self.login_frame.destroy()
+                self.setup_undelivered()
+            else:
+                self.login_frame.destroy()
+                self.setup_login(failed=True)
+        elif action == chat_pb2.REGISTER:
+            # if successful login, update users and go to main
+            # if not, go to register with failed
+            if resp.result:
+                self.credentials = self.register_entry.get()
+                self.session_token = resp.session_token
+                self.last_seq = 0
+                self.update_users(resp)
+                self.register_frame.destroy()
+                self.setup_main()
+            else:
+                self.register_username_exists_label.pack()
+        elif action == chat_pb2.LOAD_CHAT:
+            # load the chat for the connected user
+            # format messages correctly
+            messages = []
+
+            for cm in resp.messages:
+                messages.append(
+                    (cm.sender, cm.recipient, cm.message, cm.message_id)
+                )
+
+            # a chat that was closed again before its page arrived
+            if details and details["user2"] != self.connected_to:
+                return
+
+            # older pages go in front of what is already loaded
+            if details.get("older", self.loading_older):
+                self.loaded_messages = messages + self.loaded_messages
+                self.loading_older = False
+            else:
+                self.loaded_messages = messages
+            self.chat_cursor = resp.next_cursor
+            self.rerender_messages()
+        elif action == chat_pb2.SEND_MESSAGE:
+            # a message was sent currently to the user, if their chat is still open
+            if details.get("recipient") == self.connected_to:
+                self.loaded_messages.append(
+                    (
+                        self.credentials,
+                        self.connected_to,
+                        details["message"],
+                        resp.message_id,
                     )
-                    self.chat_entry.delete(0, tk.END)
+                )
+                self.rerender_messages()
+        elif action == chat_pb2.VIEW_UNDELIVERED:
+            # format undelivered messages correctly
+            messages = []
+
+            for cm in resp.messages:
+                messages.append(
+                    (cm.sender, cm.recipient, cm.message, cm.message_id)
+                )
+
+            self.undelivered_messages = messages
+            self.rerender_undelivered()
+        elif action == chat_pb2.PING:
+            self.last_seq = max(self.last_seq, resp.seq)
+            if resp.messages:
+                # a batch from SEND_MESSAGES, shown one message at a time and
+                # acknowledged together
+                acks = []
+                for cm in resp.messages:
+                    if self.show_ping(cm.sender, cm.message, cm.message_id):
+                        acks.append(cm.message_id)
+                if acks:
+                    self.send_ack_request(acks)
+            elif resp.message_id == 0:
+                # the server merged PINGs we were too slow to read, the messages
+                # are still undelivered
+                self.incoming_pings.append(
+                    ("server", f"{resp.n_undelivered} more messages, see undelivered")
+                )
+                self.rerender_pings()
+                if self.connected_to:
+                    self.send_chat_load_request(self.connected_to)
+            elif self.show_ping(resp.sender, resp.sent_message, resp.message_id):
+                self.send_ack_request([resp.message_id])
+        elif action == chat_pb2.DELETE_MESSAGE:
+            # find message in loaded messages and delete it
+            self.loaded_messages = [
+                m for m in self.loaded_messages if m[3] != details.get("message_id")
+            ]
+            self.chat_entry.delete(0, tk.END)
+            self.rerender_messages()
+        elif action == chat_pb2.DELETE_ACCOUNT:
+            # if successful, reset login vars and go to deleted
+            # if not, go to settings with failed
+            if resp.result:
+                self.reset_login_vars()
+                self.destroy_settings()
+                self.setup_deleted()
+            else:
+                self.destroy_settings()
+                self.setup_settings(failed=True)
+        elif action == chat_pb2.PING_USER:
+            # if the user is connected, remove them from the users list
+            # if the user is the connected user, reset the chat
+            # if the user is the connected user, remove the pings
+
+            # if it is a new user, add them to the users list
+            pinging_user = resp.ping_user
+            if pinging_user in self.users:
+                self.users = [
+                    user for user in self.users if user != pinging_user
+                ]
+                self.rerender_users()
+                if self.connected_to == pinging_user:
+                    self.connected_to = None
+                    self.loaded_messages = []
                     self.rerender_messages()
-                elif action == chat_pb2.VIEW_UNDELIVERED:
-                    # format undelivered messages correctly
-                    messages = []
+                self.incoming_pings = [
+                    ping
+                    for ping in self.incoming_pings
+                    if ping[0] != pinging_user
+                ]
+                self.rerender_pings()
+            elif pinging_user != self.credentials:
+                self.users.append(pinging_user)
+                self.rerender_users()
+
+            # keep the cached list current if no change was missed
+            owner, _, version = self.users_cache
+            if owner == self.credentials and resp.users_version == version + 1:
+                self.users_cache = (owner, self.users, resp.users_version)
+        elif action == chat_pb2.RESUME:
+            # the missed PINGs follow, no need to reload the chat
+            if resp.result:
+                self.update_users(resp)
+                self.n_undelivered = resp.n_undelivered
+                # only the main screen lists users
+                main_frame = getattr(self, "main_frame", None)
+                if main_frame is not None and main_frame.winfo_exists():
+                    self.rerender_users()
+            else:
+                # the token expired, log in again
+                logging.info("Session expired, logging in again")
+                for widget in self.root.winfo_children():
+                    widget.destroy()
+                self.reset_login_vars()
+                self.setup_login()
+
+    def call_unary(self, method, request):
+        """
+        Send a request as its own unary call, next to the Chat stream.
+        The response is processed like a stream response once it arrives.
 
-                    for cm in resp.messages:
-                        messages.append(
-                            (cm.sender, cm.recipient, cm.message, cm.message_id)
-                        )
+        Parameters
+        ----------
+        method : grpc.UnaryUnaryMultiCallable
+            The stub method to call.
+        request : chat_pb2.ChatRequest
+            The request to send.
+        """
+        wire_stats.record("out", request)
+        future = method.future(request, timeout=unary_timeout)
+        future.add_done_callback(
+            lambda future: self.handle_unary_response(future, request)
+        )
 
-                    self.undelivered_messages = messages
-                    self.rerender_undelivered()
-                elif action == chat_pb2.PING:
-                    if self.connected_to == resp.sender:
-                        # if the message_id already exists in current loaded messages, remove it
-                        if resp.message_id in [m[3] for m in self.loaded_messages]:
-                            self.loaded_messages = [
-                                m
-                                for m in self.loaded_messages
-                                if m[3] != resp.message_id
-                            ]
-                        else:
-                            self.loaded_messages.append(
-                                (
-                                    self.connected_to,
-                                    self.credentials,
-                                    resp.sent_message,
-                                    resp.message_id,
-                                )
-                            )
-                        self.rerender_messages()
-                    else:
-                        self.incoming_pings.append((resp.sender, resp.sent_message))
-                        self.rerender_pings()
-                elif action == chat_pb2.DELETE_MESSAGE:
-                    # find message in loaded messages and delete it
-                    index = self.chat_text.curselection()[0] - 1
-                    del self.loaded_messages[index]
-                    self.chat_entry.delete(0, tk.END)
-                    self.rerender_messages()
-                elif action == chat_pb2.DELETE_ACCOUNT:
-                    # if successful, reset login vars and go to deleted
-                    # if not, go to settings with failed
-                    if resp.result:
-                        self.reset_login_vars()
-                        self.destroy_settings()
-                        self.setup_deleted()
-                    else:
-                        self.destroy_settings()
-                        self.setup_settings(failed=True)
-                elif action == chat_pb2.PING_USER:
-                    # if the user is connected, remove them from the users list
-                    # if the user is the connected user, reset the chat
-                    # if the user is the connected user, remove the pings
-
-                    # if it is a new user, add them to the users list
-                    pinging_user = resp.ping_user
-                    if pinging_user in self.users:
-                        self.users = [
-                            user for user in self.users if user != pinging_user
-                        ]
-                        self.rerender_users()
-                        if self.connected_to == pinging_user:
-                            self.connected_to = None
-                            self.loaded_messages = []
-                            self.rerender_messages()
-                        self.incoming_pings = [
-                            ping
-                            for ping in self.incoming_pings
-                            if ping[0] != pinging_user
-                        ]
-                        self.rerender_pings()
-                    elif pinging_user != self.credentials:
-                        self.users.append(pinging_user)
-                        self.rerender_users()
+    def handle_unary_response(self, future, request):
+        """
+        Hand the response of a unary call to the processing thread, or log why it failed.
+        Runs on a gRPC callback thread.
+        """
+        try:
+            resp = future.result()
         except grpc.RpcError as e:
-            logging.error(f"Error receiving response: {e}")
+            logging.error(f"Error in unary call: {e}")
+            self.incoming.put((request, None))
+            return
+        wire_stats.record("in", resp)
+        self.incoming.put((request, resp))
+
+    def unary_failed(self, request):
+        """
+        Forget a unary call that failed, no response will come for it.
+        """
+        self.pop_pending(request.request_id)
+        if request.action == chat_pb2.LOAD_CHAT:
+            self.loading_older = False
+
+    def track(self, request, **details):
+        """
+        Give a request the next request_id and remember what its response applies to.
+
+        Parameters
+        ----------
+        request : chat_pb2.ChatRequest
+            The request about to be sent.
+        details : dict
+            What the response handler needs to know about the request.
+        """
+        with self.pending_lock:
+            request.request_id = next(self.request_ids)
+            self.pending[request.request_id] = details
+        return request
+
+    def pop_pending(self, request_id):
+        """
+        Get and forget what a response's request was for, empty if it is not pending.
+        """
+        if not request_id:
+            return {}
+        with self.pending_lock:
+            return self.pending.pop(request_id, {})
+
+    def update_users(self, resp):
+        """
+        Update the user list from a LOGIN or REGISTER response.
+
+        The response either has the full list or, if users_delta is set, only the users added
+        and removed since the version cached for this username.
+
+        Parameters
+        ----------
+        resp : chat_pb2.ChatResponse
+            The successful login or register response.
+        """
+        owner, cached, _ = self.users_cache
+        if resp.users_delta and owner == self.credentials:
+            removed = set(resp.removed_users)
+            users = [u for u in cached if u not in removed]
+            users += [
+                u for u in resp.users if u not in users and u != self.credentials
+            ]
+        else:
+            users = list(resp.users)
+
+        self.users = users
+        self.users_cache = (self.credentials, users, resp.users_version)
 
     def reset_login_vars(self):
         """
         Reset the login variables.
         """
         self.credentials = None
+        self.session_token = None
+        self.last_seq = 0
         self.users = []
         self.loaded_messages = []
+        self.chat_cursor = 0
+        self.loading_older = False
         self.incoming_pings = []
         self.undelivered_messages = []
         self.n_undelivered = 0
@@ -275,11 +536,34 @@ class ClientUI:
         confirm_password : str
             The confirm password to send. Only used for registration.
         """
+        # ask for only the user list changes if we have a list cached for this user
+        owner, _, users_version = self.users_cache
+
         # create a request
         request = chat_pb2.ChatRequest(
             action=action,
             username=username,
             passhash=password,
+            users_version=users_version if owner == username else 0,
+        )
+
+        # logging in does not need the stream, it is attached with RESUME afterwards
+        if action == chat_pb2.LOGIN:
+            self.call_unary(self.stub.Login, request)
+        else:
+            outgoing_queue.put(request)
+
+    def send_attach_request(self):
+        """
+        Attach the Chat stream to the session a unary Login started, so PINGs are pushed
+        to it.
+        """
+        _, _, users_version = self.users_cache
+        request = chat_pb2.ChatRequest(
+            action=chat_pb2.RESUME,
+            session_token=self.session_token,
+            last_seq=self.last_seq,
+            users_version=users_version,
         )
 
         outgoing_queue.put(request)
@@ -300,7 +584,7 @@ class ClientUI:
             username=username,
         )
 
-        outgoing_queue.put(request)
+        self.call_unary(self.stub.CheckUsername, request)
 
     def send_chat_load_request(self, username):
         """
@@ -318,16 +602,40 @@ class ClientUI:
             action=chat_pb2.LOAD_CHAT,
             username=self.credentials,
             user2=username,
+            page_size=page_size,
         )
+        self.track(request, user2=username, older=False)
 
-        outgoing_queue.put(request)
-
+        self.loading_older = False
         self.connected_to = username
         self.incoming_pings = [
             ping for ping in self.incoming_pings if ping[0] != username
         ]  # KG: could cause slowdown
         self.rerender_pings()
 
+        # sent last, the response can arrive before this returns
+        self.call_unary(self.stub.LoadChat, request)
+
+    def send_older_chat_request(self):
+        """
+        Send a request for the page of messages before the oldest one loaded.
+        Does nothing if there is no open chat or no older page.
+        """
+        if not self.connected_to or not self.chat_cursor or self.loading_older:
+            return
+
+        request = chat_pb2.ChatRequest(
+            action=chat_pb2.LOAD_CHAT,
+            username=self.credentials,
+            user2=self.connected_to,
+            before_message_id=self.chat_cursor,
+            page_size=page_size,
+        )
+        self.track(request, user2=self.connected_to, older=True)
+
+        self.loading_older = True
+        self.call_unary(self.stub.LoadChat, request)
+
     def send_message_request(self, message):
         """
         Send a request to send a message to the connected user.
@@ -347,11 +655,68 @@ class ClientUI:
             recipient=self.connected_to,
             message=message,
         )
+        self.track(request, recipient=self.connected_to, message=message)
 
         outgoing_queue.put(request)
 
+        # the next message can be typed and sent before this one is answered
+        self.chat_entry.delete(0, tk.END)
+
         # self.check_send_message_request()
 
+    def show_ping(self, sender, sent_message, message_id):
+        """
+        Show a message pushed by the server, in the open chat or as a ping.
+
+        Parameters
+        ----------
+        sender : str
+            The user who sent the message.
+        sent_message : str
+            The text of the message.
+        message_id : int
+            The id of the message.
+
+        Returns
+        -------
+        bool
+            Whether the message is new and should be acknowledged.
+        """
+        if self.connected_to != sender:
+            self.incoming_pings.append((sender, sent_message))
+            self.rerender_pings()
+            return True
+
+        # if the message_id already exists in current loaded messages, remove it
+        if message_id in [m[3] for m in self.loaded_messages]:
+            self.loaded_messages = [
+                m for m in self.loaded_messages if m[3] != message_id
+            ]
+            self.rerender_messages()
+            return False
+
+        self.loaded_messages.append(
+            (self.connected_to, self.credentials, sent_message, message_id)
+        )
+        self.rerender_messages()
+        return True
+
+    def send_ack_request(self, message_ids):
+        """
+        Tell the server that messages were received so they are marked delivered.
+
+        Parameters
+        ----------
+        message_ids : list of int
+            The ids of the received messages.
+        """
+        request = chat_pb2.ChatRequest(
+            action=chat_pb2.ACK,
+            message_ids=message_ids,
+        )
+
+        outgoing_queue.put(request)
+
     def send_undelivered_request(self, n_messages):
         """
         Send a request to view undelivered messages.
@@ -402,6 +767,7 @@ class ClientUI:
                 sender=self.credentials,
                 recipient=self.connected_to,
             )
+            self.track(request, message_id=message_id)
 
             outgoing_queue.put(request)
 
@@ -678,6 +1044,7 @@ class ClientUI:
         In the middle is the chat window.
         - This is a text widget that displays the chat history.
         - It is read-only.
+        - A "Load Older" button above it fetches the previous page of history.
 
         On the right side is the chat entry and settings.
         - It has a text entry for typing messages and a button under that says "send".
@@ -724,6 +1091,13 @@ class ClientUI:
         self.chat_frame = tk.Frame(self.main_frame)
         self.chat_frame.pack(side=tk.TOP)
 
+        self.load_older_button = tk.Button(
+            self.chat_frame,
+            text="Load Older",
+            command=lambda: self.send_older_chat_request(),
+        )
+        self.load_older_button.pack()
+
         self.chat_text = tk.Listbox(self.chat_frame)
 
         self.chat_text.pack()
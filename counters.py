@@ -0,0 +1,103 @@
+import sqlite3
+import threading
+
+
+class UndeliveredCounters:
+    """
+    UndeliveredCounters class for per-user undelivered message counts
+
+    Keeps the number of undelivered messages for every recipient in memory so LOGIN does not
+    have to count rows. The counts are rebuilt from the messages table once at startup and
+    then kept in sync by the send, ack, view and delete paths. Changes are written back to the
+    undelivered_counts summary table whenever persist() is called.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        # usernames whose count changed since the last persist
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def rebuild(self, conn):
+        """
+        Recount undelivered messages from the messages table and persist the result.
+
+        Parameters:
+        ----------
+        conn : sqlite3.Connection
+            open connection to the database
+        """
+        rows = conn.execute(
+            "SELECT recipient, COUNT(*) FROM messages WHERE delivered=0 GROUP BY recipient"
+        ).fetchall()
+
+        with self._lock:
+            self._counts = dict(rows)
+            self._dirty = set()
+
+        conn.execute("DELETE FROM undelivered_counts")
+        conn.executemany(
+            "INSERT INTO undelivered_counts (username, n_undelivered) VALUES (?, ?)", rows
+        )
+        conn.commit()
+
+    def get(self, username) -> int:
+        """
+        Get the number of undelivered messages for a user.
+        """
+        with self._lock:
+            return self._counts.get(username, 0)
+
+    def add(self, username, n=1):
+        """
+        Change a user's count by n, which is negative when messages are delivered or deleted.
+        """
+        if not n:
+            return
+        with self._lock:
+            count = max(self._counts.get(username, 0) + n, 0)
+            if count:
+                self._counts[username] = count
+            else:
+                self._counts.pop(username, None)
+            self._dirty.add(username)
+
+    def drop(self, username):
+        """
+        Forget a user's count, used when the account is deleted.
+        """
+        with self._lock:
+            self._counts.pop(username, None)
+            self._dirty.add(username)
+
+    def persist(self, conn):
+        """
+        Write changed counts to the undelivered_counts summary table.
+
+        Parameters:
+        ----------
+        conn : sqlite3.Connection
+            open connection to the database
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            changed = [(u, self._counts.get(u, 0)) for u in self._dirty]
+            self._dirty = set()
+
+        try:
+            conn.executemany(
+                "DELETE FROM undelivered_counts WHERE username=?",
+                [(u,) for u, n in changed if not n],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO undelivered_counts (username, n_undelivered) VALUES (?, ?)",
+                [(u, n) for u, n in changed if n],
+            )
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            # try these users again on the next persist
+            with self._lock:
+                self._dirty.update(u for u, _ in changed)
+            raise
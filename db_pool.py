@@ -0,0 +1,148 @@
+import logging
+import sqlite3
+import threading
+import time
+
+
+class ConnectionPool:
+    """
+    ConnectionPool class for long-lived SQLite connections
+
+    Each worker thread is given its own connection the first time it asks for one and keeps it
+    until release() is called (normally when its stream ends). Released connections are kept on
+    an idle stack so the next thread starts with a warm page cache and statement cache instead of
+    reopening the database file.
+    """
+
+    def __init__(
+        self,
+        db_path,
+        size=10,
+        cached_statements=128,
+        health_check_interval=30.0,
+        timeout=5.0,
+    ):
+        """
+        Parameters:
+        ----------
+        db_path : str
+            path to the sqlite database file
+        size : int
+            maximum number of idle connections kept open by the pool
+        cached_statements : int
+            number of prepared statements each connection keeps compiled
+        health_check_interval : float
+            idle connections older than this (in seconds) are checked before being reused
+        timeout : float
+            seconds to wait on a locked database before raising
+        """
+        self.db_path = db_path
+        self.size = size
+        self.cached_statements = cached_statements
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+
+        # stack of (connection, time it was released)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._closed = False
+
+    def _connect(self):
+        """
+        Open a new connection to the database.
+        """
+        # connections move between threads when they are released and reused
+        return sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+        )
+
+    def _is_healthy(self, conn):
+        """
+        Check that a connection can still run a query.
+        """
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _checkout(self):
+        """
+        Take a connection from the idle stack, or open a new one if none are usable.
+        """
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed.")
+                if not self._idle:
+                    break
+                conn, released_at = self._idle.pop()
+
+            if time.monotonic() - released_at < self.health_check_interval:
+                return conn
+            if self._is_healthy(conn):
+                return conn
+
+            logging.warning("Discarding unhealthy pooled connection.")
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+        return self._connect()
+
+    def connection(self):
+        """
+        Get the connection owned by the calling thread, checking one out if needed.
+
+        Returns:
+        ----------
+        sqlite3.Connection
+            connection reserved for this thread until release() is called
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._checkout()
+            self._local.conn = conn
+        return conn
+
+    def release(self):
+        """
+        Return the calling thread's connection to the pool.
+
+        Any open transaction is rolled back. The connection is closed instead if the pool is
+        closed or already holds `size` idle connections.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+
+        with self._lock:
+            if not self._closed and len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self):
+        """
+        Close all idle connections. Connections still held by threads are closed when released.
+        """
+        with self._lock:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+
+        for conn, _ in idle:
+            conn.close()
@@ -0,0 +1,130 @@
+import logging
+import queue
+import threading
+import time
+from concurrent import futures
+
+from metrics import LatencyHistogram
+
+
+class FanoutEngine(threading.Thread):
+    """
+    FanoutEngine class for delivering broadcasts to every connected user
+
+    broadcast() only queues the response, so the handler that caused it (REGISTER,
+    DELETE_ACCOUNT) answers its own client straight away. This thread takes up to
+    `max_batch` queued broadcasts at a time, takes one presence snapshot for all of them and
+    splits the sessions into chunks of `chunk_size` delivered in parallel by `workers`
+    threads. Each session gets the broadcasts in the order they were made.
+    """
+
+    def __init__(self, presence, workers=4, chunk_size=256, max_batch=64):
+        """
+        Parameters:
+        ----------
+        presence : PresenceRegistry
+            connected users to deliver to
+        workers : int
+            threads delivering chunks of sessions
+        chunk_size : int
+            sessions per delivery task
+        max_batch : int
+            most broadcasts delivered in one pass
+        """
+        super().__init__(daemon=True)
+        self.presence = presence
+        self.chunk_size = chunk_size
+        self.max_batch = max_batch
+
+        # time from broadcast() to the last session having it
+        self.latency = LatencyHistogram()
+        self.events = 0
+        self.deliveries = 0
+
+        self._events = queue.Queue()
+        self._pool = futures.ThreadPoolExecutor(max_workers=workers)
+
+    def broadcast(self, response):
+        """
+        Queue a response for every connected user.
+        """
+        self._events.put((time.perf_counter(), response))
+
+    def flush(self):
+        """
+        Wait until every broadcast queued so far has been delivered.
+        """
+        self._events.join()
+
+    def _send(self, sessions, responses):
+        for session in sessions:
+            for response in responses:
+                session.put(response)
+
+    def _deliver(self, batch):
+        sessions = self.presence.snapshot()
+        responses = [response for _, response in batch]
+        chunks = [
+            sessions[i : i + self.chunk_size]
+            for i in range(0, len(sessions), self.chunk_size)
+        ]
+
+        if len(chunks) == 1:
+            # not worth handing to the pool
+            self._send(chunks[0], responses)
+        else:
+            tasks = [self._pool.submit(self._send, chunk, responses) for chunk in chunks]
+            for task in tasks:
+                task.result()
+
+        done = time.perf_counter()
+        for queued_at, _ in batch:
+            self.latency.record(done - queued_at)
+        self.events += len(batch)
+        self.deliveries += len(batch) * len(sessions)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self._events.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = self._events.get_nowait()
+                except queue.Empty:
+                    break
+            # None asks the thread to stop, after this last batch
+            stopping = item is None
+
+            try:
+                if batch:
+                    self._deliver(batch)
+            except Exception as e:
+                logging.error(f"Error delivering {len(batch)} broadcasts: {e}")
+            finally:
+                for _ in range(len(batch) + stopping):
+                    self._events.task_done()
+
+    def stop(self):
+        """
+        Deliver what is queued, then stop the fan-out threads.
+        """
+        self._events.put(None)
+        self.join()
+        self._pool.shutdown()
+
+    def snapshot(self) -> dict:
+        """
+        Get the broadcast and delivery counts and the fan-out latency summary.
+        """
+        return dict(self.latency.summary(), events=self.events, deliveries=self.deliveries)
+
+    def log_snapshot(self):
+        s = self.snapshot()
+        logging.info(
+            f"fanout: events={s['events']} deliveries={s['deliveries']} p50={s['p50_ms']:.2f}ms "
+            f"p95={s['p95_ms']:.2f}ms p99={s['p99_ms']:.2f}ms max={s['max_ms']:.2f}ms"
+        )
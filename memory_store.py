@@ -0,0 +1,171 @@
+import bisect
+import itertools
+import threading
+import zlib
+
+from storage import MessageStore
+
+
+class _Stripe:
+    """
+    One lock and the data it guards.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # username -> passhash, for users hashed to this stripe
+        self.users = {}
+        # message_id -> [sender, recipient, message, delivered], for recipients hashed here
+        self.messages = {}
+        # (sender, recipient) -> ascending list of message_ids
+        self.inbox = {}
+        # recipient -> set of undelivered message_ids
+        self.undelivered = {}
+
+
+class MemoryMessageStore(MessageStore):
+    """
+    MemoryMessageStore class, a pure in-memory MessageStore engine
+
+    Nothing is written to disk, so it is meant for benchmarking the protocol layer and for
+    ephemeral instances. Data is split over `stripes` lock stripes: users by their name and
+    messages by their recipient, so unrelated conversations rarely wait on the same lock.
+    A conversation is the two directions (a -> b and b -> a), each kept in its recipient's
+    stripe and merged when loaded.
+    """
+
+    def __init__(self, stripes=16):
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self._ids = itertools.count(1)
+        # message_id -> stripe holding it; single dict operations are atomic under the GIL
+        self._locations = {}
+        # registration order for list_users
+        self._user_order = itertools.count()
+
+    def _stripe(self, name):
+        # stable across runs, unlike hash() on strings
+        return self._stripes[zlib.crc32(name.encode()) % len(self._stripes)]
+
+    # users
+
+    def list_users(self):
+        users = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                users.extend((order, u) for u, (_, order) in stripe.users.items())
+        return [u for _, u in sorted(users)]
+
+    def get_passhash(self, username):
+        stripe = self._stripe(username)
+        with stripe.lock:
+            entry = stripe.users.get(username)
+        return entry[0] if entry else None
+
+    def create_user(self, username, passhash) -> bool:
+        stripe = self._stripe(username)
+        with stripe.lock:
+            if username in stripe.users:
+                return False
+            stripe.users[username] = (passhash, next(self._user_order))
+        return True
+
+    def set_passhash(self, username, passhash):
+        stripe = self._stripe(username)
+        with stripe.lock:
+            entry = stripe.users.get(username)
+            if entry is not None:
+                stripe.users[username] = (passhash, entry[1])
+
+    def delete_account(self, username):
+        stripe = self._stripe(username)
+        with stripe.lock:
+            stripe.users.pop(username, None)
+
+        # messages to the user are in its own stripe, messages from it can be anywhere
+        for stripe in self._stripes:
+            with stripe.lock:
+                for key in [k for k in stripe.inbox if username in k]:
+                    for message_id in stripe.inbox.pop(key):
+                        stripe.messages.pop(message_id, None)
+                        self._locations.pop(message_id, None)
+                        stripe.undelivered.get(key[1], set()).discard(message_id)
+                stripe.undelivered.pop(username, None)
+
+    # messages
+
+    def send_message(self, sender, recipient, message) -> int:
+        stripe = self._stripe(recipient)
+        with stripe.lock:
+            # taken under the lock so each inbox list stays in id order
+            message_id = next(self._ids)
+            stripe.messages[message_id] = [sender, recipient, message, False]
+            stripe.inbox.setdefault((sender, recipient), []).append(message_id)
+            stripe.undelivered.setdefault(recipient, set()).add(message_id)
+            self._locations[message_id] = stripe
+        return message_id
+
+    def _page(self, stripe, sender, recipient, before, limit):
+        """
+        Newest `limit` messages from sender to recipient older than `before`.
+        """
+        with stripe.lock:
+            ids = stripe.inbox.get((sender, recipient), [])
+            end = bisect.bisect_left(ids, before) if before else len(ids)
+            return [
+                tuple(stripe.messages[i][:3]) + (i,)
+                for i in reversed(ids[max(end - limit, 0) : end])
+            ]
+
+    def load_chat(self, user1, user2, before_message_id=0, limit=50):
+        rows = self._page(self._stripe(user2), user1, user2, before_message_id, limit)
+        if user1 != user2:
+            rows += self._page(
+                self._stripe(user1), user2, user1, before_message_id, limit
+            )
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows[:limit]
+
+    def delete_message(self, message_id):
+        stripe = self._locations.get(message_id)
+        if stripe is None:
+            return
+        with stripe.lock:
+            record = stripe.messages.pop(message_id, None)
+            if record is None:
+                return
+            sender, recipient = record[0], record[1]
+            ids = stripe.inbox[(sender, recipient)]
+            del ids[bisect.bisect_left(ids, message_id)]
+            stripe.undelivered.get(recipient, set()).discard(message_id)
+        self._locations.pop(message_id, None)
+
+    # delivery state
+
+    def count_undelivered(self, username) -> int:
+        stripe = self._stripe(username)
+        with stripe.lock:
+            return len(stripe.undelivered.get(username, ()))
+
+    def view_undelivered(self, username, n_messages):
+        stripe = self._stripe(username)
+        with stripe.lock:
+            pending = stripe.undelivered.get(username, set())
+            viewed = sorted(pending, reverse=True)[:n_messages]
+            rows = []
+            for message_id in viewed:
+                record = stripe.messages[message_id]
+                record[3] = True
+                pending.discard(message_id)
+                rows.append(tuple(record[:3]) + (message_id,))
+        return rows
+
+    def mark_delivered(self, message_ids):
+        for message_id in message_ids:
+            stripe = self._locations.get(message_id)
+            if stripe is None:
+                continue
+            with stripe.lock:
+                record = stripe.messages.get(message_id)
+                if record is not None:
+                    record[3] = True
+                    stripe.undelivered.get(record[1], set()).discard(message_id)
@@ -0,0 +1,204 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MessageWriter(threading.Thread):
+    """
+    MessageWriter class for group-committing new messages
+
+    All streams hand their SEND_MESSAGE inserts to this single thread. It collects them into
+    short windows (up to `max_batch` messages or `max_wait_ms` milliseconds after the first one)
+    and writes each window in one transaction, so many senders share a single commit.
+    Each sender gets a future that resolves to its message_id once the batch is committed.
+    Messages submitted together with submit_many are never split across transactions.
+    If the thread itself dies, every pending future fails and later submissions raise.
+    """
+
+    def __init__(self, db_path, max_batch=64, max_wait_ms=5, timeout=5.0):
+        """
+        Parameters:
+        ----------
+        db_path : str
+            path to the sqlite database file
+        max_batch : int
+            maximum number of messages written in one transaction
+        max_wait_ms : float
+            how long to hold a batch open for more messages after the first arrives
+        timeout : float
+            seconds to wait on a locked database before raising
+        """
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.timeout = timeout
+
+        self._pending = queue.Queue()
+        self._stopped = False
+        # held while submitting, so nothing is queued after a failed writer drained its queue
+        self._lock = threading.Lock()
+        # what ended the thread, None while it is healthy or after a clean stop
+        self.error = None
+        # longest a healthy writer takes to commit a submission: its window, then a busy
+        # wait for the batch ahead of it and one for its own
+        self.result_timeout = self.max_wait + 2 * timeout
+
+        # counters for monitoring batch sizes
+        self.batches_committed = 0
+        self.messages_committed = 0
+
+    def submit(self, sender, recipient, message):
+        """
+        Queue a message to be inserted.
+
+        Returns:
+        ----------
+        concurrent.futures.Future
+            resolves to the new message_id once the message is committed
+        """
+        return self._submit([(sender, recipient, message)], False)
+
+    def submit_many(self, messages):
+        """
+        Queue several messages to be inserted in the same transaction.
+
+        Parameters:
+        ----------
+        messages : list
+            (sender, recipient, message) tuples
+
+        Returns:
+        ----------
+        concurrent.futures.Future
+            resolves to the new message_ids, in order, once all of them are committed
+        """
+        return self._submit(list(messages), True)
+
+    def _submit(self, rows, many):
+        future = Future()
+        with self._lock:
+            if self.error is not None:
+                raise RuntimeError(f"Message writer failed: {self.error}")
+            if self._stopped:
+                raise RuntimeError("Message writer is stopped.")
+            self._pending.put((rows, future, many))
+        return future
+
+    def stop(self):
+        """
+        Stop the writer after committing everything already submitted.
+        """
+        self._stopped = True
+        self._pending.put(None)
+        self.join()
+
+    def _collect(self, batch):
+        """
+        Add to a batch holding its first submission until it is full or the window closes.
+        Returns whether the stop sentinel was seen.
+        """
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = (
+                    self._pending.get(timeout=remaining)
+                    if remaining > 0
+                    else self._pending.get_nowait()
+                )
+            except queue.Empty:
+                break
+            if item is None:
+                return True
+            batch.append(item)
+            size += len(item[0])
+        return False
+
+    def _write(self, conn, batch):
+        """
+        Insert a batch in one transaction and resolve its futures.
+        """
+        try:
+            cursor = conn.cursor()
+            message_ids = []
+            for rows, _, _ in batch:
+                ids = []
+                for params in rows:
+                    cursor.execute(
+                        "INSERT INTO messages (sender, recipient, message) VALUES (?, ?, ?)",
+                        params,
+                    )
+                    ids.append(cursor.lastrowid)
+                message_ids.append(ids)
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Error writing batch of {len(batch)} submissions: {e}")
+            conn.rollback()
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        self.batches_committed += 1
+        self.messages_committed += sum(len(ids) for ids in message_ids)
+
+        # only now is every message in the batch durable
+        for (_, future, many), ids in zip(batch, message_ids):
+            future.set_result(ids if many else ids[0])
+
+    def _fail(self, error, taken):
+        """
+        Fail every submission not yet answered once the thread has died, those it had
+        taken off the queue and those still on it.
+        """
+        with self._lock:
+            self.error = error
+            self._stopped = True
+        items = list(taken)
+        while True:
+            try:
+                item = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                items.append(item)
+        for _, future, _ in items:
+            if not future.done():
+                future.set_exception(error)
+
+    def run(self):
+        # submissions taken off the queue and not yet answered
+        taken = []
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+            try:
+                stopping = False
+                while not stopping:
+                    first = self._pending.get()
+                    if first is None:
+                        break
+                    taken = [first]
+                    stopping = self._collect(taken)
+                    self._write(conn, taken)
+                    taken = []
+
+                # anything submitted before stop() was called still gets written
+                while True:
+                    try:
+                        item = self._pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        taken.append(item)
+                while taken:
+                    self._write(conn, taken[: self.max_batch])
+                    taken = taken[self.max_batch :]
+            finally:
+                conn.close()
+        except Exception as e:
+            logging.error(f"Message writer stopped: {e}")
+            self._fail(e, taken)
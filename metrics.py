@@ -0,0 +1,266 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import chat_pb2
+
+# Bucket upper bounds in seconds, four per doubling from 1us to about 2 minutes.
+# A percentile is reported as the upper bound of its bucket, so at most ~19% high.
+BUCKET_BOUNDS = [1e-6 * 2 ** (i / 4) for i in range(4 * 27)]
+
+# Bucket upper bounds in bytes for serialized message sizes, two per doubling up to 64MB.
+SIZE_BOUNDS = sorted({round(2 ** (i / 2)) for i in range(2 * 26 + 1)})
+
+
+def action_name(action) -> str:
+    """
+    Get the name of an action, "UNKNOWN" for a number the enum does not define.
+    proto3 enums are open, so a client can send any number.
+    """
+    if action in chat_pb2.Action.values():
+        return chat_pb2.Action.Name(action)
+    return "UNKNOWN"
+
+
+class LatencyHistogram:
+    """
+    LatencyHistogram class for the call times of one action
+
+    Keeps a count per log-spaced bucket instead of every sample, so memory is fixed and
+    recording is a bisect and an increment under a lock.
+    """
+
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, error=False):
+        """
+        Add one call.
+
+        Parameters:
+        ----------
+        seconds : float
+            time the call took
+        error : bool
+            whether the call failed
+        """
+        index = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            if error:
+                self.errors += 1
+
+    def percentile(self, p) -> float:
+        """
+        Get the p-th percentile (0-100) in seconds, 0 when nothing was recorded.
+        """
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = p / 100 * self.count
+            seen = 0
+            for index, n in enumerate(self.buckets):
+                seen += n
+                if seen >= rank and n:
+                    break
+            # the overflow bucket has no upper bound, the max is the best estimate
+            if index == len(self.bounds):
+                return self.max
+            return min(self.bounds[index], self.max)
+
+    def summary(self) -> dict:
+        """
+        Get count, errors and mean/p50/p95/p99/max in milliseconds.
+        """
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class ActionMetrics:
+    """
+    ActionMetrics class for per-action latency histograms
+
+    One LatencyHistogram per action name, created on first use. Read at runtime with
+    snapshot(), or written to the log periodically with log_every.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name) -> LatencyHistogram:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, LatencyHistogram())
+        return histogram
+
+    @contextmanager
+    def time(self, name):
+        """
+        Time the body of a with block into the histogram for `name`.
+        An exception counts as an error and is re-raised.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.histogram(name).record(time.perf_counter() - start, error=True)
+            raise
+        self.histogram(name).record(time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        """
+        Get the summary of every action seen so far, keyed by action name.
+        """
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {name: h.summary() for name, h in sorted(histograms.items())}
+
+    def log_snapshot(self):
+        """
+        Write one log line per action with its latency summary.
+        """
+        for name, s in self.snapshot().items():
+            logging.info(
+                f"{name}: count={s['count']} errors={s['errors']} p50={s['p50_ms']:.2f}ms "
+                f"p95={s['p95_ms']:.2f}ms p99={s['p99_ms']:.2f}ms max={s['max_ms']:.2f}ms"
+            )
+
+
+class SizeHistogram(LatencyHistogram):
+    """
+    SizeHistogram class for the serialized sizes of one action's messages
+
+    The same fixed buckets as LatencyHistogram, spaced over bytes instead of seconds, and a
+    count of the messages gRPC was asked to compress.
+    """
+
+    def __init__(self):
+        super().__init__(SIZE_BOUNDS)
+        self.compressed = 0
+
+    def record(self, size, compressed=False):
+        super().record(size)
+        if compressed:
+            with self._lock:
+                self.compressed += 1
+
+    def summary(self) -> dict:
+        """
+        Get count, total bytes and mean/p50/p95/p99/max in bytes.
+        """
+        return {
+            "count": self.count,
+            "compressed": self.compressed,
+            "bytes": int(self.total),
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class WireStats:
+    """
+    WireStats class for the bytes each action puts on the wire
+
+    Sizes are the serialized protobuf, ByteSize(), not the Python object, so they are what
+    gRPC frames before compression. One SizeHistogram per direction ("in" for requests
+    received, "out" for responses sent) and action name, created on first use.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, direction, name) -> SizeHistogram:
+        histogram = self._histograms.get((direction, name))
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault((direction, name), SizeHistogram())
+        return histogram
+
+    def record(self, direction, message, size=None, compressed=False) -> int:
+        """
+        Add one ChatRequest or ChatResponse, under the name of its action.
+
+        Parameters:
+        ----------
+        direction : str
+            "in" or "out"
+        message : ChatRequest or ChatResponse
+            the message sent or received
+        size : int
+            its ByteSize() if already known
+        compressed : bool
+            whether it was sent with compression on
+
+        Returns:
+        ----------
+        int
+            the serialized size of the message in bytes
+        """
+        size = message.ByteSize() if size is None else size
+        name = action_name(message.action)
+        self.histogram(direction, name).record(size, compressed)
+        return size
+
+    def snapshot(self) -> dict:
+        """
+        Get the size summary of every action seen so far, keyed by direction then action.
+        """
+        with self._lock:
+            histograms = dict(self._histograms)
+        snapshot = {"in": {}, "out": {}}
+        for (direction, name), h in sorted(histograms.items()):
+            snapshot.setdefault(direction, {})[name] = h.summary()
+        return snapshot
+
+    def log_snapshot(self):
+        """
+        Write one log line per direction and action with its size summary.
+        """
+        for direction, actions in self.snapshot().items():
+            for name, s in actions.items():
+                logging.info(
+                    f"wire {direction} {name}: count={s['count']} "
+                    f"compressed={s['compressed']} bytes={s['bytes']} "
+                    f"mean={s['mean']:.0f}B p50={s['p50']:.0f}B p95={s['p95']:.0f}B "
+                    f"max={s['max']:.0f}B"
+                )
+
+
+def log_every(interval_s, *sources):
+    """
+    Start a daemon thread that calls log_snapshot() on each source every `interval_s` seconds.
+    """
+
+    def run():
+        while True:
+            time.sleep(interval_s)
+            for source in sources:
+                source.log_snapshot()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
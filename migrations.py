@@ -0,0 +1,203 @@
+import sqlite3
+import sys
+
+# Ordered list of (version, description, statements).
+# Every statement must be safe to run again on a database that already has it applied,
+# so a migration interrupted half way can simply be retried.
+MIGRATIONS = [
+    (
+        1,
+        "base users and messages tables",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL,
+                passhash TEXT NOT NULL
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id INTEGER PRIMARY KEY,
+                sender TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                message TEXT NOT NULL,
+                delivered BOOLEAN DEFAULT 0,
+                time DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+        ],
+    ),
+    (
+        2,
+        "unique usernames",
+        [
+            # keep the oldest account if duplicates slipped in before the constraint existed
+            "DELETE FROM users WHERE user_id NOT IN (SELECT MIN(user_id) FROM users GROUP BY username);",
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users(username);",
+        ],
+    ),
+    (
+        3,
+        "indexes for messages hot paths",
+        [
+            # LOAD_CHAT (each side of the OR) and the sender half of DELETE_ACCOUNT,
+            # rows come out in message_id order since the rowid is the last index column
+            "CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(sender, recipient);",
+            # LOGIN undelivered COUNT(*) (covering), VIEW_UNDELIVERED and the recipient
+            # half of DELETE_ACCOUNT
+            "CREATE INDEX IF NOT EXISTS idx_messages_undelivered ON messages(recipient, delivered);",
+        ],
+    ),
+    (
+        4,
+        "undelivered count summary table",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS undelivered_counts (
+                username TEXT PRIMARY KEY,
+                n_undelivered INTEGER NOT NULL DEFAULT 0
+            );
+            """,
+        ],
+    ),
+    (
+        5,
+        "archive table for old delivered messages",
+        [
+            # same columns in the same order as messages, rows are moved with SELECT *
+            """
+            CREATE TABLE IF NOT EXISTS messages_archive (
+                message_id INTEGER PRIMARY KEY,
+                sender TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                message TEXT NOT NULL,
+                delivered BOOLEAN DEFAULT 0,
+                time DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            # archived pages of LOAD_CHAT and the sender half of DELETE_ACCOUNT
+            "CREATE INDEX IF NOT EXISTS idx_archive_conversation ON messages_archive(sender, recipient);",
+            # recipient half of DELETE_ACCOUNT
+            "CREATE INDEX IF NOT EXISTS idx_archive_recipient ON messages_archive(recipient);",
+        ],
+    ),
+    (
+        6,
+        "never reuse message ids",
+        [
+            # A plain INTEGER PRIMARY KEY hands out MAX(rowid) + 1, so once the archiver moved
+            # the newest rows out their ids came back. AUTOINCREMENT needs a rebuild of the table.
+            "DROP TABLE IF EXISTS messages_rebuild;",
+            """
+            CREATE TABLE messages_rebuild (
+                message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                message TEXT NOT NULL,
+                delivered BOOLEAN DEFAULT 0,
+                time DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+            "INSERT INTO messages_rebuild SELECT * FROM messages;",
+            "DROP TABLE messages;",
+            "ALTER TABLE messages_rebuild RENAME TO messages;",
+            "CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(sender, recipient);",
+            "CREATE INDEX IF NOT EXISTS idx_messages_undelivered ON messages(recipient, delivered);",
+            # new ids start above every id already used, archived ones included
+            """
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT 'messages', 0 WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name='messages');
+            """,
+            """
+            UPDATE sqlite_sequence SET seq = MAX(
+                seq,
+                (SELECT IFNULL(MAX(message_id), 0) FROM messages),
+                (SELECT IFNULL(MAX(message_id), 0) FROM messages_archive)
+            ) WHERE name='messages';
+            """,
+        ],
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn) -> int:
+    """
+    Get the schema version of a database, 0 if it has never been migrated.
+
+    Parameters:
+    ----------
+    conn : sqlite3.Connection
+        open connection to the database
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(data_path="data/messenger.db") -> int:
+    """
+    Upgrade a database in place to the latest schema version.
+
+    Each pending migration runs in its own transaction together with its schema_version row,
+    so a database is never left recorded at a version it does not fully have. The version is
+    read again once the write lock is held, so processes migrating at once apply each step once.
+
+    Parameters:
+    ----------
+    data_path : str
+        path to the sqlite database file
+
+    Returns:
+    ----------
+    int
+        schema version of the database after migrating
+    """
+    conn = sqlite3.connect(data_path)
+    # manage transactions explicitly so DDL is included in them
+    conn.isolation_level = None
+    # only takes effect on a brand new file, older ones need archiver.enable_incremental_vacuum
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    try:
+        version = current_version(conn)
+        for target, description, statements in MIGRATIONS:
+            if target <= version:
+                continue
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # another process may have migrated while we waited for the write lock
+                version = current_version(conn)
+                if target <= version:
+                    conn.execute("COMMIT")
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (target, description),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            version = target
+            print(f"Migrated {data_path} to version {version}: {description}")
+        return version
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    migrate(sys.argv[1] if len(sys.argv) > 1 else "data/messenger.db")
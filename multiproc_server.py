@@ -0,0 +1,129 @@
+import logging
+import multiprocessing
+import os
+import time
+from concurrent import futures
+
+import grpc
+
+import chat_pb2_grpc
+import server
+from broker import Broker, BrokerClient
+from metrics import log_every
+from storage import create_store
+
+# Worker processes sharing the port, 0 for one per core. Each has its own GIL, so handlers
+# run on every core instead of one.
+processes = server.config["server_config"].get("processes", 0) or os.cpu_count() or 1
+
+# Unix socket of the broker that routes PINGs and broadcasts between the workers
+broker_socket = server.config["server_config"].get("broker_socket", "data/broker.sock")
+
+
+def worker_db_config(index):
+    """
+    db_config for one worker process.
+
+    Undelivered counts are read from the database, since every worker writes messages and
+    acks to the same file, and only the first worker runs the archiver.
+    """
+    options = dict(server.db_config, cache_counts=False)
+    if index:
+        options["archive_after_s"] = 0
+    return options
+
+
+def run_worker(index):
+    """
+    Serve chats in one worker process until interrupted.
+
+    Parameters:
+    ----------
+    index : int
+        number of this worker, 0 to processes - 1
+    """
+    servicer = server.ChatServiceServicer(
+        store=create_store(worker_db_config(index)),
+        # versions are per process and a client may reconnect to another worker,
+        # so clients always get the full user list
+        max_changes=0,
+    )
+    servicer.router = BrokerClient(
+        broker_socket, servicer.deliver_local, servicer.broadcast_local
+    )
+
+    grpc_server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=server.max_workers),
+        maximum_concurrent_rpcs=server.maximum_concurrent_rpcs,
+        # every worker binds the same port, the kernel spreads new connections over them
+        options=[("grpc.so_reuseport", 1)],
+    )
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, grpc_server)
+    grpc_server.add_insecure_port(f"{server.host}:{server.port}")
+    grpc_server.start()
+    logging.info(f"Worker {index} (pid {os.getpid()}) started on port {server.port}")
+
+    if server.metrics_log_interval:
+        log_every(
+            server.metrics_log_interval,
+            servicer.metrics,
+            servicer.wire,
+            servicer.outbound_stats,
+            servicer.fanout,
+            servicer.auth,
+            servicer,
+        )
+    servicer.start_reaper(server.stream_reap_interval)
+    try:
+        while True:
+            time.sleep(86400)
+    except KeyboardInterrupt:
+        grpc_server.stop(0)
+        servicer.router.close()
+        servicer.fanout.stop()
+        servicer.auth.close()
+        servicer.store.close()
+
+
+def serve():
+    """
+    Start the broker and the worker processes, and wait for them.
+
+    Users, messages and delivery state are shared through the database, so the memory engine
+    cannot be used. Streams, the user directory and the latency metrics are per worker.
+    """
+    if server.db_config.get("engine", "sqlite") == "memory":
+        logging.error("The memory engine cannot be shared by worker processes.")
+        exit(1)
+
+    # migrate the database once, before the workers open it
+    create_store(worker_db_config(1)).close()
+
+    broker = Broker(broker_socket)
+    broker.start()
+
+    # spawned, not forked, so no worker inherits gRPC state
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_worker, args=(i,), name=f"chat-worker-{i}")
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    logging.info(f"Started {processes} worker processes, broker on {broker_socket}")
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # the workers got the interrupt too and are shutting down
+        for worker in workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+    finally:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    serve()
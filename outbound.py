@@ -0,0 +1,213 @@
+import logging
+import threading
+import weakref
+from collections import deque
+
+import chat_pb2
+
+POLICIES = ("block", "drop_oldest", "coalesce", "disconnect")
+
+# returned by get_nowait when there is nothing to send yet
+EMPTY = object()
+
+
+class OutboundStats:
+    """
+    OutboundStats class for the outbound queues of every stream
+
+    Counts what the slow-consumer policies did and tracks the live queues so the current
+    depths can be read at any time.
+    """
+
+    def __init__(self):
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+        self._queues = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def track(self, outbound):
+        with self._lock:
+            self._queues.add(outbound)
+
+    def count(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def snapshot(self) -> dict:
+        """
+        Get the number of queues, their total and largest depth, and the policy counters.
+        """
+        with self._lock:
+            depths = [len(q) for q in self._queues if not q.closed]
+            return {
+                "queues": len(depths),
+                "depth": sum(depths),
+                "max_depth": max(depths, default=0),
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "disconnected": self.disconnected,
+            }
+
+    def log_snapshot(self):
+        s = self.snapshot()
+        logging.info(
+            f"outbound: queues={s['queues']} depth={s['depth']} max_depth={s['max_depth']} "
+            f"dropped={s['dropped']} coalesced={s['coalesced']} disconnected={s['disconnected']}"
+        )
+
+
+class OutboundQueue:
+    """
+    OutboundQueue class, the bounded queue of responses waiting to be sent to one client
+
+    Holds at most `maxsize` responses. When a client stops reading and its queue is full,
+    `policy` decides what happens to the next response:
+
+    - "block": the sender waits up to `block_timeout` seconds for room, then drops it
+    - "drop_oldest": the oldest queued response is dropped to make room
+    - "coalesce": queued PINGs are merged into one summary PING (message_id 0, the number
+      of PINGs in n_undelivered); the messages stay undelivered, so the client can still
+      fetch them. Falls back to drop_oldest if there are no PINGs to merge
+    - "disconnect": the queue is closed and the stream ends with RESOURCE_EXHAUSTED
+    """
+
+    def __init__(self, maxsize=1000, policy="coalesce", block_timeout=1.0, stats=None):
+        """
+        Parameters:
+        ----------
+        maxsize : int
+            most responses held for the client
+        policy : str
+            one of POLICIES, applied when the queue is full
+        block_timeout : float
+            seconds a sender waits for room under the "block" policy
+        stats : OutboundStats
+            shared counters, optional
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbound queue policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.stats = stats if stats is not None else OutboundStats()
+        self.stats.track(self)
+
+        self.closed = False
+        # no more responses will be put, the stream ends once the queue is drained
+        self.finishing = False
+        # closed because the client fell too far behind
+        self.overflowed = False
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def _coalesce(self) -> bool:
+        """
+        Replace every queued PING with a single summary PING. Called with the lock held.
+        """
+        pings = [r for r in self._items if r.action == chat_pb2.PING]
+        if len(pings) < 2:
+            return False
+        # a summary already in the queue carries the PINGs it replaced, a batched PING
+        # one per message
+        n = sum(r.n_undelivered if r.message_id == 0 else len(r.messages) or 1 for r in pings)
+        self._items = deque(r for r in self._items if r.action != chat_pb2.PING)
+        # the newest seq, so a RESUME does not replay the PINGs it stands for
+        seq = max(r.seq for r in pings)
+        self._items.append(
+            chat_pb2.ChatResponse(action=chat_pb2.PING, n_undelivered=n, seq=seq)
+        )
+        self.stats.count("coalesced", sum(1 for r in pings if r.message_id != 0))
+        return True
+
+    def _make_room(self) -> bool:
+        """
+        Apply the policy to a full queue. Called with the lock held.
+        Returns False if the new response cannot be queued.
+        """
+        if self.policy == "coalesce" and self._coalesce() and len(self._items) < self.maxsize:
+            return True
+        if self.policy in ("drop_oldest", "coalesce"):
+            while len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.stats.count("dropped")
+            return True
+        if self.policy == "disconnect":
+            logging.warning("Disconnecting a client that stopped reading its responses.")
+            self.overflowed = True
+            self.closed = True
+            self._items.clear()
+            self.stats.count("disconnected")
+            return False
+        # "block", and the wait for room already timed out
+        self.stats.count("dropped")
+        return False
+
+    def put(self, response, block=True):
+        """
+        Queue a response for the client, applying the policy if the queue is full.
+        Responses put after close() are ignored.
+        """
+        with self._cond:
+            if self.closed or self.finishing:
+                return
+            if len(self._items) >= self.maxsize and self.policy == "block" and block:
+                self._cond.wait_for(
+                    lambda: len(self._items) < self.maxsize or self.closed,
+                    self.block_timeout,
+                )
+                if self.closed:
+                    return
+            if len(self._items) >= self.maxsize and not self._make_room():
+                self._cond.notify_all()
+                return
+            self._items.append(response)
+            self._cond.notify_all()
+
+    def get_nowait(self):
+        """
+        Get the next response, None once the queue is closed or finished and drained, or
+        EMPTY if nothing is queued.
+        """
+        with self._cond:
+            if self.closed:
+                return None
+            if not self._items:
+                return None if self.finishing else EMPTY
+            response = self._items.popleft()
+            # room for a blocked sender
+            self._cond.notify_all()
+            return response
+
+    def get(self):
+        """
+        Wait for the next response, None once the queue is closed or finished and drained.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self.closed or self.finishing)
+            if self.closed or not self._items:
+                return None
+            response = self._items.popleft()
+            self._cond.notify_all()
+            return response
+
+    def finish(self):
+        """
+        End the stream after the responses already queued, when the client stopped sending.
+        """
+        with self._cond:
+            self.finishing = True
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Stop the queue, waking the stream waiting on it. Queued responses are discarded,
+        for a cancelled, reaped or overflowed stream.
+        """
+        with self._cond:
+            self.closed = True
+            self._items.clear()
+            self._cond.notify_all()
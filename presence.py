@@ -0,0 +1,103 @@
+import threading
+import zlib
+
+
+class _Stripe:
+    """
+    One lock and the sessions it guards.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # username -> Session
+        self.sessions = {}
+
+
+class PresenceRegistry:
+    """
+    PresenceRegistry class for the users currently connected and their streams
+
+    Usernames are split over `stripes` lock stripes, so connects, disconnects and lookups for
+    different users rarely wait on each other. Broadcasts read a copy-on-write snapshot: a
+    tuple of every session that is rebuilt at most once after a change and otherwise
+    returned as is, so iterating it is safe while users come and go.
+    """
+
+    def __init__(self, stripes=16):
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self._snapshot = ()
+        # bumped on every change, the snapshot is stale when it was built for an older one
+        self._version = 0
+        self._snapshot_version = 0
+        self._version_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+
+    def _stripe(self, username):
+        # stable across runs, unlike hash() on strings
+        return self._stripes[zlib.crc32(username.encode()) % len(self._stripes)]
+
+    def _changed(self):
+        # called after the stripe is changed, so a snapshot built for this version has it
+        with self._version_lock:
+            self._version += 1
+
+    def add(self, username, session):
+        """
+        Register the stream a user is connected on.
+
+        Returns:
+        ----------
+        Session or None
+            the user's previous session, replaced by this one
+        """
+        stripe = self._stripe(username)
+        with stripe.lock:
+            previous = stripe.sessions.get(username)
+            stripe.sessions[username] = session
+        self._changed()
+        return previous
+
+    def remove(self, username, session=None) -> bool:
+        """
+        Unregister a user. With `session`, only if that is still the user's current stream,
+        so a stream ending does not unregister a newer login of the same user.
+        """
+        stripe = self._stripe(username)
+        with stripe.lock:
+            current = stripe.sessions.get(username)
+            if current is None or (session is not None and current is not session):
+                return False
+            del stripe.sessions[username]
+        self._changed()
+        return True
+
+    def get(self, username):
+        """
+        Get the session a user is connected on, or None if they are offline.
+        """
+        stripe = self._stripe(username)
+        with stripe.lock:
+            return stripe.sessions.get(username)
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def __len__(self):
+        return len(self.snapshot())
+
+    def snapshot(self):
+        """
+        Get every connected session as a tuple, for broadcasts.
+        """
+        if self._snapshot_version == self._version:
+            return self._snapshot
+        with self._snapshot_lock:
+            version = self._version
+            if self._snapshot_version != version:
+                sessions = []
+                for stripe in self._stripes:
+                    with stripe.lock:
+                        sessions.extend(stripe.sessions.values())
+                self._snapshot = tuple(sessions)
+                self._snapshot_version = version
+            return self._snapshot
@@ -1,11 +1,7 @@
-import hashlib
 import os
-import sqlite3
-import sys
 import grpc
 from concurrent import futures
 import time
-import queue
 import threading
 import json
 import logging
@@ -14,9 +10,16 @@ import chat_pb2
 import chat_pb2_grpc
 import json
 import traceback
+from auth import AuthBusy, AuthPool
+from metrics import ActionMetrics, WireStats, action_name, log_every
+from outbound import OutboundQueue, OutboundStats
+from presence import PresenceRegistry
+from session_tokens import SessionTokens
+from fanout import FanoutEngine
+from storage import create_store
+from user_directory import UserDirectory
 
 log_path = "logs/server.log"
-db_path = "data/messenger.db"
 
 # setup logging
 if not os.path.exists(log_path):
@@ -44,8 +47,119 @@ except KeyError as e:
     logging.error(f"KeyError for config: {e}")
     exit(1)
 
-# map of clients to queues for sending responses
-clients = {}
+# storage settings, defaults used for older configs without a db_config section
+db_config = config.get("db_config", {})
+
+# LOAD_CHAT paging, page_size=0 in a request means the default
+page_size_default = config["server_config"].get("page_size", 50)
+page_size_max = config["server_config"].get("max_page_size", 500)
+
+# Concurrency limits. Each Chat stream holds a worker thread for as long as it is open
+# (aio_server.py does not), so by default there is a worker for every allowed stream plus
+# some for short calls, and RPCs beyond that are refused instead of queued behind streams.
+max_streams_default = config["server_config"].get("max_streams", 1000)
+max_workers = config["server_config"].get("max_workers") or (
+    max_streams_default + 4 * (os.cpu_count() or 1)
+)
+maximum_concurrent_rpcs = (
+    config["server_config"].get("maximum_concurrent_rpcs") or max_workers
+)
+
+# per-client outbound queues, and what to do when a client stops reading, see OutboundQueue
+outbound_queue_size = config["server_config"].get("outbound_queue_size", 1000)
+outbound_policy = config["server_config"].get("outbound_policy", "coalesce")
+outbound_block_timeout = config["server_config"].get("outbound_block_timeout_s", 1.0)
+
+# Stream teardown. Streams with no request or response for stream_idle_timeout_s are closed
+# (0 never closes them, the GUI client sends nothing while the user is idle). A closed stream
+# still open after stream_leak_grace_s is counted as leaked.
+stream_idle_timeout = config["server_config"].get("stream_idle_timeout_s", 0)
+stream_leak_grace = config["server_config"].get("stream_leak_grace_s", 5)
+stream_reap_interval = config["server_config"].get("stream_reap_interval_s", 30)
+
+# how often per-action latency percentiles are written to the log, 0 to never
+metrics_log_interval = config["server_config"].get("metrics_log_interval_s", 60)
+
+# lock stripes in the registry of connected users
+presence_stripes = config["server_config"].get("presence_stripes", 16)
+
+# PING_USER fan-out: delivery threads, sessions per delivery task, broadcasts per pass
+fanout_workers = config["server_config"].get("fanout_workers", 4)
+fanout_chunk_size = config["server_config"].get("fanout_chunk_size", 256)
+fanout_max_batch = config["server_config"].get("fanout_max_batch", 64)
+
+# most messages in one SEND_MESSAGES request, larger batches are refused
+send_batch_max = config["server_config"].get("send_batch_max", 1000)
+
+# Password hashing: processes running it, PBKDF2 rounds per hash, most hashes waiting at once
+# before LOGIN/REGISTER/DELETE_ACCOUNT are refused
+auth_workers = config["server_config"].get("auth_workers", 2)
+auth_iterations = config["server_config"].get("auth_iterations", 200_000)
+auth_max_pending = config["server_config"].get("auth_max_pending", 64)
+
+# Response compression: algorithm for responses of at least compression_min_bytes serialized
+# ("none", "gzip" or "deflate"). Smaller ones, PINGs and acks, are sent uncompressed, since
+# they do not shrink and would only cost CPU.
+response_compression = config["server_config"].get("response_compression", "none")
+compression_min_bytes_default = config["server_config"].get("compression_min_bytes", 1024)
+
+COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
+# RESUME after a dropped stream: how long a token outlives the stream, PINGs kept per user
+session_token_ttl = config["server_config"].get("session_token_ttl_s", 86400)
+replay_buffer_size = config["server_config"].get("replay_buffer_size", 100)
+
+
+class Session:
+    """
+    Session class for the state of one Chat stream
+
+    Handed to every action handler along with the request. Holds the user logged in on the
+    stream (None before LOGIN/REGISTER), the bounded queue its responses are sent from, and
+    when it connected and how many response bytes it has been sent.
+    """
+
+    def __init__(self, queue, context=None):
+        self.username = None
+        self.queue = queue
+        self.context = context
+        self.connected_at = time.time()
+        self.bytes_sent = 0
+        # for idle reaping, updated on every request and every response sent
+        self.last_active = time.monotonic()
+        # when the stream was first seen closed but not yet ended, for leak detection
+        self.closed_at = None
+
+    def put(self, response):
+        """
+        Send a response to this stream's client.
+        """
+        self.queue.put(response)
+
+    def reply(self, req, response):
+        """
+        Send the response to a request, tagged with the request's request_id.
+        """
+        response.request_id = req.request_id
+        self.put(response)
+
+
+class Reply:
+    """
+    Reply class, stands in for the queue of a Session in a unary call
+
+    Keeps the one response the handler puts, to be returned from the call.
+    """
+
+    def __init__(self):
+        self.response = None
+
+    def put(self, response):
+        self.response = response
 
 
 class ChatServiceServicer(chat_pb2_grpc.ChatServiceServicer):
@@ -55,6 +169,771 @@ class ChatServiceServicer(chat_pb2_grpc.ChatServiceServicer):
     This class handles the main chat functionality of the server, sending responses via queues.
     """
 
+    def __init__(
+        self,
+        store=None,
+        max_streams=None,
+        max_changes=None,
+        auth=None,
+        compression=None,
+        compression_min_bytes=None,
+    ):
+        """
+        Parameters:
+        ----------
+        store : MessageStore
+            storage engine to use, by default the one named in config.json
+        max_streams : int
+            most Chat streams open at once, 0 for no limit, by default from config.json
+        max_changes : int
+            user list changes kept for delta sync, by default from config.json
+        auth : AuthPool
+            password hashing pool, by default sized from config.json
+        compression : str
+            "none", "gzip" or "deflate" for large responses, by default from config.json
+        compression_min_bytes : int
+            smallest serialized response that is compressed, by default from config.json
+        """
+        self.store = store if store is not None else create_store(db_config)
+        self.auth = auth if auth is not None else AuthPool(
+            workers=auth_workers,
+            iterations=auth_iterations,
+            max_pending=auth_max_pending,
+        )
+
+        # open Chat streams, further ones are refused with RESOURCE_EXHAUSTED
+        self.max_streams = max_streams if max_streams is not None else max_streams_default
+        self.sessions = set()
+        self.streams_opened = 0
+        self.streams_reaped = 0
+        self._streams_lock = threading.Lock()
+
+        # every registered username, with a version for delta sync
+        if max_changes is None:
+            max_changes = config["server_config"].get("user_changes_kept", 1000)
+        self.directory = UserDirectory(max_changes=max_changes)
+        self.directory.load(self.store.list_users())
+
+        # action -> handler(session, req), each call timed per action
+        self.handlers = {
+            chat_pb2.CHECK_USERNAME: self.handle_check_username,
+            chat_pb2.LOGIN: self.handle_login,
+            chat_pb2.REGISTER: self.handle_register,
+            chat_pb2.LOAD_CHAT: self.handle_load_chat,
+            chat_pb2.SEND_MESSAGE: self.handle_send_message,
+            chat_pb2.SEND_MESSAGES: self.handle_send_messages,
+            chat_pb2.PING: self.handle_ping,
+            chat_pb2.ACK: self.handle_ack,
+            chat_pb2.VIEW_UNDELIVERED: self.handle_view_undelivered,
+            chat_pb2.DELETE_MESSAGE: self.handle_delete_message,
+            chat_pb2.DELETE_ACCOUNT: self.handle_delete_account,
+            chat_pb2.PING_USER: self.handle_ping_user,
+            chat_pb2.RESUME: self.handle_resume,
+        }
+        self.metrics = ActionMetrics()
+        # serialized request and response sizes per action
+        self.wire = WireStats()
+        # responses of at least compression_min_bytes are compressed, see compress_next
+        self.compression = COMPRESSION[compression or response_compression]
+        if compression_min_bytes is None:
+            compression_min_bytes = compression_min_bytes_default
+        self.compression_min_bytes = compression_min_bytes
+        # users connected right now, username -> Session
+        self.presence = PresenceRegistry(stripes=presence_stripes)
+        # PING_USER broadcasts, delivered off the requester's thread
+        self.fanout = FanoutEngine(
+            self.presence,
+            workers=fanout_workers,
+            chunk_size=fanout_chunk_size,
+            max_batch=fanout_max_batch,
+        )
+        self.fanout.start()
+        self.outbound_stats = OutboundStats()
+        # tokens to RESUME a dropped stream with, and the PINGs sent to each user since
+        self.tokens = SessionTokens(
+            ttl_s=session_token_ttl,
+            replay_size=replay_buffer_size,
+            stripes=presence_stripes,
+        )
+        # BrokerClient to the other worker processes, see multiproc_server.py
+        self.router = None
+
+    def user_list(self, username, users_version):
+        """
+        Build the user list fields of a LOGIN or REGISTER response.
+
+        Sends only the changes since users_version when the directory still remembers them,
+        otherwise every user except the one logging in.
+
+        Parameters:
+        ----------
+        username : str
+            user the response is for
+        users_version : int
+            version of the list the client already has, 0 for none
+        """
+        delta = self.directory.delta(users_version) if users_version else None
+        if delta is not None:
+            added, removed, version = delta
+            return dict(
+                users=added,
+                removed_users=removed,
+                users_version=version,
+                users_delta=True,
+            )
+
+        users, version = self.directory.snapshot()
+        return dict(
+            users=[u for u in users if u != username], users_version=version
+        )
+
+    def connect(self, session, username):
+        """
+        Log a user in on a stream, so messages and broadcasts for them reach it.
+        """
+        session.username = username
+        self.presence.add(username, session)
+        if self.router is not None:
+            self.router.online(username)
+
+    def disconnect(self, username, session=None) -> bool:
+        """
+        Log a user out, only from `session` if given. Returns False if they were not on it.
+        """
+        if not self.presence.remove(username, session):
+            return False
+        # their stream ended, they may RESUME it
+        self.tokens.detach(username)
+        if self.router is not None:
+            self.router.offline(username)
+        return True
+
+    def deliver(self, username, response):
+        """
+        Send a response to a user if they are online, here or in another worker process.
+        The response is also kept for replay if the user RESUMEs a dropped stream.
+        """
+        with self.tokens.lock(username):
+            self.tokens.record(username, response)
+            session = self.presence.get(username)
+        if session is not None:
+            session.put(response)
+        elif self.router is not None:
+            self.router.route(username, response)
+
+    def deliver_local(self, username, response):
+        """
+        Send a response routed from another worker process, if the user is still here.
+        """
+        with self.tokens.lock(username):
+            self.tokens.record(username, response)
+            session = self.presence.get(username)
+        if session is not None:
+            session.put(response)
+
+    def broadcast(self, response):
+        """
+        Send a response to every connected user, in every worker process.
+        """
+        self.fanout.broadcast(response)
+        if self.router is not None:
+            self.router.broadcast(response)
+
+    def broadcast_local(self, response):
+        """
+        Deliver a broadcast from another worker process to the users connected here.
+
+        A PING_USER is also applied to this process's user directory, with its version
+        replaced by the local one.
+        """
+        if response.action == chat_pb2.PING_USER:
+            if response.ping_user in self.directory:
+                version = self.directory.remove(response.ping_user)
+            else:
+                version = self.directory.add(response.ping_user)
+            response = chat_pb2.ChatResponse(
+                action=chat_pb2.PING_USER,
+                ping_user=response.ping_user,
+                users_version=version,
+            )
+        self.fanout.broadcast(response)
+
+    def new_queue(self):
+        """
+        Create the bounded outbound queue for a new stream.
+        """
+        return OutboundQueue(
+            maxsize=outbound_queue_size,
+            policy=outbound_policy,
+            block_timeout=outbound_block_timeout,
+            stats=self.outbound_stats,
+        )
+
+    @property
+    def open_streams(self) -> int:
+        return len(self.sessions)
+
+    def admit_stream(self, session) -> bool:
+        """
+        Count a new Chat stream in, False if max_streams are already open.
+        """
+        with self._streams_lock:
+            if self.max_streams and len(self.sessions) >= self.max_streams:
+                logging.warning(f"Refused a chat, {len(self.sessions)} of {self.max_streams} open.")
+                return False
+            self.sessions.add(session)
+            self.streams_opened += 1
+            return True
+
+    def end_stream(self, session):
+        """
+        Count a Chat stream out, once its response stream has finished.
+        """
+        with self._streams_lock:
+            self.sessions.discard(session)
+
+    def reap_streams(self):
+        """
+        Close streams idle for longer than stream_idle_timeout_s, and count leaked ones.
+
+        A stream is leaked if it was closed (client gone, reaped or overflowed) but its
+        response stream has still not finished `stream_leak_grace_s` later.
+
+        Returns:
+        ----------
+        tuple
+            (number reaped, number leaked)
+        """
+        now = time.monotonic()
+        reaped = leaked = 0
+        with self._streams_lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            if session.queue.closed:
+                if session.closed_at is None:
+                    session.closed_at = now
+                elif now - session.closed_at > stream_leak_grace:
+                    leaked += 1
+            elif stream_idle_timeout and now - session.last_active > stream_idle_timeout:
+                logging.info(f"Closing idle stream of {session.username}.")
+                # ends the response stream, which ends the RPC and its reader
+                session.queue.close()
+                reaped += 1
+        with self._streams_lock:
+            self.streams_reaped += reaped
+        # tokens of users gone for longer than session_token_ttl_s
+        self.tokens.prune()
+        if leaked:
+            logging.warning(f"{leaked} closed streams have not finished.")
+        return reaped, leaked
+
+    def start_reaper(self, interval_s):
+        """
+        Start a daemon thread that calls reap_streams every `interval_s` seconds.
+        """
+
+        def run():
+            while True:
+                time.sleep(interval_s)
+                self.reap_streams()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def stream_snapshot(self) -> dict:
+        """
+        Get the number of live and leaked streams, lifetime counters and live threads.
+        """
+        now = time.monotonic()
+        with self._streams_lock:
+            sessions = list(self.sessions)
+            opened, reaped = self.streams_opened, self.streams_reaped
+        leaked = sum(
+            1
+            for s in sessions
+            if s.closed_at is not None and now - s.closed_at > stream_leak_grace
+        )
+        return {
+            "live": len(sessions) - leaked,
+            "leaked": leaked,
+            "opened": opened,
+            "closed": opened - len(sessions),
+            "reaped": reaped,
+            "threads": threading.active_count(),
+        }
+
+    def log_snapshot(self):
+        s = self.stream_snapshot()
+        logging.info(
+            f"streams: live={s['live']} leaked={s['leaked']} opened={s['opened']} "
+            f"closed={s['closed']} reaped={s['reaped']} threads={s['threads']}"
+        )
+
+    def compresses(self, size) -> bool:
+        """
+        Whether a response of `size` serialized bytes is sent compressed.
+        """
+        return (
+            self.compression != grpc.Compression.NoCompression
+            and size >= self.compression_min_bytes
+        )
+
+    def start_compression(self, context):
+        """
+        Turn compression on for a Chat stream, responses too small for it opt out one by one.
+        """
+        if self.compression != grpc.Compression.NoCompression:
+            context.set_compression(self.compression)
+
+    def compress_next(self, context, response) -> tuple:
+        """
+        Decide on compression for the next response of a Chat stream, by its size.
+
+        Returns:
+        ----------
+        tuple
+            (serialized size, whether it is compressed)
+        """
+        size = response.ByteSize()
+        compressed = self.compresses(size)
+        if self.compression != grpc.Compression.NoCompression and not compressed:
+            context.disable_next_message_compression()
+        return size, compressed
+
+    def full_message(self) -> str:
+        """
+        Details sent with RESOURCE_EXHAUSTED when a stream is refused.
+        """
+        return f"Server is full ({self.max_streams} chats open), try again later."
+
+    def handle_check_username(self, session, req):
+        # check if username is already in use
+        # if username is already in use, send response with success=False
+        # otherwise, send response with success=True
+        session.reply(
+            req,
+            chat_pb2.ChatResponse(
+                action=chat_pb2.CHECK_USERNAME, result=req.username not in self.directory
+            ),
+        )
+
+    def check_password(self, username, password) -> bool:
+        """
+        Check a user's password in the auth pool, upgrading a legacy or outdated hash.
+        False for an unknown user. Raises AuthBusy if the pool is full.
+        """
+        stored = self.store.get_passhash(username)
+        if stored is None or not self.auth.verify(password, stored):
+            return False
+        if self.auth.needs_rehash(stored):
+            self.store.set_passhash(username, self.auth.hash(password))
+            logging.info(f"Upgraded the password hash of {username}.")
+        return True
+
+    def login(self, req):
+        """
+        Check a LOGIN request and build its response, with a new session token.
+        Does not attach the user to a stream.
+        """
+        try:
+            valid = self.check_password(req.username, req.passhash)
+        except AuthBusy as e:
+            logging.warning(f"Refused LOGIN of {req.username}: {e}")
+            valid = False
+
+        # if username and password match, send response with success=True
+        # otherwise, send response with success=False
+        if not valid:
+            return chat_pb2.ChatResponse(action=chat_pb2.LOGIN, result=False)
+
+        n_undelivered = self.store.count_undelivered(req.username)
+
+        return chat_pb2.ChatResponse(
+            action=chat_pb2.LOGIN,
+            result=True,
+            n_undelivered=n_undelivered,
+            session_token=self.tokens.issue(req.username),
+            **self.user_list(req.username, req.users_version),
+        )
+
+    def handle_login(self, session, req):
+        response = self.login(req)
+        session.reply(req, response)
+
+        if response.result:
+            # add user to connected users
+            self.connect(session, req.username)
+
+    def handle_unary_login(self, session, req):
+        # no stream to attach, the client RESUMEs its Chat stream with the token
+        session.reply(req, self.login(req))
+
+    def handle_register(self, session, req):
+        # check to make sure username is not already in use
+        if req.username in self.directory:
+            session.reply(req, chat_pb2.ChatResponse(action=chat_pb2.REGISTER, result=False))
+            return
+
+        # add new user to database
+        try:
+            passhash = self.auth.hash(req.passhash)
+        except AuthBusy as e:
+            logging.warning(f"Refused REGISTER of {req.username}: {e}")
+            session.reply(req, chat_pb2.ChatResponse(action=chat_pb2.REGISTER, result=False))
+            return
+        if not self.store.create_user(req.username, passhash):
+            # lost a race with another REGISTER for the same name
+            session.reply(req, chat_pb2.ChatResponse(action=chat_pb2.REGISTER, result=False))
+            return
+        users_version = self.directory.add(req.username)
+        response = chat_pb2.ChatResponse(
+            action=chat_pb2.REGISTER,
+            result=True,
+            session_token=self.tokens.issue(req.username),
+            **self.user_list(req.username, req.users_version),
+        )
+
+        session.reply(req, response)
+
+        # add user to connected users
+        self.connect(session, req.username)
+
+        # send ping_user to all connected users
+        self.broadcast(
+            chat_pb2.ChatResponse(
+                action=chat_pb2.PING_USER,
+                ping_user=session.username,
+                users_version=users_version,
+            )
+        )
+
+    def handle_load_chat(self, session, req):
+        session.username = req.username
+        user2 = req.user2
+
+        # newest page first, older pages via the cursor from the previous one, a page_size
+        # of 0 or below (int32 on the wire) means the default
+        page_size = req.page_size if req.page_size > 0 else page_size_default
+        page_size = min(page_size, page_size_max)
+        try:
+            # fetch one extra row to know whether an older page exists
+            result = self.store.load_chat(
+                req.username, user2, req.before_message_id, page_size + 1
+            )
+        except Exception as e:
+            logging.error(f"Error in Load Chat: {e}")
+            # the client is waiting on a response, send an empty chat and count the error
+            session.reply(req, chat_pb2.ChatResponse(action=chat_pb2.LOAD_CHAT))
+            raise
+
+        next_cursor = 0
+        if len(result) > page_size:
+            result = result[:page_size]
+            next_cursor = result[-1][3]
+
+        formatted_messages = []
+
+        # rows come newest first, send them oldest first
+        for sender, recipient, message, message_id in reversed(result):
+            formatted_messages.append(
+                chat_pb2.ChatMessage(
+                    sender=sender,
+                    recipient=recipient,
+                    message=message,
+                    message_id=message_id,
+                )
+            )
+
+        session.reply(
+            req,
+            chat_pb2.ChatResponse(
+                action=chat_pb2.LOAD_CHAT,
+                messages=formatted_messages,
+                next_cursor=next_cursor,
+            ),
+        )
+
+    def handle_send_message(self, session, req):
+        sender = req.sender
+        recipient = req.recipient
+        message = req.message
+
+        # returns once the message is durable
+        message_id = self.store.send_message(sender, recipient, message)
+
+        # send message to recipient
+        session.reply(
+            req,
+            chat_pb2.ChatResponse(action=chat_pb2.SEND_MESSAGE, message_id=message_id),
+        )
+
+        # ping recipient if online
+        self.deliver(
+            recipient,
+            chat_pb2.ChatResponse(
+                action=chat_pb2.PING,
+                sender=sender,
+                sent_message=message,
+                message_id=message_id,
+            ),
+        )
+
+    def handle_send_messages(self, session, req):
+        # a burst of messages, stored together and answered with their ids in order
+        if len(req.messages) > send_batch_max:
+            logging.warning(f"Refused a batch of {len(req.messages)} messages.")
+            session.reply(req, chat_pb2.ChatResponse(action=chat_pb2.SEND_MESSAGES))
+            return
+
+        batch = [(m.sender or req.sender, m.recipient, m.message) for m in req.messages]
+        message_ids = self.store.send_messages(batch) if batch else []
+
+        session.reply(
+            req,
+            chat_pb2.ChatResponse(
+                action=chat_pb2.SEND_MESSAGES, result=True, message_ids=message_ids
+            ),
+        )
+
+        # one PING per recipient holding all of their messages, message_id is the newest
+        by_recipient = {}
+        for (sender, recipient, message), message_id in zip(batch, message_ids):
+            by_recipient.setdefault(recipient, []).append(
+                chat_pb2.ChatMessage(
+                    sender=sender,
+                    recipient=recipient,
+                    message=message,
+                    message_id=message_id,
+                )
+            )
+        for recipient, messages in by_recipient.items():
+            self.deliver(
+                recipient,
+                chat_pb2.ChatResponse(
+                    action=chat_pb2.PING,
+                    messages=messages,
+                    message_id=max(m.message_id for m in messages),
+                ),
+            )
+
+    def handle_ping(self, session, req):
+        session.reply(
+            req,
+            chat_pb2.ChatResponse(
+                action=req.action,
+                sender=req.sender,
+                sent_message=req.sent_message,
+                message_id=req.message_id,
+            ),
+        )
+
+        self.store.mark_delivered((req.message_id,))
+
+    def handle_ack(self, session, req):
+        # client received these messages
+        self.store.mark_delivered(req.message_ids)
+
+    def handle_view_undelivered(self, session, req):
+        session.username = req.username
+
+        # only the messages returned are marked as delivered
+        result = self.store.view_undelivered(req.username, req.n_messages)
+
+        # format messages to ChatMessage
+        messages_formatted = []
+
+        for sender, recipient, message, message_id in result:
+            messages_formatted.append(
+                chat_pb2.ChatMessage(
+                    sender=sender,
+                    recipient=recipient,
+                    message=message,
+                    message_id=message_id,
+                )
+            )
+
+        session.reply(
+            req,
+            chat_pb2.ChatResponse(
+                action=chat_pb2.VIEW_UNDELIVERED,
+                messages=messages_formatted,
+            ),
+        )
+
+    def handle_delete_message(self, session, req):
+        message_id = req.message_id
+        self.store.delete_message(message_id)
+
+        session.reply(
+            req,
+            chat_pb2.ChatResponse(action=chat_pb2.DELETE_MESSAGE, message_id=message_id),
+        )
+
+        # if recipient is online, ping recipient to update chat
+        self.deliver(
+            req.recipient,
+            chat_pb2.ChatResponse(
+                action=chat_pb2.PING,
+                sender=req.sender,
+                sent_message=req.message,
+                message_id=message_id,
+            ),
+        )
+
+    def handle_delete_account(self, session, req):
+        session.username = username = req.username
+
+        try:
+            valid = self.check_password(username, req.passhash)
+        except AuthBusy as e:
+            logging.warning(f"Refused DELETE_ACCOUNT of {username}: {e}")
+            valid = False
+
+        # username doesn't exist, or exists but passhash is wrong
+        if not valid:
+            session.reply(req, chat_pb2.ChatResponse(action=chat_pb2.DELETE_ACCOUNT, result=False))
+            return
+
+        self.store.delete_account(username)
+        users_version = self.directory.remove(username)
+
+        session.reply(req, chat_pb2.ChatResponse(action=chat_pb2.DELETE_ACCOUNT, result=True))
+        # tell server to ping users to update their chat, remove from connected users
+
+        # delete user from connected users
+        self.disconnect(username)
+        self.tokens.revoke(username)
+
+        self.broadcast(
+            chat_pb2.ChatResponse(
+                action=chat_pb2.PING_USER,
+                ping_user=username,
+                users_version=users_version,
+            )
+        )
+
+    def handle_resume(self, session, req):
+        # reconnect with the token from LOGIN/REGISTER instead of the password
+        username = self.tokens.resolve(req.session_token)
+        if username is None or username not in self.directory:
+            session.reply(req, chat_pb2.ChatResponse(action=chat_pb2.RESUME, result=False))
+            return
+
+        n_undelivered = self.store.count_undelivered(username)
+        response = chat_pb2.ChatResponse(
+            action=chat_pb2.RESUME,
+            result=True,
+            n_undelivered=n_undelivered,
+            session_token=req.session_token,
+            **self.user_list(username, req.users_version),
+        )
+
+        # PINGs sent from here on are either in the replay or delivered live, never both
+        with self.tokens.lock(username):
+            missed, complete = self.tokens.replay(username, req.last_seq)
+            session.reply(req, response)
+            for ping in missed:
+                session.put(ping)
+            if not complete:
+                # some were pushed out of the buffer, the client fetches them as undelivered
+                session.put(
+                    chat_pb2.ChatResponse(action=chat_pb2.PING, n_undelivered=n_undelivered)
+                )
+            self.connect(session, username)
+
+    def handle_ping_user(self, session, req):
+        # ping that a user has been added or deleted
+        session.reply(req, chat_pb2.ChatResponse(action=req.action, ping_user=req.ping_user))
+
+    def dispatch(self, session, req):
+        """
+        Run the handler registered for a request's action, timed into its histogram.
+
+        A handler that raises is logged and counted as an error for its action,
+        the stream carries on with the next request.
+
+        Parameters:
+        ----------
+        session : Session
+            stream the request came in on
+        req : ChatRequest
+            request from the client
+        """
+        handler = self.handlers.get(req.action)
+        if handler is None:
+            logging.error(f"Invalid action: {req.action}")
+            return
+
+        session.last_active = time.monotonic()
+        name = chat_pb2.Action.Name(req.action)
+        try:
+            with self.metrics.time(name):
+                handler(session, req)
+        except Exception:
+            logging.error(f"Error handling {name}: {traceback.format_exc()}")
+
+    def run_unary(self, action, request, handler):
+        """
+        Run a handler for a unary call, timed into the histogram of its action.
+
+        Parameters:
+        ----------
+        action : chat_pb2.Action
+            action the call stands for
+        request : ChatRequest
+            request from the client
+        handler : callable
+            handler(session, req) that puts one response
+
+        Returns:
+        ----------
+        ChatResponse or None
+            the response, None if the handler failed
+        """
+        request.action = action
+        self.wire.record("in", request)
+        name = action_name(action)
+        session = Session(Reply())
+        try:
+            with self.metrics.time(name):
+                handler(session, request)
+        except Exception:
+            logging.error(f"Error handling unary {name}: {traceback.format_exc()}")
+            return None
+        return session.queue.response
+
+    def unary(self, action, request, context, handler):
+        response = self.run_unary(action, request, handler)
+        if response is None:
+            context.abort(
+                grpc.StatusCode.INTERNAL,
+                f"Error handling {action_name(action)}",
+            )
+        self.compress_unary(context, response)
+        return response
+
+    def compress_unary(self, context, response):
+        """
+        Compress the response of a unary call if it is large enough, and count it.
+        """
+        size = response.ByteSize()
+        compressed = self.compresses(size)
+        if compressed:
+            context.set_compression(self.compression)
+        self.wire.record("out", response, size, compressed)
+
+    def CheckUsername(self, request, context):
+        return self.unary(
+            chat_pb2.CHECK_USERNAME, request, context, self.handle_check_username
+        )
+
+    def Login(self, request, context):
+        return self.unary(chat_pb2.LOGIN, request, context, self.handle_unary_login)
+
+    def LoadChat(self, request, context):
+        return self.unary(chat_pb2.LOAD_CHAT, request, context, self.handle_load_chat)
+
     def Chat(self, request_iterator, context):
         """
         Chat function for ChatServiceServicer, unique to each client.
@@ -64,388 +943,23 @@ class ChatServiceServicer(chat_pb2_grpc.ChatServiceServicer):
         request_iterator : iterator
             iterator of requests from client
         context : context
-            All tutorials have this, but it's not used here. Kept for compatibility.
+            used to end the stream with an error status
         """
-        username = None
         # queue for sending responses to client
-        client_queue = queue.Queue()
+        session = Session(self.new_queue(), context)
+        if not self.admit_stream(session):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, self.full_message())
+
+        # wakes the response loop below however the RPC ends (cancelled, deadline, closed)
+        context.add_callback(session.queue.close)
+        self.start_compression(context)
 
         # handle incoming requests
         def handle_requests():
-            nonlocal username
             try:
                 for req in request_iterator:
-                    # print size of req in bytes
-                    logging.info(f"Size of request: {sys.getsizeof(req)} bytes")
-
-                    if req.action == chat_pb2.CHECK_USERNAME:
-                        # check if username is already in use
-                        sqlcon = sqlite3.connect(db_path)
-                        sqlcur = sqlcon.cursor()
-
-                        sqlcur.execute(
-                            "SELECT * FROM users WHERE username=?", (req.username,)
-                        )
-
-                        # if username is already in use, send response with success=False
-                        # otherwise, send response with success=True
-                        if sqlcur.fetchone():
-                            client_queue.put(
-                                chat_pb2.ChatResponse(
-                                    action=chat_pb2.CHECK_USERNAME, result=False
-                                )
-                            )
-                        else:
-                            client_queue.put(
-                                chat_pb2.ChatResponse(
-                                    action=chat_pb2.CHECK_USERNAME, result=True
-                                )
-                            )
-                        sqlcon.close()
-
-                    elif req.action == chat_pb2.LOGIN:
-                        sqlcon = sqlite3.connect(db_path)
-                        sqlcur = sqlcon.cursor()
-
-                        req.passhash = hashlib.sha256(req.passhash.encode()).hexdigest()
-
-                        sqlcur.execute(
-                            "SELECT * FROM users WHERE username=? AND passhash=?",
-                            (req.username, req.passhash),
-                        )
-
-                        # if username and password match, send response with success=True
-                        # otherwise, send response with success=False
-                        if sqlcur.fetchone():
-
-                            sqlcur.execute(
-                                "SELECT COUNT(*) FROM messages WHERE recipient=? AND delivered=0",
-                                (req.username,),
-                            )
-
-                            n_undelivered = sqlcur.fetchone()[0]
-
-                            response = chat_pb2.ChatResponse(
-                                action=chat_pb2.LOGIN,
-                                result=True,
-                                users=[
-                                    s[0]
-                                    for s in sqlcur.execute(
-                                        "SELECT username FROM users WHERE username != ?",
-                                        (req.username,),
-                                    ).fetchall()
-                                ],
-                                n_undelivered=n_undelivered,
-                            )
-
-                            client_queue.put(response)
-
-                            # add user to clients
-                            username = req.username
-                            clients[username] = client_queue
-                        else:
-                            client_queue.put(
-                                chat_pb2.ChatResponse(
-                                    action=chat_pb2.LOGIN, result=False
-                                )
-                            )
-                        sqlcon.close()
-
-                    elif req.action == chat_pb2.REGISTER:
-                        sqlcon = sqlite3.connect(db_path)
-                        sqlcur = sqlcon.cursor()
-
-                        # check to make sure username is not already in use
-                        sqlcur.execute(
-                            "SELECT * FROM users WHERE username=?", (req.username,)
-                        )
-                        if sqlcur.fetchone():
-                            client_queue.put(
-                                chat_pb2.ChatResponse(
-                                    action=chat_pb2.REGISTER, result=False
-                                )
-                            )
-                        else:
-                            # add new user to database
-                            req.passhash = hashlib.sha256(
-                                req.passhash.encode()
-                            ).hexdigest()
-                            sqlcur.execute(
-                                "INSERT INTO users (username, passhash) VALUES (?, ?)",
-                                (req.username, req.passhash),
-                            )
-                            sqlcon.commit()
-                            response = chat_pb2.ChatResponse(
-                                action=chat_pb2.REGISTER,
-                                result=True,
-                                users=[
-                                    s[0]
-                                    for s in sqlcur.execute(
-                                        "SELECT username FROM users WHERE username != ?",
-                                        (req.username,),
-                                    ).fetchall()
-                                ],
-                            )
-
-                            client_queue.put(response)
-
-                        sqlcon.close()
-
-                        # add user to clients
-                        username = req.username
-                        clients[username] = client_queue
-
-                        # send ping_user to all clients
-                        for user_q in clients.values():
-                            user_q.put(
-                                chat_pb2.ChatResponse(
-                                    action=chat_pb2.PING_USER, ping_user=username
-                                )
-                            )
-
-                        # ping all online users
-                    elif req.action == chat_pb2.LOAD_CHAT:
-                        sqlcon = sqlite3.connect(db_path)
-                        sqlcur = sqlcon.cursor()
-
-                        username = req.username
-                        user2 = req.user2
-                        try:
-                            sqlcur.execute(
-                                "SELECT sender, recipient, message, message_id FROM messages WHERE (sender=? AND recipient=?) OR (sender=? AND recipient=?) ORDER BY time",
-                                (username, user2, user2, username),
-                            )
-                            result = sqlcur.fetchall()
-                        except Exception as e:
-                            logging.error(f"Error in Load Chat: {e}")
-                            result = []
-
-                        formatted_messages = []
-
-                        for sender, recipient, message, message_id in result:
-                            formatted_messages.append(
-                                chat_pb2.ChatMessage(
-                                    sender=sender,
-                                    recipient=recipient,
-                                    message=message,
-                                    message_id=message_id,
-                                )
-                            )
-
-                        client_queue.put(
-                            chat_pb2.ChatResponse(
-                                action=chat_pb2.LOAD_CHAT, messages=formatted_messages
-                            )
-                        )
-
-                    elif req.action == chat_pb2.SEND_MESSAGE:
-                        sender = req.sender
-                        recipient = req.recipient
-                        message = req.message
-                        sqlcon = sqlite3.connect(db_path)
-                        sqlcur = sqlcon.cursor()
-
-                        try:
-                            sqlcur.execute(
-                                "INSERT INTO messages (sender, recipient, message) VALUES (?, ?, ?)",
-                                (sender, recipient, message),
-                            )
-                            sqlcon.commit()
-
-                            # get the message_id
-                            sqlcur.execute(
-                                "SELECT message_id FROM messages WHERE sender=? AND recipient=? AND message=? ORDER BY time DESC LIMIT 1",
-                                (sender, recipient, message),
-                            )
-                            message_id = sqlcur.fetchone()[0]
-
-                            # send message to recipient
-                            client_queue.put(
-                                chat_pb2.ChatResponse(
-                                    action=chat_pb2.SEND_MESSAGE, message_id=message_id
-                                )
-                            )
-
-                            # ping recipient if online
-                            if recipient in clients:
-                                clients[recipient].put(
-                                    chat_pb2.ChatResponse(
-                                        action=chat_pb2.PING,
-                                        sender=sender,
-                                        sent_message=message,
-                                        message_id=message_id,
-                                    )
-                                )
-
-                        except:
-                            logging.error("Error sending message")
-                            message_id = None
-
-                        sqlcon.close()
-                    elif req.action == chat_pb2.PING:
-                        action = req.action
-                        sender = req.sender
-                        sent_message = req.sent_message
-                        message_id = req.message_id
-
-                        client_queue.put(
-                            chat_pb2.ChatResponse(
-                                action=action,
-                                sender=sender,
-                                sent_message=sent_message,
-                                message_id=message_id,
-                            )
-                        )
-
-                        sqlcon = sqlite3.connect(db_path)
-                        sqlcur = sqlcon.cursor()
-
-                        logging.info(f"Updating message {message_id} to delivered.")
-
-                        sqlcur.execute(
-                            "UPDATE messages SET delivered=1 WHERE message_id=?",
-                            (message_id,),
-                        )
-                        sqlcon.commit()
-
-                        sqlcon.close()
-                    elif req.action == chat_pb2.VIEW_UNDELIVERED:
-                        sqlcon = sqlite3.connect(db_path)
-                        sqlcur = sqlcon.cursor()
-
-                        username = req.username
-                        n_messages = req.n_messages
-
-                        sqlcur.execute(
-                            "SELECT sender, recipient, message, message_id FROM messages WHERE recipient=? AND delivered=0 ORDER BY time DESC LIMIT ?",
-                            (username, n_messages),
-                        )
-                        result = sqlcur.fetchall()
-
-                        # format messages to ChatMessage
-                        messages_formatted = []
-
-                        for sender, recipient, message, message_id in result:
-                            messages_formatted.append(
-                                chat_pb2.ChatMessage(
-                                    sender=sender,
-                                    recipient=recipient,
-                                    message=message,
-                                    message_id=message_id,
-                                )
-                            )
-
-                        client_queue.put(
-                            chat_pb2.ChatResponse(
-                                action=chat_pb2.VIEW_UNDELIVERED,
-                                messages=messages_formatted,
-                            )
-                        )
-
-                        sqlcur.execute(
-                            "UPDATE messages SET delivered=1 WHERE recipient=?",
-                            (username,),
-                        )
-
-                        sqlcon.commit()
-                        sqlcon.close()
-                    elif req.action == chat_pb2.DELETE_MESSAGE:
-                        sqlcon = sqlite3.connect(db_path)
-                        sqlcur = sqlcon.cursor()
-
-                        message_id = req.message_id
-                        sqlcur.execute(
-                            "DELETE FROM messages WHERE message_id=?", (message_id,)
-                        )
-                        sqlcon.commit()
-
-                        sqlcon.close()
-                        client_queue.put(
-                            chat_pb2.ChatResponse(
-                                action=chat_pb2.DELETE_MESSAGE, message_id=message_id
-                            )
-                        )
-
-                        # if recipient is online, ping recipient to update chat
-                        if req.recipient in clients:
-                            clients[req.recipient].put(
-                                chat_pb2.ChatResponse(
-                                    action=chat_pb2.PING,
-                                    sender=req.sender,
-                                    sent_message=req.message,
-                                    message_id=message_id,
-                                )
-                            )
-
-                    elif req.action == chat_pb2.DELETE_ACCOUNT:
-                        sqlcon = sqlite3.connect(db_path)
-                        sqlcur = sqlcon.cursor()
-
-                        username = req.username
-                        passhash = req.passhash
-
-                        passhash = hashlib.sha256(passhash.encode()).hexdigest()
-                        sqlcur.execute(
-                            "SELECT passhash FROM users WHERE username=?", (username,)
-                        )
-
-                        result = sqlcur.fetchone()
-                        if result:
-                            # username exists and passhash matches
-                            if result[0] == passhash:
-                                sqlcur.execute(
-                                    "DELETE FROM users WHERE username=?", (username,)
-                                )
-                                sqlcur.execute(
-                                    "DELETE FROM messages WHERE sender=? OR recipient=?",
-                                    (username, username),
-                                )
-                                sqlcon.commit()
-
-                                client_queue.put(
-                                    chat_pb2.ChatResponse(
-                                        action=chat_pb2.DELETE_ACCOUNT, result=True
-                                    )
-                                )
-                                # tell server to ping users to update their chat, remove from connected users
-
-                                # delete user from clients
-                                if username in clients:
-                                    del clients[username]
-
-                                for user_q in clients.values():
-                                    user_q.put(
-                                        chat_pb2.ChatResponse(
-                                            action=chat_pb2.PING_USER,
-                                            ping_user=username,
-                                        )
-                                    )
-
-                            # username exists but passhash is wrong
-                            else:
-                                client_queue.put(
-                                    chat_pb2.ChatResponse(
-                                        action=chat_pb2.DELETE_ACCOUNT, result=False
-                                    )
-                                )
-                        else:
-                            # username doesn't exist
-                            client_queue.put(
-                                chat_pb2.ChatResponse(
-                                    action=chat_pb2.DELETE_ACCOUNT, result=False
-                                )
-                            )
-
-                        sqlcon.close()
-                    elif req.action == chat_pb2.PING_USER:
-                        # ping that a user has been added or deleted
-                        action = req.action
-                        ping_user = req.ping_user
-                        client_queue.put(
-                            chat_pb2.ChatResponse(action=action, ping_user=ping_user)
-                        )
-                    else:
-                        logging.error(f"Invalid action: {req.action}")
+                    self.wire.record("in", req)
+                    self.dispatch(session, req)
             except Exception as e:
                 tb = traceback.extract_tb(e.__traceback__)
                 line_number = tb[-1].lineno if tb else "unknown"
@@ -453,36 +967,74 @@ class ChatServiceServicer(chat_pb2_grpc.ChatServiceServicer):
                     f"Error handling requests at line {line_number}: {traceback.format_exc()}"
                 )
             finally:
-                if username in clients:
-                    del clients[username]
-                    logging.info(f"{username} disconnected.")
-
-        # Run request handling in a separate thread.
-        threading.Thread(target=handle_requests, daemon=True).start()
-
-        # Continuously yield responses from the client's queue.
-        while True:
-            try:
-                response = client_queue.get()
+                # free anything the store holds for this stream's thread
+                self.store.release()
+                if session.username and self.disconnect(session.username, session):
+                    logging.info(f"{session.username} disconnected.")
+                # the client stopped sending, end the response stream once the responses
+                # already queued are sent, which frees its worker
+                session.queue.finish()
+
+        try:
+            # Run request handling in a separate thread.
+            threading.Thread(
+                target=handle_requests, name="chat-requests", daemon=True
+            ).start()
+
+            # Yield responses from the client's queue until the stream is closed.
+            while True:
+                response = session.queue.get()
+                if response is None:
+                    break
+                size, compressed = self.compress_next(context, response)
                 yield response
-            except Exception as e:
-                break
+                session.last_active = time.monotonic()
+                session.bytes_sent += self.wire.record("out", response, size, compressed)
+
+            if session.queue.overflowed:
+                context.abort(
+                    grpc.StatusCode.RESOURCE_EXHAUSTED,
+                    "Too many responses waiting, the client is not reading them.",
+                )
+        finally:
+            self.end_stream(session)
 
 
 def serve():
     """
     Main loop for server. Runs server on separate thread.
     """
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    chat_pb2_grpc.add_ChatServiceServicer_to_server(ChatServiceServicer(), server)
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=max_workers),
+        maximum_concurrent_rpcs=maximum_concurrent_rpcs,
+    )
+    servicer = ChatServiceServicer()
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
     server.add_insecure_port(f"{host}:{port}")
     server.start()
-    logging.info(f"Server started on port {port}")
+    logging.info(
+        f"Server started on port {port} with {max_workers} workers, "
+        f"{servicer.max_streams or 'unlimited'} chats"
+    )
+    if metrics_log_interval:
+        log_every(
+            metrics_log_interval,
+            servicer.metrics,
+            servicer.wire,
+            servicer.outbound_stats,
+            servicer.fanout,
+            servicer.auth,
+            servicer,
+        )
+    servicer.start_reaper(stream_reap_interval)
     try:
         while True:
             time.sleep(86400)
     except KeyboardInterrupt:
         server.stop(0)
+        servicer.fanout.stop()
+        servicer.auth.close()
+        servicer.store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+import secrets
+import threading
+import time
+import zlib
+from collections import deque
+
+
+class _Resumable:
+    """
+    One user's token and the PINGs sent to them since it was issued.
+    """
+
+    def __init__(self, token, replay_size):
+        self.token = token
+        # only counts once the user has disconnected
+        self.expires = 0.0
+        # responses stamped with their seq, oldest first
+        self.replay = deque(maxlen=replay_size)
+        # seq of the last PING recorded, and of the newest one pushed out of the full buffer
+        self.seq = 0
+        self.evicted_seq = 0
+        # when the user's last stream ended, None while connected
+        self.detached_at = None
+
+    def expired(self, now) -> bool:
+        return self.detached_at is not None and self.expires < now
+
+
+class SessionTokens:
+    """
+    SessionTokens class for resuming a session after a dropped stream
+
+    LOGIN and REGISTER issue a token. Every PING sent to the user is numbered with `seq`,
+    counting up from 1 per token, and kept in a replay buffer of the last `replay_size`,
+    whether or not they are connected. A client whose stream dropped sends RESUME with the
+    token and the last seq it has seen, and gets back only the PINGs it missed, without
+    logging in or reloading the chat. Message ids cannot be used for this, since they do not
+    grow across conversations on the sharded engine. Tokens expire `ttl_s` seconds after the
+    user disconnects.
+
+    Recording a PING and resuming the user must not interleave, or a PING could be
+    replayed and delivered live, or neither. Callers hold lock(username) around both.
+    """
+
+    def __init__(self, ttl_s=86400, replay_size=100, stripes=16):
+        self.ttl_s = ttl_s
+        self.replay_size = replay_size
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # username -> _Resumable
+        self._users = {}
+        # token -> username
+        self._tokens = {}
+        self._tokens_lock = threading.Lock()
+
+    def lock(self, username):
+        """
+        Get the lock to hold while recording for or resuming `username`.
+        """
+        return self._locks[zlib.crc32(username.encode()) % len(self._locks)]
+
+    def issue(self, username) -> str:
+        """
+        Give a user a new token with an empty replay buffer, replacing their old one.
+        """
+        token = secrets.token_urlsafe(32)
+        resumable = _Resumable(token, self.replay_size)
+        with self.lock(username), self._tokens_lock:
+            old = self._users.get(username)
+            if old is not None:
+                self._tokens.pop(old.token, None)
+            self._users[username] = resumable
+            self._tokens[token] = username
+        return token
+
+    def resolve(self, token):
+        """
+        Get the user a token belongs to, or None if it is unknown or expired.
+        """
+        with self._tokens_lock:
+            username = self._tokens.get(token)
+            resumable = self._users.get(username)
+            if resumable is None or resumable.expired(time.monotonic()):
+                return None
+            resumable.expires = time.monotonic() + self.ttl_s
+            return username
+
+    def revoke(self, username):
+        """
+        Forget a user's token and replay buffer, when the account is deleted.
+        """
+        with self.lock(username), self._tokens_lock:
+            resumable = self._users.pop(username, None)
+            if resumable is not None:
+                self._tokens.pop(resumable.token, None)
+
+    def record(self, username, response):
+        """
+        Number a PING and keep it for replay if the user has a token, otherwise clear its
+        seq. Called with lock(username) held.
+        """
+        resumable = self._users.get(username)
+        if resumable is None:
+            # a seq from another process's tokens would mean nothing to the client
+            response.ClearField("seq")
+            return
+        if len(resumable.replay) == resumable.replay.maxlen:
+            resumable.evicted_seq = resumable.replay[0].seq
+        resumable.seq += 1
+        response.seq = resumable.seq
+        resumable.replay.append(response)
+
+    def detach(self, username):
+        """
+        Note that a user's stream ended, so their token starts to expire.
+        """
+        with self.lock(username):
+            resumable = self._users.get(username)
+            if resumable is not None:
+                resumable.detached_at = time.monotonic()
+                resumable.expires = resumable.detached_at + self.ttl_s
+
+    def replay(self, username, last_seq):
+        """
+        Get the PINGs a resuming user missed, those with a seq after `last_seq`.
+        Called with lock(username) held.
+
+        Returns:
+        ----------
+        tuple
+            (responses oldest first, False if the buffer overflowed and some were lost)
+        """
+        resumable = self._users.get(username)
+        if resumable is None:
+            return [], False
+        resumable.detached_at = None
+
+        responses = [r for r in resumable.replay if r.seq > last_seq]
+        return responses, resumable.evicted_seq <= last_seq
+
+    def prune(self) -> int:
+        """
+        Drop expired tokens and their buffers. Returns how many were dropped.
+        """
+        now = time.monotonic()
+        with self._tokens_lock:
+            expired = [u for u, r in self._users.items() if r.expired(now)]
+        for username in expired:
+            with self.lock(username), self._tokens_lock:
+                resumable = self._users.get(username)
+                if resumable is not None and resumable.expired(now):
+                    del self._users[username]
+                    self._tokens.pop(resumable.token, None)
+        return len(expired)
+
+    def __len__(self):
+        return len(self._users)
@@ -1,6 +1,8 @@
 import os
 import sqlite3
 
+from migrations import migrate
+
 def reset_database(data_path="data/messenger.db") -> None:
     """
     Reset the database by deleting the file if it exists.
@@ -24,6 +26,9 @@ def structure_tables(data_path="data/messenger.db") -> None:
     with sqlite3.connect(data_path) as conn:
         cursor = conn.cursor()
 
+        # must be set before the first table is created, lets the archiver shrink the file
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
         # set up users table in messenger.db file
         cursor.execute(
             """
@@ -52,6 +57,9 @@ def structure_tables(data_path="data/messenger.db") -> None:
         print(f"Created users table.")
         print(f"Created messages table.")
 
+    # bring the new tables up to the latest schema version (indexes, constraints)
+    migrate(data_path)
+
 
 if __name__ == "__main__":
     reset_database()
@@ -0,0 +1,160 @@
+import zlib
+
+from sqlite_store import SQLiteMessageStore
+from storage import MessageStore
+
+
+def _hash(key):
+    # stable across runs and processes, unlike hash() on strings
+    return zlib.crc32(key.encode())
+
+
+class ShardedMessageStore(MessageStore):
+    """
+    ShardedMessageStore class, a MessageStore engine spread over several sqlite files
+
+    Each shard is a full SQLiteMessageStore with its own file, connection pool, writer and
+    ack buffer, so writes to different shards commit in parallel. A conversation lives on
+    the shard picked by a hash of its (sorted) user pair, which keeps LOAD_CHAT on a single
+    shard, and a user row on the shard picked by a hash of the username.
+
+    Message ids are made global by folding the shard in: id = local_id * n_shards + shard.
+    Ids still have to fit the proto's int32, so each shard gets 2**31 / n_shards of them.
+    Operations that touch every shard (DELETE_ACCOUNT, undelivered messages) are not atomic
+    across shards.
+    """
+
+    def __init__(self, shard_paths, **sqlite_options):
+        """
+        Parameters:
+        ----------
+        shard_paths : list of str
+            one database file per shard; the order must never change once data is stored
+        sqlite_options : dict
+            passed on to every SQLiteMessageStore
+        """
+        self.shards = [SQLiteMessageStore(path, **sqlite_options) for path in shard_paths]
+        self.n_shards = len(self.shards)
+
+    # routing
+
+    def user_shard(self, username) -> int:
+        return _hash(username) % self.n_shards
+
+    def conversation_shard(self, user1, user2) -> int:
+        # either user may be first, both directions belong to the same conversation
+        return _hash("\0".join(sorted((user1, user2)))) % self.n_shards
+
+    def _global_id(self, shard, local_id):
+        return local_id * self.n_shards + shard
+
+    def _local_id(self, message_id):
+        # (shard, local id)
+        return message_id % self.n_shards, message_id // self.n_shards
+
+    def _map(self, fn, *args):
+        """
+        Call fn(shard, *args) on every shard, results in shard order.
+        Runs on the calling thread, whose pooled connections are per thread.
+        """
+        return [fn(shard, *args) for shard in self.shards]
+
+    # users
+
+    def list_users(self):
+        # oldest first within a shard, shards one after another
+        users = []
+        for shard_users in self._map(SQLiteMessageStore.list_users):
+            users.extend(shard_users)
+        return users
+
+    def get_passhash(self, username):
+        return self.shards[self.user_shard(username)].get_passhash(username)
+
+    def create_user(self, username, passhash) -> bool:
+        return self.shards[self.user_shard(username)].create_user(username, passhash)
+
+    def set_passhash(self, username, passhash):
+        self.shards[self.user_shard(username)].set_passhash(username, passhash)
+
+    def delete_account(self, username):
+        # conversations with the user can be on any shard, the user row is on one of them
+        self._map(SQLiteMessageStore.delete_account, username)
+
+    # messages
+
+    def send_message(self, sender, recipient, message) -> int:
+        shard = self.conversation_shard(sender, recipient)
+        local_id = self.shards[shard].send_message(sender, recipient, message)
+        return self._global_id(shard, local_id)
+
+    def send_messages(self, messages):
+        # one transaction per shard, the batch as a whole is not atomic across shards
+        by_shard = {}
+        for index, (sender, recipient, message) in enumerate(messages):
+            shard = self.conversation_shard(sender, recipient)
+            by_shard.setdefault(shard, []).append((index, (sender, recipient, message)))
+
+        message_ids = [0] * len(messages)
+        for shard, entries in by_shard.items():
+            local_ids = self.shards[shard].send_messages([m for _, m in entries])
+            for (index, _), local_id in zip(entries, local_ids):
+                message_ids[index] = self._global_id(shard, local_id)
+        return message_ids
+
+    def load_chat(self, user1, user2, before_message_id=0, limit=50):
+        shard = self.conversation_shard(user1, user2)
+        # local ids below this are exactly the global ids below the cursor
+        before = -(-(before_message_id - shard) // self.n_shards) if before_message_id else 0
+        if before_message_id and before <= 0:
+            # a cursor below every id of this shard, 0 would mean no cursor at all
+            return []
+        rows = self.shards[shard].load_chat(user1, user2, before, limit)
+        return [row[:3] + (self._global_id(shard, row[3]),) for row in rows]
+
+    def delete_message(self, message_id):
+        shard, local_id = self._local_id(message_id)
+        self.shards[shard].delete_message(local_id)
+
+    # delivery state
+
+    def count_undelivered(self, username) -> int:
+        return sum(self._map(SQLiteMessageStore.count_undelivered, username))
+
+    def view_undelivered(self, username, n_messages):
+        # newest n from each shard, then the newest n of those by send time
+        rows = []
+        for shard, shard_rows in enumerate(
+            self._map(SQLiteMessageStore.undelivered_rows, username, n_messages)
+        ):
+            rows.extend((row[4], row[3], shard, row[:3]) for row in shard_rows)
+        rows.sort(reverse=True)
+        rows = rows[:n_messages]
+
+        # only the messages that were shown are marked, each on its own shard
+        viewed = {}
+        for _, local_id, shard, _ in rows:
+            viewed.setdefault(shard, []).append(local_id)
+        for shard, local_ids in viewed.items():
+            self.shards[shard].set_delivered(username, local_ids)
+
+        return [row + (self._global_id(shard, local_id),) for _, local_id, shard, row in rows]
+
+    def mark_delivered(self, message_ids):
+        by_shard = {}
+        for message_id in message_ids:
+            shard, local_id = self._local_id(message_id)
+            by_shard.setdefault(shard, []).append(local_id)
+        for shard, local_ids in by_shard.items():
+            self.shards[shard].mark_delivered(local_ids)
+
+    # lifecycle
+
+    def flush(self):
+        self._map(SQLiteMessageStore.flush)
+
+    def release(self):
+        self._map(SQLiteMessageStore.release)
+
+    def close(self):
+        self._map(SQLiteMessageStore.close)
@@ -0,0 +1,273 @@
+import sqlite3
+
+from ack_buffer import AckBuffer
+from archiver import Archiver
+from counters import UndeliveredCounters
+from db_pool import ConnectionPool
+from message_writer import MessageWriter
+from migrations import migrate
+from storage import MessageStore
+
+# message_id is an int32 in the proto, so this is newer than any message
+MAX_MESSAGE_ID = 2**31 - 1
+
+# One page of a conversation, newest first. Each direction is its own index range scan
+# (sender, recipient, message_id < cursor) so only the rows on the page are read, once in
+# messages and once in messages_archive for pages the archiver has moved.
+LOAD_CHAT_PAGE_QUERY = """
+    SELECT sender, recipient, message, message_id FROM (
+        SELECT * FROM (
+            SELECT sender, recipient, message, message_id FROM messages
+            WHERE sender=? AND recipient=? AND message_id<?
+            ORDER BY message_id DESC LIMIT ?
+        )
+        UNION
+        SELECT * FROM (
+            SELECT sender, recipient, message, message_id FROM messages
+            WHERE sender=? AND recipient=? AND message_id<?
+            ORDER BY message_id DESC LIMIT ?
+        )
+        UNION
+        SELECT * FROM (
+            SELECT sender, recipient, message, message_id FROM messages_archive
+            WHERE sender=? AND recipient=? AND message_id<?
+            ORDER BY message_id DESC LIMIT ?
+        )
+        UNION
+        SELECT * FROM (
+            SELECT sender, recipient, message, message_id FROM messages_archive
+            WHERE sender=? AND recipient=? AND message_id<?
+            ORDER BY message_id DESC LIMIT ?
+        )
+    )
+    ORDER BY message_id DESC LIMIT ?
+"""
+
+
+class SQLiteMessageStore(MessageStore):
+    """
+    SQLiteMessageStore class, the MessageStore engine backed by a single sqlite file
+
+    Reads go through pooled per-thread connections, new messages through the group-commit
+    writer and delivery acknowledgements through the ack buffer. Undelivered counts are kept
+    in memory and rebuilt when the store is opened, unless `cache_counts` is off because other
+    processes write to the same file. Old delivered messages can be moved to an archive table
+    in the background, see archiver.Archiver.
+    """
+
+    def __init__(
+        self,
+        db_path,
+        pool_size=10,
+        cached_statements=128,
+        health_check_interval=30,
+        write_batch_size=64,
+        write_batch_ms=5,
+        ack_flush_ms=50,
+        ack_max_pending=1000,
+        archive_after_s=0,
+        archive_chunk_size=500,
+        archive_interval_s=60,
+        cache_counts=True,
+    ):
+        self.db_path = db_path
+        # counted from the messages table on every LOGIN when off, for multi-process servers
+        self.cache_counts = cache_counts
+
+        # upgrade the database schema in place before taking any requests
+        migrate(db_path)
+
+        # long-lived connections shared by all streams, one per handler thread
+        self.pool = ConnectionPool(
+            db_path,
+            size=pool_size,
+            cached_statements=cached_statements,
+            health_check_interval=health_check_interval,
+        )
+
+        # undelivered counts per user, counted once here and then kept in sync
+        self.counters = UndeliveredCounters()
+        if cache_counts:
+            self.counters.rebuild(self.pool.connection())
+            self.pool.release()
+
+        # single writer that group-commits new messages from every stream
+        self.writer = MessageWriter(
+            db_path, max_batch=write_batch_size, max_wait_ms=write_batch_ms
+        )
+        self.writer.start()
+
+        # delivery acknowledgements, written in batches
+        self.acks = AckBuffer(
+            db_path,
+            flush_interval_ms=ack_flush_ms,
+            max_pending=ack_max_pending,
+            # not persisted when uncached, another process's counts would be overwritten
+            counters=self.counters if cache_counts else None,
+        )
+        self.acks.start()
+
+        # moves old delivered messages to messages_archive, off when archive_after_s is 0
+        self.archiver = None
+        if archive_after_s:
+            self.archiver = Archiver(
+                db_path,
+                max_age_s=archive_after_s,
+                chunk_size=archive_chunk_size,
+                interval_s=archive_interval_s,
+            )
+            self.archiver.start()
+
+    # users
+
+    def list_users(self):
+        conn = self.pool.connection()
+        rows = conn.execute("SELECT username FROM users ORDER BY user_id").fetchall()
+        return [row[0] for row in rows]
+
+    def get_passhash(self, username):
+        conn = self.pool.connection()
+        row = conn.execute(
+            "SELECT passhash FROM users WHERE username=?", (username,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def create_user(self, username, passhash) -> bool:
+        conn = self.pool.connection()
+        try:
+            conn.execute(
+                "INSERT INTO users (username, passhash) VALUES (?, ?)",
+                (username, passhash),
+            )
+            conn.commit()
+        except sqlite3.IntegrityError:
+            # username is unique, someone else registered it first
+            conn.rollback()
+            return False
+        return True
+
+    def set_passhash(self, username, passhash):
+        conn = self.pool.connection()
+        conn.execute("UPDATE users SET passhash=? WHERE username=?", (passhash, username))
+        conn.commit()
+
+    def delete_account(self, username):
+        conn = self.pool.connection()
+        conn.execute("DELETE FROM users WHERE username=?", (username,))
+        deleted = conn.execute(
+            "DELETE FROM messages WHERE sender=? OR recipient=? RETURNING recipient, delivered",
+            (username, username),
+        ).fetchall()
+        # archived messages are all delivered, they do not change any counts
+        conn.execute(
+            "DELETE FROM messages_archive WHERE sender=? OR recipient=?",
+            (username, username),
+        )
+        conn.commit()
+
+        # unread messages from this user no longer count for others
+        for recipient, delivered in deleted:
+            if not delivered:
+                self.counters.add(recipient, -1)
+        self.counters.drop(username)
+
+    # messages
+
+    def send_message(self, sender, recipient, message) -> int:
+        # wait for the writer to commit the batch holding this message, raises if the
+        # writer died or is stuck instead of blocking the stream forever
+        future = self.writer.submit(sender, recipient, message)
+        message_id = future.result(timeout=self.writer.result_timeout)
+        self.counters.add(recipient)
+        return message_id
+
+    def send_messages(self, messages):
+        # one submission, so the writer commits the whole batch together
+        future = self.writer.submit_many(messages)
+        message_ids = future.result(timeout=self.writer.result_timeout)
+        for _, recipient, _ in messages:
+            self.counters.add(recipient)
+        return message_ids
+
+    def load_chat(self, user1, user2, before_message_id=0, limit=50):
+        before = before_message_id or MAX_MESSAGE_ID
+        conn = self.pool.connection()
+        return conn.execute(
+            LOAD_CHAT_PAGE_QUERY,
+            ((user1, user2, before, limit) + (user2, user1, before, limit)) * 2 + (limit,),
+        ).fetchall()
+
+    def delete_message(self, message_id):
+        conn = self.pool.connection()
+        deleted = conn.execute(
+            "DELETE FROM messages WHERE message_id=? RETURNING recipient, delivered",
+            (message_id,),
+        ).fetchall()
+        conn.execute("DELETE FROM messages_archive WHERE message_id=?", (message_id,))
+        conn.commit()
+
+        # deleting an unread message takes it off the recipient's count
+        for recipient, delivered in deleted:
+            if not delivered:
+                self.counters.add(recipient, -1)
+
+    # delivery state
+
+    def count_undelivered(self, username) -> int:
+        if not self.cache_counts:
+            conn = self.pool.connection()
+            return conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE recipient=? AND delivered=0", (username,)
+            ).fetchone()[0]
+        return self.counters.get(username)
+
+    def undelivered_rows(self, username, n_messages):
+        """
+        Get a user's newest undelivered messages without marking them.
+        Rows also carry the time each message was sent.
+        """
+        conn = self.pool.connection()
+        return conn.execute(
+            "SELECT sender, recipient, message, message_id, time FROM messages WHERE recipient=? AND delivered=0 ORDER BY message_id DESC LIMIT ?",
+            (username, n_messages),
+        ).fetchall()
+
+    def set_delivered(self, username, message_ids):
+        """
+        Mark a user's messages as delivered right away, bypassing the ack buffer.
+        """
+        conn = self.pool.connection()
+        if message_ids:
+            cursor = conn.execute(
+                f"UPDATE messages SET delivered=1 WHERE message_id IN ({','.join('?' * len(message_ids))}) AND delivered=0",
+                message_ids,
+            )
+            self.counters.add(username, -cursor.rowcount)
+        conn.commit()
+
+    def view_undelivered(self, username, n_messages):
+        rows = self.undelivered_rows(username, n_messages)
+
+        # only the messages that were shown are now delivered
+        self.set_delivered(username, [row[3] for row in rows])
+        return [row[:4] for row in rows]
+
+    def mark_delivered(self, message_ids):
+        # marked delivered with the next batch of acks
+        self.acks.add(message_ids)
+
+    # lifecycle
+
+    def flush(self):
+        self.acks.flush()
+
+    def release(self):
+        # hand this thread's connection back to the pool
+        self.pool.release()
+
+    def close(self):
+        if self.archiver is not None:
+            self.archiver.stop()
+        self.writer.stop()
+        self.acks.stop()
+        self.pool.close()
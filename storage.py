@@ -0,0 +1,171 @@
+class MessageStore:
+    """
+    MessageStore class, the interface between the chat protocol and its storage engine
+
+    Covers users, messages, delivery state and deletes. Rows are returned as
+    (sender, recipient, message, message_id) tuples. Engines are chosen with
+    db_config["engine"] in config/config.json, see create_store.
+    """
+
+    # users
+
+    def list_users(self):
+        """
+        Get every registered username, oldest account first (within each shard when sharded).
+        """
+        raise NotImplementedError
+
+    def get_passhash(self, username):
+        """
+        Get the stored password hash for a user, or None if the user does not exist.
+        """
+        raise NotImplementedError
+
+    def create_user(self, username, passhash) -> bool:
+        """
+        Add a new user. Returns False if the username is already taken.
+        """
+        raise NotImplementedError
+
+    def set_passhash(self, username, passhash):
+        """
+        Replace a user's stored password hash, when it is upgraded to a stronger one.
+        """
+        raise NotImplementedError
+
+    def delete_account(self, username):
+        """
+        Delete a user along with every message they sent or received.
+        """
+        raise NotImplementedError
+
+    # messages
+
+    def send_message(self, sender, recipient, message) -> int:
+        """
+        Store a new undelivered message. Returns its message_id once it is durable.
+        """
+        raise NotImplementedError
+
+    def send_messages(self, messages):
+        """
+        Store several new undelivered messages, in one transaction where the engine has them.
+
+        Parameters:
+        ----------
+        messages : list
+            (sender, recipient, message) tuples
+
+        Returns:
+        ----------
+        list
+            the new message_ids in the same order, once every message is durable
+        """
+        return [self.send_message(*m) for m in messages]
+
+    def load_chat(self, user1, user2, before_message_id=0, limit=50):
+        """
+        Get up to `limit` messages between two users, newest first.
+
+        Parameters:
+        ----------
+        user1, user2 : str
+            the two users in the conversation, in either order
+        before_message_id : int
+            only return messages older than this id, 0 for the newest messages
+        limit : int
+            maximum number of messages returned
+        """
+        raise NotImplementedError
+
+    def delete_message(self, message_id):
+        """
+        Delete a single message.
+        """
+        raise NotImplementedError
+
+    # delivery state
+
+    def count_undelivered(self, username) -> int:
+        """
+        Get the number of undelivered messages for a user.
+        """
+        raise NotImplementedError
+
+    def view_undelivered(self, username, n_messages):
+        """
+        Get a user's newest `n_messages` undelivered messages, newest first,
+        and mark exactly those as delivered.
+        """
+        raise NotImplementedError
+
+    def mark_delivered(self, message_ids):
+        """
+        Mark messages as delivered. Engines may apply this in the background.
+        """
+        raise NotImplementedError
+
+    # lifecycle
+
+    def flush(self):
+        """
+        Apply any changes the engine is still holding in memory.
+        """
+
+    def release(self):
+        """
+        Free resources held for the calling thread, called when a stream ends.
+        """
+
+    def close(self):
+        """
+        Flush and shut down the engine.
+        """
+
+
+def create_store(db_config):
+    """
+    Create the storage engine named in the db_config section of config.json.
+
+    Parameters:
+    ----------
+    db_config : dict
+        db_config section, "engine" is "sqlite" (default), "sharded" or "memory"
+    """
+    engine = db_config.get("engine", "sqlite")
+
+    sqlite_options = dict(
+        pool_size=db_config.get("pool_size", 10),
+        cached_statements=db_config.get("cached_statements", 128),
+        health_check_interval=db_config.get("health_check_interval", 30),
+        write_batch_size=db_config.get("write_batch_size", 64),
+        write_batch_ms=db_config.get("write_batch_ms", 5),
+        ack_flush_ms=db_config.get("ack_flush_ms", 50),
+        ack_max_pending=db_config.get("ack_max_pending", 1000),
+        archive_after_s=db_config.get("archive_after_s", 0),
+        archive_chunk_size=db_config.get("archive_chunk_size", 500),
+        archive_interval_s=db_config.get("archive_interval_s", 60),
+        cache_counts=db_config.get("cache_counts", True),
+    )
+
+    if engine == "sqlite":
+        from sqlite_store import SQLiteMessageStore
+
+        return SQLiteMessageStore(
+            db_config.get("path", "data/messenger.db"), **sqlite_options
+        )
+    if engine == "sharded":
+        from sharded_store import ShardedMessageStore
+
+        # "{}" in shard_path is replaced by the shard number
+        shard_path = db_config.get("shard_path", "data/messenger_shard{}.db")
+        return ShardedMessageStore(
+            [shard_path.format(i) for i in range(db_config.get("shards", 4))],
+            **sqlite_options,
+        )
+    if engine == "memory":
+        from memory_store import MemoryMessageStore
+
+        return MemoryMessageStore(stripes=db_config.get("stripes", 16))
+
+    raise ValueError(f"Unknown storage engine: {engine}")
@@ -1,14 +1,38 @@
 from concurrent import futures
+import asyncio
+import hashlib
 import unittest
 import os
+import queue
 import sqlite3
+import tempfile
+import threading
+import time
 
 import grpc
 import chat_pb2
 import chat_pb2_grpc
-from server import ChatServiceServicer
+import server
+from server import ChatServiceServicer, Session
+import aio_server
+from aio_server import AioChatServiceServicer
 from setup import reset_database, structure_tables
-from test_server import handle_requests
+from db_pool import ConnectionPool
+from migrations import LATEST_VERSION, current_version, migrate
+from message_writer import MessageWriter
+from ack_buffer import AckBuffer
+from archiver import Archiver
+from counters import UndeliveredCounters
+from user_directory import UserDirectory
+from metrics import ActionMetrics, LatencyHistogram, WireStats
+from outbound import OutboundQueue, OutboundStats
+from presence import PresenceRegistry
+from fanout import FanoutEngine
+from broker import Broker, BrokerClient
+from auth import AuthBusy, AuthPool, AuthUnavailable, hash_password, verify_password
+from session_tokens import SessionTokens
+from storage import create_store
+from bench_compression import Relay
 
 unittest.TestLoader.sortTestMethodsUsing = None
 
@@ -53,11 +77,33 @@ class TestServerProcessResponse(unittest.TestCase):
 
         structure_tables("data/test_database.db")
 
+        # the real servicer on the test database, no batching window so sequential
+        # sends are not slowed down
+        cls.servicer = ChatServiceServicer(
+            store=create_store({"engine": "sqlite", "path": "data/test_database.db", "write_batch_ms": 0}),
+            auth=AuthPool(workers=0, iterations=1000),
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.servicer.fanout.stop()
+        cls.servicer.store.close()
+
+    def handle(self, request):
+        # dispatch on a fresh stream, acks written before the database is checked
+        session = Session(queue.Queue())
+        self.servicer.dispatch(session, request)
+        self.servicer.store.flush()
+        try:
+            return session.queue.get_nowait()
+        except queue.Empty:
+            return None
+
     def test1b_register_user(self):
         # register user, check if it exists in the database
         request = chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username="foo", passhash="bar")
 
-        response = handle_requests(request)
+        response = self.handle(request)
 
         self.assertEqual(response.result, True)
         self.assertEqual(response.users, [])
@@ -79,7 +125,7 @@ class TestServerProcessResponse(unittest.TestCase):
         # if user already exists, it should return False
         request = chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username="foo", passhash="bar")
 
-        response = handle_requests(request)
+        response = self.handle(request)
 
         self.assertEqual(response.result, False)
 
@@ -99,7 +145,7 @@ class TestServerProcessResponse(unittest.TestCase):
         # login existing user, check return true
         request = chat_pb2.ChatRequest(action=chat_pb2.LOGIN, username="foo", passhash="bar")
 
-        response = handle_requests(request)
+        response = self.handle(request)
 
         self.assertEqual(response.result, True)
 
@@ -107,14 +153,14 @@ class TestServerProcessResponse(unittest.TestCase):
         # login with invalid password, should return False
         request = chat_pb2.ChatRequest(action=chat_pb2.LOGIN, username="foo", passhash="baz")
 
-        response = handle_requests(request)
+        response = self.handle(request)
 
         self.assertEqual(response.result, False)
 
     def test1f_register_other(self):
         # register another user, check if it exists in the database
         request = chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username="bar", passhash="baz")
-        response = handle_requests(request)
+        response = self.handle(request)
 
         self.assertEqual(response.result, True)
         self.assertEqual(response.users, ["foo"])
@@ -122,7 +168,7 @@ class TestServerProcessResponse(unittest.TestCase):
     def test2a_send_message(self):
         # send message between two users, check if it exists in the database
         request = chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="foo", recipient="bar", message="Hello, World!")
-        response = handle_requests(request)
+        response = self.handle(request)
 
         self.assertIsNotNone(response.message_id)
 
@@ -140,7 +186,7 @@ class TestServerProcessResponse(unittest.TestCase):
         # send many messages between two users, check if they exist in the database
         for i in range(1000):
             request = chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="foo", recipient="bar", message=f"Message {i}")
-            response = handle_requests(request)
+            response = self.handle(request)
 
             self.assertIsNotNone(response.message_id)
 
@@ -154,7 +200,7 @@ class TestServerProcessResponse(unittest.TestCase):
     def test3a_ping(self):
         # ping user, check if message is delivered
         request = chat_pb2.ChatRequest(action=chat_pb2.PING, sender="foo", sent_message="Hello, World!", message_id=1)
-        response = handle_requests(request)
+        response = self.handle(request)
 
         conn = sqlite3.connect("data/test_database.db")
         cursor = conn.cursor()
@@ -163,10 +209,21 @@ class TestServerProcessResponse(unittest.TestCase):
         self.assertEqual(count, 1)
         conn.close()
 
+    def test3ab_ack(self):
+        # acknowledge several messages at once, all are marked delivered
+        request = chat_pb2.ChatRequest(action=chat_pb2.ACK, message_ids=[2, 3])
+        self.handle(request)
+
+        conn = sqlite3.connect("data/test_database.db")
+        cursor = conn.cursor()
+        cursor.execute("SELECT message_id FROM messages WHERE sender='foo' AND delivered=1 ORDER BY message_id;")
+        self.assertEqual(cursor.fetchall(), [(1,), (2,), (3,)])
+        conn.close()
+
     def test3b_load_chat(self):
         # load chat between two users, check if messages are returned
         request = chat_pb2.ChatRequest(action=chat_pb2.LOAD_CHAT, username="foo", user2="bar")
-        response = handle_requests(request)
+        response = self.handle(request)
 
 
         # check to make sure response.messages is not empty
@@ -175,27 +232,66 @@ class TestServerProcessResponse(unittest.TestCase):
     def test3c_load_chat_empty(self):
         # check to make sure empty chat returns no messages
         request = chat_pb2.ChatRequest(action=chat_pb2.LOAD_CHAT, username="foo", user2="baz")
-        response = handle_requests(request)
+        response = self.handle(request)
         
         self.assertEqual(response.messages, [])
 
+    def test3d_load_chat_pages(self):
+        # page backwards through the 1001 messages between foo and bar
+        request = chat_pb2.ChatRequest(action=chat_pb2.LOAD_CHAT, username="bar", user2="foo", page_size=400)
+        response = self.handle(request)
+
+        ids = [m.message_id for m in response.messages]
+        self.assertEqual(len(ids), 400)
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(response.next_cursor, ids[0])
+
+        seen = list(ids)
+        while response.next_cursor:
+            request = chat_pb2.ChatRequest(
+                action=chat_pb2.LOAD_CHAT, username="bar", user2="foo", page_size=400, before_message_id=response.next_cursor
+            )
+            response = self.handle(request)
+            page = [m.message_id for m in response.messages]
+            self.assertLess(max(page), min(seen))
+            seen = page + seen
+
+        self.assertEqual(len(seen), 1001)
+        self.assertEqual(len(set(seen)), 1001)
+
+    def test3e_load_chat_default_page(self):
+        # without a page size the newest default-sized page is returned
+        request = chat_pb2.ChatRequest(action=chat_pb2.LOAD_CHAT, username="foo", user2="bar")
+        response = self.handle(request)
+
+        self.assertEqual(len(response.messages), 50)
+        self.assertEqual(response.messages[-1].message, "Message 999")
+        self.assertNotEqual(response.next_cursor, 0)
+
     def test4a_view_undelivered(self):
         # view undelivered messages, check if they are returned
         request = chat_pb2.ChatRequest(action=chat_pb2.VIEW_UNDELIVERED, username="bar", n_messages=10)
-        _ = handle_requests(request)
+        response = self.handle(request)
+
+        self.assertEqual(len(response.messages), 10)
+        self.assertEqual(response.messages[0].message, "Message 999")
 
-        # check if undelieverd are marked as delivered
+        # check that only the viewed messages are marked as delivered
+        # (1001 sent to bar, 3 already acknowledged)
         conn = sqlite3.connect("data/test_database.db")
         cursor = conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM messages WHERE recipient='bar' AND delivered=0;")
         count = cursor.fetchone()[0]
-        self.assertEqual(count, 0)
+        self.assertEqual(count, 988)
+        viewed = [m.message_id for m in response.messages]
+        cursor.execute(f"SELECT COUNT(*) FROM messages WHERE delivered=1 AND message_id IN ({','.join('?' * len(viewed))});", viewed)
+        self.assertEqual(cursor.fetchone()[0], 10)
         conn.close()
 
     def test5a_delete_message(self):
         # delete message, check if it is removed from the database
         request = chat_pb2.ChatRequest(action=chat_pb2.DELETE_MESSAGE, message_id=1)
-        _ = handle_requests(request)
+        self.handle(request)
 
         conn = sqlite3.connect("data/test_database.db")
         cursor = conn.cursor()
@@ -207,7 +303,7 @@ class TestServerProcessResponse(unittest.TestCase):
     def test5b_delete_account_invalid_pass(self):
         # delete account with invalid password, should return False
         request = chat_pb2.ChatRequest(action=chat_pb2.DELETE_ACCOUNT, username="foo", passhash="baz")
-        response = handle_requests(request)
+        response = self.handle(request)
 
         self.assertEqual(response.result, False)
 
@@ -225,7 +321,7 @@ class TestServerProcessResponse(unittest.TestCase):
     def test5c_delete_account_invalid_user(self):
         # delete account with invalid username, should return False
         request = chat_pb2.ChatRequest(action=chat_pb2.DELETE_ACCOUNT, username="baz", passhash="bar")
-        response = handle_requests(request)
+        response = self.handle(request)
 
         self.assertEqual(response.result, False)
 
@@ -239,7 +335,7 @@ class TestServerProcessResponse(unittest.TestCase):
     def test5d_delete_account(self):
         # delete account, check if it is removed from the database
         request = chat_pb2.ChatRequest(action=chat_pb2.DELETE_ACCOUNT, username="foo", passhash="bar")
-        response = handle_requests(request)
+        response = self.handle(request)
 
         self.assertEqual(response.result, True)
 
@@ -255,6 +351,1577 @@ class TestServerProcessResponse(unittest.TestCase):
         conn.close()
 
 
+class TestConnectionPool(unittest.TestCase):
+    '''
+    Tests the long-lived SQLite connection pool used by the server handlers.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, "pool.db")
+        structure_tables(self.db)
+        self.pool = ConnectionPool(self.db, size=2, health_check_interval=0)
+
+    def tearDown(self):
+        self.pool.close()
+        self.tmpdir.cleanup()
+
+    def test_same_thread_same_connection(self):
+        # a thread keeps its connection until it releases it
+        self.assertIs(self.pool.connection(), self.pool.connection())
+        self.pool.release()
+
+    def test_released_connection_is_reused(self):
+        # a connection released by one thread is handed to the next one
+        seen = []
+
+        def worker():
+            seen.append(self.pool.connection())
+            self.pool.release()
+
+        for _ in range(2):
+            t = threading.Thread(target=worker)
+            t.start()
+            t.join()
+
+        self.assertIs(seen[0], seen[1])
+
+    def test_unhealthy_connection_replaced(self):
+        # a closed connection on the idle stack is discarded, not handed out
+        conn = self.pool.connection()
+        self.pool.release()
+        conn.close()
+
+        new_conn = self.pool.connection()
+        self.assertIsNot(conn, new_conn)
+        self.assertEqual(new_conn.execute("SELECT COUNT(*) FROM users").fetchone()[0], 0)
+        self.pool.release()
+
+    def test_release_rolls_back(self):
+        # uncommitted work is not leaked to the next user of the connection
+        conn = self.pool.connection()
+        conn.execute("INSERT INTO users (username, passhash) VALUES ('a', 'b')")
+        self.pool.release()
+
+        conn = self.pool.connection()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM users").fetchone()[0], 0)
+        self.pool.release()
+
+    def test_closed_pool(self):
+        # idle connections are closed and no more can be checked out
+        self.pool.connection()
+        self.pool.release()
+        self.pool.close()
+        with self.assertRaises(RuntimeError):
+            self.pool.connection()
+
+
+class TestMigrations(unittest.TestCase):
+    '''
+    Tests upgrading databases in place with "migrations.py".
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, "legacy.db")
+
+        # database as created by the original setup.py, with a duplicate username
+        conn = sqlite3.connect(self.db)
+        conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT NOT NULL, passhash TEXT NOT NULL);")
+        conn.execute("CREATE TABLE messages (message_id INTEGER PRIMARY KEY, sender TEXT NOT NULL, recipient TEXT NOT NULL, message TEXT NOT NULL, delivered BOOLEAN DEFAULT 0, time DATETIME DEFAULT CURRENT_TIMESTAMP);")
+        conn.executemany("INSERT INTO users (username, passhash) VALUES (?, ?)", [("foo", "1"), ("bar", "2"), ("foo", "3")])
+        conn.execute("INSERT INTO messages (sender, recipient, message) VALUES ('foo', 'bar', 'hi')")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_upgrade_in_place(self):
+        self.assertEqual(migrate(self.db), LATEST_VERSION)
+
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(current_version(conn), LATEST_VERSION)
+
+        # oldest duplicate kept, existing messages untouched
+        self.assertEqual(conn.execute("SELECT passhash FROM users WHERE username='foo'").fetchall(), [("1",)])
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0], 1)
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO users (username, passhash) VALUES ('bar', 'x')")
+        conn.close()
+
+    def test_idempotent(self):
+        migrate(self.db)
+        self.assertEqual(migrate(self.db), LATEST_VERSION)
+
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0], LATEST_VERSION)
+        conn.close()
+
+    def test_concurrent_migrations(self):
+        # processes starting together apply every step once, none of them fails
+        errors = []
+
+        def run():
+            try:
+                self.assertEqual(migrate(self.db), LATEST_VERSION)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0], LATEST_VERSION)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0], 1)
+        conn.close()
+
+    def test_hot_paths_use_indexes(self):
+        migrate(self.db)
+        conn = sqlite3.connect(self.db)
+
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT COUNT(*) FROM messages WHERE recipient=? AND delivered=0", ("bar",)).fetchall()
+        self.assertIn("COVERING INDEX idx_messages_undelivered", str(plan))
+
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT sender, recipient, message, message_id FROM messages WHERE (sender=? AND recipient=?) OR (sender=? AND recipient=?) ORDER BY message_id",
+            ("foo", "bar", "bar", "foo"),
+        ).fetchall()
+        self.assertIn("idx_messages_conversation", str(plan))
+        conn.close()
+
+
+class TestMessageWriter(unittest.TestCase):
+    '''
+    Tests the group-commit writer used for SEND_MESSAGE.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, "writer.db")
+        structure_tables(self.db)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_concurrent_senders(self):
+        # messages from many threads all get distinct ids that match their rows
+        writer = MessageWriter(self.db, max_batch=16, max_wait_ms=20)
+        writer.start()
+        results = {}
+
+        def sender(i):
+            for j in range(25):
+                results[(i, j)] = writer.submit(f"user{i}", "bar", f"{i}-{j}").result()
+
+        threads = [threading.Thread(target=sender, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        writer.stop()
+
+        self.assertEqual(len(set(results.values())), 200)
+        # concurrent senders share commits
+        self.assertLess(writer.batches_committed, 200)
+
+        conn = sqlite3.connect(self.db)
+        for (i, j), message_id in results.items():
+            row = conn.execute("SELECT sender, message FROM messages WHERE message_id=?", (message_id,)).fetchone()
+            self.assertEqual(row, (f"user{i}", f"{i}-{j}"))
+        conn.close()
+
+    def test_batch_window(self):
+        # a full batch is committed together, even with a long window
+        writer = MessageWriter(self.db, max_batch=5, max_wait_ms=10000)
+        writer.start()
+        pending = [writer.submit("foo", "bar", str(i)) for i in range(5)]
+        ids = [f.result(timeout=5) for f in pending]
+        writer.stop()
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(writer.batches_committed, 1)
+
+    def test_submit_many(self):
+        # a batch larger than max_batch is still one transaction, ids in order
+        writer = MessageWriter(self.db, max_batch=2, max_wait_ms=0)
+        writer.start()
+        ids = writer.submit_many([("foo", "bar", str(i)) for i in range(5)]).result(timeout=5)
+        writer.stop()
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(writer.batches_committed, 1)
+        self.assertEqual(writer.messages_committed, 5)
+
+    def test_stop_flushes_pending(self):
+        # messages submitted before stop() are still written
+        writer = MessageWriter(self.db, max_batch=100, max_wait_ms=10000)
+        writer.start()
+        pending = [writer.submit("foo", "bar", str(i)) for i in range(3)]
+        writer.stop()
+
+        self.assertTrue(all(f.done() and f.result() for f in pending))
+        with self.assertRaises(RuntimeError):
+            writer.submit("foo", "bar", "late")
+
+    def test_dead_writer_fails_pending(self):
+        # an error escaping the loop fails every waiting sender instead of hanging them
+        writer = MessageWriter(self.db, max_batch=2, max_wait_ms=50)
+
+        def broken(conn, batch):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        writer._write = broken
+        pending = [writer.submit("foo", "bar", str(i)) for i in range(5)]
+        writer.start()
+        writer.join(timeout=5)
+
+        self.assertFalse(writer.is_alive())
+        for future in pending:
+            with self.assertRaises(sqlite3.OperationalError):
+                future.result(timeout=1)
+        with self.assertRaises(RuntimeError):
+            writer.submit("foo", "bar", "late")
+
+
+class TestAckBuffer(unittest.TestCase):
+    '''
+    Tests batching of delivery acknowledgements.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, "acks.db")
+        structure_tables(self.db)
+        conn = sqlite3.connect(self.db)
+        conn.executemany(
+            "INSERT INTO messages (sender, recipient, message) VALUES ('foo', 'bar', ?)",
+            [(str(i),) for i in range(1200)],
+        )
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def delivered(self):
+        conn = sqlite3.connect(self.db)
+        count = conn.execute("SELECT COUNT(*) FROM messages WHERE delivered=1").fetchone()[0]
+        conn.close()
+        return count
+
+    def test_flush(self):
+        # duplicate ids are only counted once, large batches are split across statements
+        acks = AckBuffer(self.db)
+        acks.add(range(1, 1101))
+        acks.add([1, 2, 3])
+        self.assertEqual(self.delivered(), 0)
+
+        self.assertEqual(acks.flush(), 1100)
+        self.assertEqual(self.delivered(), 1100)
+
+        # already delivered messages are not updated again
+        acks.add([1, 1101])
+        self.assertEqual(acks.flush(), 1)
+
+    def test_periodic_flush(self):
+        # the background thread writes pending acks on its own
+        acks = AckBuffer(self.db, flush_interval_ms=10)
+        acks.start()
+        acks.add([5, 6, 7])
+        for _ in range(100):
+            if self.delivered() == 3:
+                break
+            threading.Event().wait(0.01)
+        acks.stop()
+        self.assertEqual(self.delivered(), 3)
+
+    def test_stop_flushes(self):
+        acks = AckBuffer(self.db, flush_interval_ms=60000)
+        acks.start()
+        acks.add([9])
+        acks.stop()
+        self.assertEqual(self.delivered(), 1)
+
+
+class TestUndeliveredCounters(unittest.TestCase):
+    '''
+    Tests the in-memory undelivered counts and their summary table.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, "counts.db")
+        structure_tables(self.db)
+        self.conn = sqlite3.connect(self.db)
+        self.conn.executemany(
+            "INSERT INTO messages (sender, recipient, message, delivered) VALUES (?, ?, 'hi', ?)",
+            [("foo", "bar", 0), ("foo", "bar", 0), ("foo", "bar", 1), ("bar", "foo", 0)],
+        )
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmpdir.cleanup()
+
+    def summary(self):
+        return dict(self.conn.execute("SELECT username, n_undelivered FROM undelivered_counts").fetchall())
+
+    def test_rebuild(self):
+        counters = UndeliveredCounters()
+        counters.rebuild(self.conn)
+
+        self.assertEqual(counters.get("bar"), 2)
+        self.assertEqual(counters.get("foo"), 1)
+        self.assertEqual(counters.get("baz"), 0)
+        self.assertEqual(self.summary(), {"bar": 2, "foo": 1})
+
+    def test_changes_persisted(self):
+        counters = UndeliveredCounters()
+        counters.rebuild(self.conn)
+
+        counters.add("baz", 3)
+        counters.add("bar", -5)
+        counters.drop("foo")
+        self.assertEqual(counters.get("bar"), 0)
+
+        counters.persist(self.conn)
+        self.assertEqual(self.summary(), {"baz": 3})
+
+    def test_acks_decrement(self):
+        # flushing acks takes delivered messages off the recipients' counts
+        counters = UndeliveredCounters()
+        counters.rebuild(self.conn)
+
+        acks = AckBuffer(self.db, counters=counters)
+        acks.add([1, 3, 4])
+        self.assertEqual(acks.flush(), 2)
+
+        self.assertEqual(counters.get("bar"), 1)
+        self.assertEqual(counters.get("foo"), 0)
+        self.assertEqual(self.summary(), {"bar": 1})
+
+
+class TestUserDirectory(unittest.TestCase):
+    '''
+    Tests the cached user directory and its version-stamped deltas.
+    '''
+
+    def setUp(self):
+        self.directory = UserDirectory(max_changes=3)
+        self.directory.load(["foo", "bar"])
+
+    def test_snapshot(self):
+        users, version = self.directory.snapshot()
+        self.assertEqual(users, ("foo", "bar"))
+        self.assertIn("foo", self.directory)
+        self.assertNotIn("baz", self.directory)
+
+        # versions only go up
+        self.assertGreater(self.directory.add("baz"), version)
+        self.assertEqual(self.directory.snapshot()[0], ("foo", "bar", "baz"))
+
+    def test_delta(self):
+        _, version = self.directory.snapshot()
+        self.assertEqual(self.directory.delta(version), ([], [], version))
+
+        self.directory.add("baz")
+        self.directory.remove("foo")
+        added, removed, latest = self.directory.delta(version)
+        self.assertEqual((added, removed), (["baz"], ["foo"]))
+        self.assertEqual(latest, version + 2)
+
+        # a user added and removed again since the client's version is not sent
+        self.directory.add("qux")
+        self.directory.remove("qux")
+        self.assertEqual(self.directory.delta(latest)[:2], ([], []))
+
+    def test_stale_version(self):
+        _, version = self.directory.snapshot()
+        for name in ["a", "b", "c", "d"]:
+            self.directory.add(name)
+
+        # too many changes since the client's version, it needs the full list
+        self.assertIsNone(self.directory.delta(version))
+        # versions from an earlier server process are unknown
+        self.assertIsNone(self.directory.delta(1))
+        self.assertIsNone(self.directory.delta(self.directory.version + 1))
+
+
+class TestArchiver(unittest.TestCase):
+    '''
+    Tests for moving old delivered messages to the archive table.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, "archive.db")
+        self.store = create_store({"engine": "sqlite", "path": self.db, "write_batch_ms": 0})
+        self.ids = [self.store.send_message("foo", "bar", str(i)) for i in range(10)]
+        # the first 8 are delivered, and all but the last are a day old
+        self.store.mark_delivered(self.ids[:8])
+        self.store.flush()
+        conn = sqlite3.connect(self.db)
+        conn.execute("UPDATE messages SET time=datetime('now', '-1 day') WHERE message_id<?", (self.ids[-1],))
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def count(self, table):
+        conn = sqlite3.connect(self.db)
+        n = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        conn.close()
+        return n
+
+    def test_archive_in_chunks(self):
+        archiver = Archiver(self.db, max_age_s=3600, chunk_size=3, pause_ms=0)
+        self.assertEqual(archiver.archive(), 8)
+        self.assertEqual(self.count("messages_archive"), 8)
+        # undelivered and recent messages stay in the hot table
+        self.assertEqual(self.count("messages"), 2)
+        self.assertEqual(self.store.count_undelivered("bar"), 2)
+        # nothing left to do on the next run
+        self.assertEqual(archiver.archive(), 0)
+
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        conn.close()
+
+    def test_load_chat_reaches_archive(self):
+        Archiver(self.db, max_age_s=3600, pause_ms=0).archive()
+
+        page = self.store.load_chat("bar", "foo", limit=4)
+        self.assertEqual([row[3] for row in page], self.ids[:5:-1])
+        page = self.store.load_chat("foo", "bar", before_message_id=page[-1][3], limit=10)
+        self.assertEqual([row[3] for row in page], self.ids[5::-1])
+
+        # archived messages can still be deleted
+        self.store.delete_message(self.ids[0])
+        self.store.delete_account("bar")
+        self.assertEqual(self.count("messages_archive"), 0)
+
+    def test_ids_not_reused_after_archive(self):
+        # every message old and delivered, so the newest ids leave the hot table too
+        self.store.mark_delivered(self.ids)
+        self.store.flush()
+        conn = sqlite3.connect(self.db)
+        conn.execute("UPDATE messages SET time=datetime('now', '-1 day')")
+        conn.commit()
+        conn.close()
+        self.assertEqual(Archiver(self.db, max_age_s=3600, pause_ms=0).archive(), 10)
+        self.assertEqual(self.count("messages"), 0)
+
+        new_id = self.store.send_message("bar", "foo", "new")
+        self.assertGreater(new_id, max(self.ids))
+        page = self.store.load_chat("foo", "bar", limit=3)
+        self.assertEqual([row[3] for row in page], [new_id] + self.ids[:-3:-1])
+
+        # deleting the new message leaves the archive alone
+        self.store.delete_message(new_id)
+        self.assertEqual(self.count("messages_archive"), 10)
+
+
+class TestActionMetrics(unittest.TestCase):
+    '''
+    Tests for the per-action latency histograms.
+    '''
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.record(ms / 1000)
+        histogram.record(0.5, error=True)
+
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 101)
+        self.assertEqual(summary["errors"], 1)
+        self.assertEqual(summary["max_ms"], 500)
+        # reported as bucket upper bounds, at most one bucket (~19%) high
+        self.assertTrue(51 <= summary["p50_ms"] <= 51 * 1.19)
+        self.assertTrue(96 <= summary["p95_ms"] <= 96 * 1.19)
+        self.assertTrue(100 <= summary["p99_ms"] <= 100 * 1.19)
+
+    def test_time(self):
+        metrics = ActionMetrics()
+        with metrics.time("LOGIN"):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.time("LOGIN"):
+                raise ValueError()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["LOGIN"]["count"], 2)
+        self.assertEqual(snapshot["LOGIN"]["errors"], 1)
+
+    def test_wire_sizes(self):
+        # serialized sizes, not the Python object, so they grow with the message
+        wire = WireStats()
+        small = chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="foo", recipient="bar", message="hi")
+        large = chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="foo", recipient="bar", message="x" * 1000)
+        self.assertEqual(wire.record("in", small), small.ByteSize())
+        wire.record("in", large)
+        wire.record("out", chat_pb2.ChatResponse(action=chat_pb2.SEND_MESSAGE, message_id=1))
+
+        snapshot = wire.snapshot()
+        sent = snapshot["in"]["SEND_MESSAGE"]
+        self.assertEqual(sent["count"], 2)
+        self.assertEqual(sent["bytes"], small.ByteSize() + large.ByteSize())
+        self.assertEqual(sent["max"], large.ByteSize())
+        self.assertEqual(snapshot["out"]["SEND_MESSAGE"]["count"], 1)
+
+        # an action number the enum does not define is still counted
+        wire.record("in", chat_pb2.ChatRequest(action=99))
+        self.assertEqual(wire.snapshot()["in"]["UNKNOWN"]["count"], 1)
+
+
+class TestServerDispatch(unittest.TestCase):
+    '''
+    Tests the servicer's handler registry on the in-memory engine.
+    '''
+
+    def setUp(self):
+        self.servicer = ChatServiceServicer(store=create_store({"engine": "memory"}))
+        self.session = Session(queue.Queue())
+
+    def tearDown(self):
+        self.servicer.store.close()
+
+    def test_every_action_has_a_handler(self):
+        self.assertEqual(set(self.servicer.handlers), set(chat_pb2.Action.values()) - {chat_pb2.UNKNOWN})
+
+    def test_dispatch_timed_per_action(self):
+        self.servicer.dispatch(self.session, chat_pb2.ChatRequest(action=chat_pb2.CHECK_USERNAME, username="foo"))
+        self.assertTrue(self.session.queue.get_nowait().result)
+
+        # a failing handler is counted as an error and does not end the stream
+        self.servicer.store.send_message = None
+        self.servicer.dispatch(self.session, chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="foo", recipient="bar", message="hi"))
+        self.servicer.dispatch(self.session, chat_pb2.ChatRequest(action=chat_pb2.CHECK_USERNAME, username="foo"))
+
+        snapshot = self.servicer.metrics.snapshot()
+        self.assertEqual(snapshot["CHECK_USERNAME"]["count"], 2)
+        self.assertEqual(snapshot["CHECK_USERNAME"]["errors"], 0)
+        self.assertEqual(snapshot["SEND_MESSAGE"]["errors"], 1)
+
+    def test_load_chat_page_size_bounds(self):
+        for name, value in (("page_size_default", 3), ("page_size_max", 5)):
+            self.addCleanup(setattr, server, name, getattr(server, name))
+            setattr(server, name, value)
+        for i in range(10):
+            self.servicer.store.send_message("foo", "bar", str(i))
+
+        # 0 and negative sizes get the default page, larger ones are capped
+        for page_size, expected in ((0, 3), (-5, 3), (-1, 3), (-2**31, 3), (2, 2), (400, 5)):
+            self.servicer.dispatch(self.session, chat_pb2.ChatRequest(action=chat_pb2.LOAD_CHAT, username="foo", user2="bar", page_size=page_size))
+            response = self.session.queue.get_nowait()
+            self.assertEqual(len(response.messages), expected, page_size)
+        self.assertEqual(self.servicer.metrics.snapshot()["LOAD_CHAT"]["errors"], 0)
+
+    def test_request_id_echoed(self):
+        # pipelined sends, answered in any order, each matched by its id
+        for i, recipient in enumerate(["bar", "baz", "bar"], 1):
+            self.servicer.dispatch(self.session, chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="foo", recipient=recipient, message="hi", request_id=i))
+        responses = [self.session.queue.get_nowait() for _ in range(3)]
+        self.assertEqual([r.request_id for r in responses], [1, 2, 3])
+
+        # PINGs pushed to another user carry none
+        bar = Session(queue.Queue())
+        self.servicer.connect(bar, "bar")
+        self.servicer.dispatch(self.session, chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="foo", recipient="bar", message="hi", request_id=7))
+        self.assertEqual(self.session.queue.get_nowait().request_id, 7)
+        self.assertEqual(bar.queue.get_nowait().request_id, 0)
+
+    def test_send_messages(self):
+        bar = Session(queue.Queue())
+        self.servicer.connect(bar, "bar")
+        batch = [chat_pb2.ChatMessage(recipient=r, message=str(i)) for i, r in enumerate(["bar", "baz", "bar"])]
+        self.servicer.dispatch(self.session, chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGES, sender="foo", messages=batch))
+
+        response = self.session.queue.get_nowait()
+        self.assertTrue(response.result)
+        self.assertEqual(len(response.message_ids), 3)
+        self.assertEqual(list(response.message_ids), sorted(response.message_ids))
+
+        # one PING for both of bar's messages
+        ping = bar.queue.get_nowait()
+        self.assertEqual([(m.sender, m.message) for m in ping.messages], [("foo", "0"), ("foo", "2")])
+        self.assertEqual(ping.message_id, response.message_ids[2])
+        self.assertTrue(bar.queue.empty())
+        self.assertEqual(self.servicer.store.count_undelivered("baz"), 1)
+
+
+class TestOutboundQueue(unittest.TestCase):
+    '''
+    Tests the bounded outbound queue and its slow-consumer policies.
+    '''
+
+    def ping(self, message_id):
+        return chat_pb2.ChatResponse(action=chat_pb2.PING, message_id=message_id)
+
+    def drain(self, outbound):
+        responses = []
+        while len(outbound):
+            responses.append(outbound.get())
+        return responses
+
+    def test_finish_drains(self):
+        outbound = OutboundQueue(maxsize=10)
+        for i in range(1, 4):
+            outbound.put(self.ping(i))
+        outbound.finish()
+        # nothing is queued after the end of the stream
+        outbound.put(self.ping(4))
+
+        self.assertEqual([outbound.get().message_id for _ in range(3)], [1, 2, 3])
+        self.assertIsNone(outbound.get())
+        self.assertIsNone(outbound.get_nowait())
+
+    def test_drop_oldest(self):
+        stats = OutboundStats()
+        outbound = OutboundQueue(maxsize=3, policy="drop_oldest", stats=stats)
+        for i in range(1, 6):
+            outbound.put(self.ping(i))
+
+        self.assertEqual(stats.snapshot()["max_depth"], 3)
+        self.assertEqual([r.message_id for r in self.drain(outbound)], [3, 4, 5])
+        self.assertEqual(stats.dropped, 2)
+
+    def test_coalesce(self):
+        stats = OutboundStats()
+        outbound = OutboundQueue(maxsize=3, policy="coalesce", stats=stats)
+        outbound.put(chat_pb2.ChatResponse(action=chat_pb2.PING_USER, ping_user="foo"))
+        for i in range(1, 6):
+            outbound.put(self.ping(i))
+
+        responses = self.drain(outbound)
+        self.assertEqual([r.action for r in responses], [chat_pb2.PING_USER, chat_pb2.PING, chat_pb2.PING])
+        # one summary standing in for the first four PINGs, then the newest
+        self.assertEqual((responses[1].message_id, responses[1].n_undelivered), (0, 4))
+        self.assertEqual(responses[2].message_id, 5)
+        self.assertEqual((stats.coalesced, stats.dropped), (4, 0))
+
+    def test_block(self):
+        outbound = OutboundQueue(maxsize=1, policy="block", block_timeout=0.05)
+        outbound.put(self.ping(1))
+        # nobody reading, the sender gives up and the response is dropped
+        outbound.put(self.ping(2))
+        self.assertEqual(outbound.stats.dropped, 1)
+
+        # a reader makes room for a waiting sender
+        reader = threading.Timer(0.01, outbound.get)
+        reader.start()
+        outbound.block_timeout = 5
+        outbound.put(self.ping(3))
+        reader.join()
+        self.assertEqual([r.message_id for r in self.drain(outbound)], [3])
+
+    def test_disconnect(self):
+        outbound = OutboundQueue(maxsize=2, policy="disconnect")
+        for i in range(1, 4):
+            outbound.put(self.ping(i))
+
+        self.assertTrue(outbound.overflowed)
+        self.assertIsNone(outbound.get())
+        self.assertEqual(outbound.stats.snapshot()["disconnected"], 1)
+
+
+class TestPresenceRegistry(unittest.TestCase):
+    '''
+    Tests the registry of connected users.
+    '''
+
+    def setUp(self):
+        self.presence = PresenceRegistry(stripes=4)
+
+    def test_add_remove(self):
+        first, second = object(), object()
+        self.assertIsNone(self.presence.add("foo", first))
+        self.assertIs(self.presence.add("foo", second), first)
+        self.assertIs(self.presence.get("foo"), second)
+
+        # the old stream ending does not log out the new one
+        self.assertFalse(self.presence.remove("foo", first))
+        self.assertIn("foo", self.presence)
+        self.assertTrue(self.presence.remove("foo", second))
+        self.assertNotIn("foo", self.presence)
+        self.assertIsNone(self.presence.get("foo"))
+
+    def test_snapshot(self):
+        sessions = {f"user{i}": object() for i in range(10)}
+        for username, session in sessions.items():
+            self.presence.add(username, session)
+
+        snapshot = self.presence.snapshot()
+        self.assertCountEqual(snapshot, sessions.values())
+        # unchanged registry, same tuple
+        self.assertIs(self.presence.snapshot(), snapshot)
+
+        self.presence.remove("user3")
+        self.assertEqual(len(self.presence.snapshot()), 9)
+        # an old snapshot is unaffected by later changes
+        self.assertEqual(len(snapshot), 10)
+
+    def test_concurrent_connects_and_broadcasts(self):
+        errors = []
+
+        def churn(i):
+            for j in range(200):
+                session = object()
+                self.presence.add(f"user{i}-{j % 5}", session)
+                self.presence.remove(f"user{i}-{(j + 3) % 5}")
+
+        def broadcast():
+            try:
+                for _ in range(500):
+                    for session in self.presence.snapshot():
+                        pass
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=churn, args=(i,)) for i in range(8)]
+        threads += [threading.Thread(target=broadcast) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        expected = sum(1 for i in range(8) for k in range(5) if f"user{i}-{k}" in self.presence)
+        self.assertEqual(len(self.presence.snapshot()), expected)
+
+
+class TestFanoutEngine(unittest.TestCase):
+    '''
+    Tests delivering broadcasts to every connected session.
+    '''
+
+    def setUp(self):
+        self.presence = PresenceRegistry(stripes=4)
+        self.queues = [queue.Queue() for _ in range(50)]
+        for i, q in enumerate(self.queues):
+            self.presence.add(f"user{i}", Session(q))
+        self.fanout = FanoutEngine(self.presence, workers=3, chunk_size=8, max_batch=4)
+        self.fanout.start()
+
+    def tearDown(self):
+        self.fanout.stop()
+
+    def test_broadcast_in_order(self):
+        for i in range(10):
+            self.fanout.broadcast(chat_pb2.ChatResponse(action=chat_pb2.PING_USER, ping_user=f"new{i}"))
+        self.fanout.flush()
+
+        for q in self.queues:
+            self.assertEqual([q.get_nowait().ping_user for _ in range(q.qsize())], [f"new{i}" for i in range(10)])
+
+        snapshot = self.fanout.snapshot()
+        self.assertEqual((snapshot["events"], snapshot["deliveries"], snapshot["count"]), (10, 500, 10))
+
+    def test_register_does_not_wait_for_broadcast(self):
+        servicer = ChatServiceServicer(store=create_store({"engine": "memory"}))
+        self.addCleanup(servicer.store.close)
+        self.addCleanup(servicer.fanout.stop)
+        slow = threading.Event()
+        blocked = Session(queue.Queue())
+        blocked.put = lambda response: slow.wait(5)
+        servicer.presence.add("slow", blocked)
+
+        session = Session(queue.Queue())
+        servicer.dispatch(session, chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username="foo", passhash="p"))
+        # answered while the broadcast is still stuck on the slow session
+        self.assertTrue(session.queue.get_nowait().result)
+        slow.set()
+        servicer.fanout.flush()
+        self.assertEqual(session.queue.get_nowait().ping_user, "foo")
+
+
+class TestAuthPool(unittest.TestCase):
+    '''
+    Tests salted password hashing, legacy hash upgrades and the pending limit.
+    '''
+
+    def test_salted_hash(self):
+        first, second = hash_password("secret", 1000), hash_password("secret", 1000)
+        # same password, different salts
+        self.assertNotEqual(first, second)
+        self.assertTrue(first.startswith("pbkdf2_sha256$1000$"))
+        self.assertTrue(verify_password("secret", first))
+        self.assertFalse(verify_password("wrong", first))
+
+    def test_legacy_hash_upgraded_on_login(self):
+        store = create_store({"engine": "memory"})
+        store.create_user("foo", hashlib.sha256(b"bar").hexdigest())
+        servicer = ChatServiceServicer(store=store, auth=AuthPool(workers=0, iterations=1000))
+        self.addCleanup(servicer.fanout.stop)
+
+        session = Session(queue.Queue())
+        servicer.dispatch(session, chat_pb2.ChatRequest(action=chat_pb2.LOGIN, username="foo", passhash="baz"))
+        self.assertFalse(session.queue.get_nowait().result)
+        servicer.dispatch(session, chat_pb2.ChatRequest(action=chat_pb2.LOGIN, username="foo", passhash="bar"))
+        self.assertTrue(session.queue.get_nowait().result)
+
+        stored = store.get_passhash("foo")
+        self.assertTrue(stored.startswith("pbkdf2_sha256$1000$"))
+        self.assertTrue(verify_password("bar", stored))
+
+    def test_timeout_refuses_request(self):
+        # a hash that takes too long is a failed REGISTER, not a request left unanswered
+        auth = AuthPool(workers=1, iterations=300_000, timeout=0.01)
+        self.addCleanup(auth.close)
+        servicer = ChatServiceServicer(store=create_store({"engine": "memory"}), auth=auth)
+        self.addCleanup(servicer.fanout.stop)
+
+        session = Session(queue.Queue())
+        servicer.dispatch(session, chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username="foo", passhash="p"))
+        self.assertFalse(session.queue.get_nowait().result)
+
+    def test_broken_pool_replaced(self):
+        auth = AuthPool(workers=1, iterations=1000)
+        self.addCleanup(auth.close)
+        auth.hash("warm up")
+        for process in list(auth._pool._processes.values()):
+            process.kill()
+            process.join()
+
+        with self.assertRaises(AuthUnavailable):
+            auth.hash("p")
+        # a new pool takes over
+        self.assertTrue(verify_password("p", auth.hash("p")))
+
+    def test_max_pending(self):
+        auth = AuthPool(workers=1, iterations=1000, max_pending=1)
+        self.addCleanup(auth.close)
+        slow = threading.Thread(target=auth._run, args=(hash_password, "p", 3_000_000))
+        slow.start()
+        deadline = time.monotonic() + 5
+        while auth.snapshot()["pending"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+        with self.assertRaises(AuthBusy):
+            auth.hash("other")
+        slow.join()
+        self.assertEqual(auth.snapshot(), {"pending": 0, "rejected": 1})
+        # room again once the slow hash is done
+        self.assertTrue(verify_password("other", auth.hash("other")))
+
+
+class TestSessionResume(unittest.TestCase):
+    '''
+    Tests resuming a dropped stream with a session token and replaying missed PINGs.
+    '''
+
+    def setUp(self):
+        self.servicer = ChatServiceServicer(store=create_store({"engine": "memory"}), auth=AuthPool(workers=0, iterations=1000))
+        self.addCleanup(self.servicer.fanout.stop)
+        self.servicer.tokens = SessionTokens(replay_size=3)
+
+        self.foo = Session(queue.Queue())
+        self.servicer.dispatch(self.foo, chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username="foo", passhash="p"))
+        self.token = self.foo.queue.get_nowait().session_token
+        self.bar = Session(queue.Queue())
+        self.servicer.dispatch(self.bar, chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username="bar", passhash="p"))
+        self.servicer.fanout.flush()
+        # drop the REGISTER responses and PING_USERs
+        for session in (self.foo, self.bar):
+            while not session.queue.empty():
+                session.queue.get_nowait()
+
+    def send(self, message):
+        self.servicer.dispatch(self.bar, chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="bar", recipient="foo", message=message))
+        return self.bar.queue.get_nowait().message_id
+
+    def resume(self, last_seq):
+        session = Session(queue.Queue())
+        self.servicer.dispatch(session, chat_pb2.ChatRequest(action=chat_pb2.RESUME, session_token=self.token, last_seq=last_seq))
+        return session, [session.queue.get_nowait() for _ in range(session.queue.qsize())]
+
+    def test_resume_replays_missed(self):
+        self.assertTrue(self.token)
+        self.send("seen")
+        seen = self.foo.queue.get_nowait().seq
+        self.send("lost in the queue")
+        # the stream drops
+        self.assertTrue(self.servicer.disconnect("foo", self.foo))
+        self.send("while away")
+
+        session, responses = self.resume(seen)
+        self.assertEqual((responses[0].action, responses[0].result, responses[0].n_undelivered), (chat_pb2.RESUME, True, 3))
+        self.assertEqual([r.sent_message for r in responses[1:]], ["lost in the queue", "while away"])
+
+        # and live again
+        self.send("back")
+        self.assertEqual(session.queue.get_nowait().sent_message, "back")
+
+    def test_resume_overflowed(self):
+        self.servicer.disconnect("foo", self.foo)
+        for i in range(5):
+            self.send(f"m{i}")
+        _, responses = self.resume(0)
+        self.assertEqual([r.sent_message for r in responses[1:4]], ["m2", "m3", "m4"])
+        # a summary for the ones pushed out of the buffer
+        self.assertEqual((responses[4].message_id, responses[4].n_undelivered), (0, 5))
+
+    def test_replay_by_seq_not_message_id(self):
+        # sharded message ids do not grow across conversations
+        tokens = SessionTokens()
+        tokens.issue("foo")
+        with tokens.lock("foo"):
+            tokens.record("foo", chat_pb2.ChatResponse(action=chat_pb2.PING, message_id=122))
+            for message_id in (4, 126, 8, 7, 5):
+                tokens.record("foo", chat_pb2.ChatResponse(action=chat_pb2.PING, message_id=message_id))
+            missed, complete = tokens.replay("foo", 1)
+        self.assertTrue(complete)
+        self.assertEqual([r.message_id for r in missed], [4, 126, 8, 7, 5])
+        self.assertEqual([r.seq for r in missed], [2, 3, 4, 5, 6])
+
+    def test_resume_invalid(self):
+        self.token = "not a token"
+        _, responses = self.resume(0)
+        self.assertEqual((responses[0].action, responses[0].result), (chat_pb2.RESUME, False))
+
+        # revoked with the account
+        self.token = self.servicer.tokens.issue("foo")
+        self.servicer.dispatch(self.foo, chat_pb2.ChatRequest(action=chat_pb2.DELETE_ACCOUNT, username="foo", passhash="p"))
+        _, responses = self.resume(0)
+        self.assertFalse(responses[0].result)
+
+    def test_token_expires_after_disconnect(self):
+        self.servicer.tokens.ttl_s = 0
+        self.assertEqual(self.servicer.tokens.resolve(self.token), "foo")
+        self.servicer.disconnect("foo", self.foo)
+        time.sleep(0.01)
+        self.assertIsNone(self.servicer.tokens.resolve(self.token))
+        self.assertEqual(self.servicer.tokens.prune(), 1)
+
+
+class TestBroker(unittest.TestCase):
+    '''
+    Tests routing PINGs and broadcasts between servicers of different worker processes.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        socket_path = os.path.join(self.tmpdir.name, "broker.sock")
+        self.broker = Broker(socket_path)
+        self.broker.start()
+        self.addCleanup(self.broker.stop)
+
+        # two servicers standing in for two worker processes
+        self.workers = []
+        for _ in range(2):
+            servicer = ChatServiceServicer(store=create_store({"engine": "memory"}), max_changes=0)
+            servicer.router = BrokerClient(socket_path, servicer.deliver_local, servicer.broadcast_local)
+            self.addCleanup(servicer.store.close)
+            self.addCleanup(servicer.fanout.stop)
+            self.addCleanup(servicer.router.close)
+            self.workers.append(servicer)
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_route_to_other_worker(self):
+        first, second = self.workers
+        bar = Session(queue.Queue())
+        second.connect(bar, "bar")
+        self.wait_for(lambda: "bar" in self.broker.owners)
+
+        session = Session(queue.Queue())
+        first.dispatch(session, chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="foo", recipient="bar", message="hi"))
+        self.assertEqual(session.queue.get_nowait().action, chat_pb2.SEND_MESSAGE)
+
+        ping = bar.queue.get(timeout=5)
+        self.assertEqual((ping.action, ping.sender, ping.sent_message), (chat_pb2.PING, "foo", "hi"))
+        # counted once the frame is forwarded, which can be after it arrives
+        self.wait_for(lambda: self.broker.routed == 1)
+
+        # gone from the broker once the stream ends
+        self.assertTrue(second.disconnect("bar", bar))
+        self.wait_for(lambda: "bar" not in self.broker.owners)
+
+    def test_routed_counted_across_workers(self):
+        # both workers route at once, every forwarded frame is counted
+        first, second = self.workers
+        foo, bar = Session(queue.Queue()), Session(queue.Queue())
+        first.connect(foo, "foo")
+        second.connect(bar, "bar")
+        self.wait_for(lambda: {"foo", "bar"} <= set(self.broker.owners))
+
+        def send(servicer, username):
+            for i in range(200):
+                servicer.deliver(username, chat_pb2.ChatResponse(action=chat_pb2.PING, message_id=i + 1))
+
+        threads = [threading.Thread(target=send, args=args) for args in ((first, "bar"), (second, "foo"))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.wait_for(lambda: foo.queue.qsize() == 200 and bar.queue.qsize() == 200)
+        self.wait_for(lambda: self.broker.routed == 400)
+
+    def test_stale_offline_keeps_newer_login(self):
+        first, second = self.workers
+        old, new = Session(queue.Queue()), Session(queue.Queue())
+        first.connect(old, "bar")
+        self.wait_for(lambda: "bar" in self.broker.owners)
+        first_conn = self.broker.owners["bar"]
+        second.connect(new, "bar")
+        # the old stream ending after the user moved to the second worker
+        first.disconnect("bar", old)
+        self.wait_for(lambda: self.broker.owners.get("bar") not in (None, first_conn))
+
+        first.deliver("bar", chat_pb2.ChatResponse(action=chat_pb2.PING, message_id=1))
+        self.assertEqual(new.queue.get(timeout=5).message_id, 1)
+
+    def test_broadcast_updates_other_directory(self):
+        first, second = self.workers
+        watcher = Session(queue.Queue())
+        second.connect(watcher, "watcher")
+
+        session = Session(queue.Queue())
+        first.dispatch(session, chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username="foo", passhash="p"))
+
+        ping = watcher.queue.get(timeout=5)
+        self.assertEqual((ping.action, ping.ping_user), (chat_pb2.PING_USER, "foo"))
+        self.assertIn("foo", second.directory)
+        self.assertEqual(ping.users_version, second.directory.version)
+
+    def test_uncached_counts_shared_file(self):
+        path = os.path.join(self.tmpdir.name, "shared.db")
+        writer = create_store({"path": path, "cache_counts": False})
+        reader = create_store({"path": path, "cache_counts": False})
+        self.addCleanup(writer.close)
+        self.addCleanup(reader.close)
+
+        writer.send_message("foo", "bar", "hi")
+        self.assertEqual(reader.count_undelivered("bar"), 1)
+        self.assertEqual(len(reader.view_undelivered("bar", 10)), 1)
+        self.assertEqual(writer.count_undelivered("bar"), 0)
+
+
+class TestUnaryCalls(unittest.TestCase):
+    '''
+    Tests the CheckUsername, Login and LoadChat unary RPCs next to the Chat stream.
+    '''
+
+    def setUp(self):
+        self.servicer = ChatServiceServicer(store=create_store({"engine": "memory"}), auth=AuthPool(workers=0, iterations=1000))
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(self.servicer, self.server)
+        port = self.server.add_insecure_port("127.0.0.1:0")
+        self.server.start()
+        self.channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+
+        for username in ("foo", "bar"):
+            session = Session(queue.Queue())
+            self.servicer.dispatch(session, chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username=username, passhash="p"))
+            self.servicer.disconnect(username, session)
+        for i in range(5):
+            self.servicer.store.send_message("bar", "foo", f"m{i}")
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+        self.servicer.fanout.stop()
+        self.servicer.store.close()
+
+    def test_check_username_and_login(self):
+        self.assertFalse(self.stub.CheckUsername(chat_pb2.ChatRequest(username="foo"), timeout=5).result)
+        self.assertTrue(self.stub.CheckUsername(chat_pb2.ChatRequest(username="new"), timeout=5).result)
+
+        self.assertFalse(self.stub.Login(chat_pb2.ChatRequest(username="foo", passhash="x"), timeout=5).result)
+        response = self.stub.Login(chat_pb2.ChatRequest(username="foo", passhash="p"), timeout=5)
+        self.assertEqual((response.action, response.result, response.n_undelivered, list(response.users)), (chat_pb2.LOGIN, True, 5, ["bar"]))
+        # no stream to deliver to until it is attached
+        self.assertNotIn("foo", self.servicer.presence)
+        self.assertEqual(self.servicer.metrics.snapshot()["LOGIN"]["count"], 2)
+        self.assertEqual(self.servicer.wire.snapshot()["out"]["LOGIN"]["count"], 2)
+
+        # attach the stream with the token, PINGs are pushed on it
+        requests = queue.Queue()
+        responses = self.stub.Chat(iter(requests.get, None))
+        requests.put(chat_pb2.ChatRequest(action=chat_pb2.RESUME, session_token=response.session_token))
+        self.assertTrue(next(responses).result)
+        self.servicer.dispatch(Session(queue.Queue()), chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="bar", recipient="foo", message="hi"))
+        self.assertEqual(next(responses).sent_message, "hi")
+        requests.put(None)
+
+    def test_load_chat_in_parallel(self):
+        calls = [
+            self.stub.LoadChat.future(chat_pb2.ChatRequest(username="foo", user2="bar", page_size=2), timeout=5)
+            for _ in range(20)
+        ]
+        for call in calls:
+            response = call.result()
+            self.assertEqual([m.message for m in response.messages], ["m3", "m4"])
+
+        older = self.stub.LoadChat(chat_pb2.ChatRequest(username="foo", user2="bar", page_size=2, before_message_id=response.next_cursor), timeout=5)
+        self.assertEqual([m.message for m in older.messages], ["m1", "m2"])
+
+    def test_handler_error_status(self):
+        # the store failing makes the handler raise
+        self.servicer.store.load_chat = None
+        with self.assertRaises(grpc.RpcError) as e:
+            self.stub.LoadChat(chat_pb2.ChatRequest(username="foo", user2="bar"), timeout=5)
+        self.assertEqual(e.exception.code(), grpc.StatusCode.INTERNAL)
+
+
+class TestCompression(unittest.TestCase):
+    '''
+    Tests that only responses above the size threshold are compressed.
+    '''
+
+    def setUp(self):
+        self.servicer = ChatServiceServicer(store=create_store({"engine": "memory"}), auth=AuthPool(workers=0, iterations=1000), compression="gzip", compression_min_bytes=512)
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(self.servicer, self.server)
+        self.port = self.server.add_insecure_port("127.0.0.1:0")
+        self.server.start()
+        self.channel = grpc.insecure_channel(f"127.0.0.1:{self.port}")
+        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+
+        for username in ("foo", "bar"):
+            session = Session(queue.Queue())
+            self.servicer.dispatch(session, chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username=username, passhash="p"))
+            self.servicer.disconnect(username, session)
+        for i in range(20):
+            self.servicer.store.send_message("bar", "foo", f"message {i} " * 10)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+        self.servicer.fanout.stop()
+        self.servicer.store.close()
+
+    def test_unary_threshold(self):
+        page = self.stub.LoadChat(chat_pb2.ChatRequest(username="foo", user2="bar"), timeout=5)
+        self.assertEqual(len(page.messages), 20)
+        self.stub.CheckUsername(chat_pb2.ChatRequest(username="foo"), timeout=5)
+
+        out = self.servicer.wire.snapshot()["out"]
+        self.assertEqual(out["LOAD_CHAT"]["compressed"], 1)
+        self.assertEqual(out["CHECK_USERNAME"]["compressed"], 0)
+
+    def test_compressed_on_the_wire(self):
+        # bytes counted on the socket, so this is what gRPC really sent
+        relay = Relay(self.port)
+        relay.start()
+        self.addCleanup(relay.close)
+        channel = grpc.insecure_channel(f"127.0.0.1:{relay.port}")
+        self.addCleanup(channel.close)
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        stub.CheckUsername(chat_pb2.ChatRequest(username="foo"), timeout=5)
+
+        before = relay.to_client
+        page = stub.LoadChat(chat_pb2.ChatRequest(username="foo", user2="bar"), timeout=5)
+        self.assertLess(relay.to_client - before, page.ByteSize() / 2)
+
+    def test_stream_threshold(self):
+        requests = queue.Queue()
+        responses = self.stub.Chat(iter(requests.get, None))
+        requests.put(chat_pb2.ChatRequest(action=chat_pb2.LOGIN, username="foo", passhash="p"))
+        self.assertTrue(next(responses).result)
+        requests.put(chat_pb2.ChatRequest(action=chat_pb2.VIEW_UNDELIVERED, username="foo", n_messages=20))
+        self.assertEqual(len(next(responses).messages), 20)
+        self.servicer.dispatch(Session(queue.Queue()), chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="bar", recipient="foo", message="hi"))
+        self.assertEqual(next(responses).sent_message, "hi")
+        requests.put(None)
+        # each response is counted once the stream moves past it
+        self.assertEqual(list(responses), [])
+
+        out = self.servicer.wire.snapshot()["out"]
+        self.assertEqual(out["VIEW_UNDELIVERED"]["compressed"], 1)
+        self.assertEqual(out["PING"]["compressed"], 0)
+        self.assertEqual(out["LOGIN"]["compressed"], 0)
+
+class TestStreamLimits(unittest.TestCase):
+    '''
+    Tests the threaded server beyond ten clients and at its stream limit.
+    '''
+
+    def setUp(self):
+        self.servicer = ChatServiceServicer(store=create_store({"engine": "memory"}), max_streams=12)
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=16), maximum_concurrent_rpcs=16)
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(self.servicer, self.server)
+        port = self.server.add_insecure_port("127.0.0.1:0")
+        self.server.start()
+        self.channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+        self.servicer.store.close()
+
+    def open_stream(self, username):
+        requests = queue.Queue()
+        requests.put(chat_pb2.ChatRequest(action=chat_pb2.CHECK_USERNAME, username=username))
+        responses = self.stub.Chat(iter(requests.get, None))
+        return requests, responses
+
+    def test_limit(self):
+        streams = [self.open_stream(f"user{i}") for i in range(12)]
+        for requests, responses in streams:
+            self.assertEqual(next(responses).action, chat_pb2.CHECK_USERNAME)
+        self.assertEqual(self.servicer.open_streams, 12)
+
+        # the 13th is refused with a clear status instead of hanging
+        requests, responses = self.open_stream("user12")
+        with self.assertRaises(grpc.RpcError) as refused:
+            next(responses)
+        self.assertEqual(refused.exception.code(), grpc.StatusCode.RESOURCE_EXHAUSTED)
+        self.assertIn("12 chats", refused.exception.details())
+
+        # closing a stream frees its place
+        requests, responses = streams.pop()
+        requests.put(None)
+        self.assertEqual(list(responses), [])
+        requests, responses = self.open_stream("user12")
+        self.assertTrue(next(responses).result)
+
+        for requests, responses in streams + [(requests, responses)]:
+            requests.put(None)
+            list(responses)
+        self.assertEqual(self.servicer.open_streams, 0)
+
+
+class TestStreamLifecycle(unittest.TestCase):
+    '''
+    Tests that closed and idle streams give back their threads and queues.
+    '''
+
+    def setUp(self):
+        self.servicer = ChatServiceServicer(store=create_store({"engine": "memory"}))
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(self.servicer, self.server)
+        port = self.server.add_insecure_port("127.0.0.1:0")
+        self.server.start()
+        self.channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+        self.servicer.store.close()
+
+    def open_stream(self):
+        requests = queue.Queue()
+        requests.put(chat_pb2.ChatRequest(action=chat_pb2.CHECK_USERNAME, username="foo"))
+        responses = self.stub.Chat(iter(requests.get, None))
+        self.assertEqual(next(responses).action, chat_pb2.CHECK_USERNAME)
+        return requests, responses
+
+    def wait_for_streams(self, n):
+        for _ in range(200):
+            if self.servicer.open_streams == n:
+                return
+            time.sleep(0.01)
+        self.fail(f"{self.servicer.open_streams} streams open, expected {n}")
+
+    def reader_threads(self):
+        return sum(1 for t in threading.enumerate() if t.name == "chat-requests")
+
+    def test_cancelled_stream_torn_down(self):
+        streams = [self.open_stream() for _ in range(4)]
+        self.assertEqual(self.servicer.open_streams, 4)
+        self.assertEqual(self.reader_threads(), 4)
+
+        # the client goes away without closing its request stream
+        for requests, responses in streams:
+            responses.cancel()
+        self.wait_for_streams(0)
+        time.sleep(0.05)
+        self.assertEqual(self.reader_threads(), 0)
+
+        snapshot = self.servicer.stream_snapshot()
+        self.assertEqual((snapshot["live"], snapshot["leaked"], snapshot["closed"]), (0, 0, 4))
+
+    def test_idle_stream_reaped(self):
+        idle_timeout = server.stream_idle_timeout
+        server.stream_idle_timeout = 0.05
+        self.addCleanup(setattr, server, "stream_idle_timeout", idle_timeout)
+
+        requests, responses = self.open_stream()
+        self.assertEqual(self.servicer.reap_streams(), (0, 0))
+        time.sleep(0.1)
+        self.assertEqual(self.servicer.reap_streams(), (1, 0))
+
+        # the server ends the stream, the client sees it finish
+        self.assertEqual(list(responses), [])
+        self.wait_for_streams(0)
+        self.assertEqual(self.servicer.stream_snapshot()["reaped"], 1)
+
+    def test_unknown_action_keeps_stream(self):
+        requests = queue.Queue()
+        responses = self.stub.Chat(iter(requests.get, None))
+        requests.put(chat_pb2.ChatRequest(action=99))
+        requests.put(chat_pb2.ChatRequest(action=chat_pb2.CHECK_USERNAME, username="foo", request_id=2))
+        response = next(responses)
+        self.assertEqual((response.action, response.request_id), (chat_pb2.CHECK_USERNAME, 2))
+        requests.put(None)
+        self.assertEqual(list(responses), [])
+
+    def test_half_closed_stream_gets_every_response(self):
+        # a client that sends its requests and closes its side still reads every reply
+        for _ in range(20):
+            requests = [chat_pb2.ChatRequest(action=chat_pb2.CHECK_USERNAME, username=f"user{i}", request_id=i) for i in range(1, 6)]
+            responses = list(self.stub.Chat(iter(requests), timeout=5))
+            self.assertEqual([r.request_id for r in responses], [1, 2, 3, 4, 5])
+        self.wait_for_streams(0)
+
+
+class TestAioServer(unittest.IsolatedAsyncioTestCase):
+    '''
+    Tests the grpc.aio server end to end on the in-memory engine.
+    '''
+
+    async def asyncSetUp(self):
+        self.servicer = AioChatServiceServicer(store=create_store({"engine": "memory"}), max_workers=2, auth=AuthPool(workers=0, iterations=1000))
+        self.server = grpc.aio.server()
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(self.servicer, self.server)
+        port = self.server.add_insecure_port("127.0.0.1:0")
+        await self.server.start()
+        self.channel = grpc.aio.insecure_channel(f"127.0.0.1:{port}")
+        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+
+    async def asyncTearDown(self):
+        await self.channel.close()
+        await self.server.stop(0)
+        self.servicer.executor.shutdown()
+        self.servicer.store.close()
+
+    def open_stream(self):
+        requests = asyncio.Queue()
+
+        async def send():
+            while (req := await requests.get()) is not None:
+                yield req
+
+        return requests, self.stub.Chat(send())
+
+    async def test_unary_calls(self):
+        self.servicer.store.create_user("foo", hash_password("p", 1000))
+        self.servicer.directory.add("foo")
+        check, login = await asyncio.gather(
+            self.stub.CheckUsername(chat_pb2.ChatRequest(username="foo"), timeout=5),
+            self.stub.Login(chat_pb2.ChatRequest(username="foo", passhash="p"), timeout=5),
+        )
+        self.assertFalse(check.result)
+        self.assertTrue(login.result)
+        self.assertTrue(login.session_token)
+        chat = await self.stub.LoadChat(chat_pb2.ChatRequest(username="foo", user2="bar"), timeout=5)
+        self.assertEqual(len(chat.messages), 0)
+
+    async def test_own_stream_limit(self):
+        # not the threaded server's limit, which is sized by its worker threads
+        self.assertEqual(self.servicer.max_streams, aio_server.aio_max_streams)
+        limited = AioChatServiceServicer(store=self.servicer.store, max_workers=1, max_streams=5, auth=self.servicer.auth)
+        self.assertEqual(limited.max_streams, 5)
+        limited.fanout.stop()
+        limited.executor.shutdown()
+
+    async def test_half_closed_stream(self):
+        requests = [chat_pb2.ChatRequest(action=chat_pb2.CHECK_USERNAME, username=f"user{i}", request_id=i) for i in range(1, 6)]
+        responses = [r async for r in self.stub.Chat(iter(requests), timeout=5)]
+        self.assertEqual([r.request_id for r in responses], [1, 2, 3, 4, 5])
+
+    async def test_many_streams(self):
+        # far more streams than handler threads, idle streams hold no thread
+        streams = [self.open_stream() for _ in range(50)]
+        for i, (requests, call) in enumerate(streams):
+            await requests.put(chat_pb2.ChatRequest(action=chat_pb2.REGISTER, username=f"user{i}", passhash="p"))
+        for i, (requests, call) in enumerate(streams):
+            response = await call.read()
+            self.assertEqual(response.action, chat_pb2.REGISTER)
+            self.assertTrue(response.result)
+
+        # a message reaches the recipient's stream as a PING
+        requests, call = streams[0]
+        await requests.put(chat_pb2.ChatRequest(action=chat_pb2.SEND_MESSAGE, sender="user0", recipient="user49", message="hi"))
+        while (response := await call.read()).action != chat_pb2.SEND_MESSAGE:
+            pass
+        recipient = streams[49][1]
+        while (ping := await recipient.read()).action != chat_pb2.PING:
+            pass
+        self.assertEqual((ping.sender, ping.sent_message, ping.message_id), ("user0", "hi", response.message_id))
+
+        # closing the request side ends the response stream
+        for requests, call in streams:
+            await requests.put(None)
+        for requests, call in streams:
+            while await call.read() != grpc.aio.EOF:
+                pass
+
+
+class MessageStoreTests:
+    '''
+    Behaviour every MessageStore engine must share, mixed into one TestCase per engine.
+    '''
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.assertTrue(self.store.create_user("foo", "h1"))
+        self.assertTrue(self.store.create_user("bar", "h2"))
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_users(self):
+        self.assertFalse(self.store.create_user("foo", "other"))
+        self.assertEqual(self.store.get_passhash("foo"), "h1")
+        self.assertIsNone(self.store.get_passhash("baz"))
+        self.assertEqual(self.store.list_users(), ["foo", "bar"])
+
+    def test_load_chat_pages(self):
+        ids = [self.store.send_message("foo", "bar", str(i)) if i % 2 else self.store.send_message("bar", "foo", str(i)) for i in range(7)]
+        self.store.send_message("foo", "baz", "elsewhere")
+
+        page = self.store.load_chat("foo", "bar", limit=3)
+        self.assertEqual([row[3] for row in page], ids[:3:-1])
+        self.assertEqual(page[0], ("bar", "foo", "6", ids[6]))
+
+        page = self.store.load_chat("bar", "foo", before_message_id=ids[4], limit=10)
+        self.assertEqual([row[3] for row in page], ids[3::-1])
+
+    def test_send_messages(self):
+        ids = self.store.send_messages([("foo", "bar", "a"), ("bar", "foo", "b"), ("foo", "baz", "c")])
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(self.store.count_undelivered("bar"), 1)
+        page = self.store.load_chat("foo", "bar")
+        self.assertEqual([(row[2], row[3]) for row in page], [("b", ids[1]), ("a", ids[0])])
+
+    def test_delivery(self):
+        ids = [self.store.send_message("foo", "bar", str(i)) for i in range(5)]
+        self.assertEqual(self.store.count_undelivered("bar"), 5)
+
+        self.store.mark_delivered([ids[0]])
+        self.store.flush()
+        self.assertEqual(self.store.count_undelivered("bar"), 4)
+
+        # newest first, and only the returned messages are marked delivered
+        rows = self.store.view_undelivered("bar", 2)
+        self.assertEqual([row[3] for row in rows], [ids[4], ids[3]])
+        self.assertEqual(self.store.count_undelivered("bar"), 2)
+
+        self.store.delete_message(ids[1])
+        self.assertEqual(self.store.count_undelivered("bar"), 1)
+        self.assertEqual(len(self.store.load_chat("foo", "bar")), 4)
+
+    def test_delete_account(self):
+        self.store.create_user("baz", "h3")
+        self.store.send_message("foo", "bar", "a")
+        self.store.send_message("baz", "foo", "b")
+        kept = self.store.send_message("baz", "bar", "c")
+
+        self.store.delete_account("foo")
+        self.assertIsNone(self.store.get_passhash("foo"))
+        self.assertEqual(self.store.load_chat("foo", "bar"), [])
+        self.assertEqual(self.store.load_chat("baz", "foo"), [])
+        self.assertEqual([row[3] for row in self.store.load_chat("bar", "baz")], [kept])
+        self.assertEqual(self.store.count_undelivered("bar"), 1)
+
+
+class TestSQLiteMessageStore(MessageStoreTests, unittest.TestCase):
+    '''
+    Runs the MessageStore tests against the sqlite engine.
+    '''
+
+    def make_store(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        return create_store({"engine": "sqlite", "path": os.path.join(self.tmpdir.name, "store.db"), "write_batch_ms": 0})
+
+
+class TestMemoryMessageStore(MessageStoreTests, unittest.TestCase):
+    '''
+    Runs the MessageStore tests against the in-memory engine.
+    '''
+
+    def make_store(self):
+        return create_store({"engine": "memory", "stripes": 4})
+
+    def test_concurrent_sends(self):
+        # ids stay unique and each direction stays in order under concurrent senders
+        def sender(i):
+            for j in range(100):
+                self.store.send_message(f"user{i}", "bar", str(j))
+
+        threads = [threading.Thread(target=sender, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.store.count_undelivered("bar"), 800)
+        page = self.store.load_chat("user3", "bar", limit=200)
+        self.assertEqual([row[2] for row in page], [str(j) for j in range(99, -1, -1)])
+
+
+class TestShardedMessageStore(MessageStoreTests, unittest.TestCase):
+    '''
+    Runs the MessageStore tests against the sharded sqlite engine.
+    '''
+
+    def make_store(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        return create_store({"engine": "sharded", "shards": 3, "shard_path": os.path.join(self.tmpdir.name, "shard{}.db"), "write_batch_ms": 0})
+
+    def test_users(self):
+        # registration order is only kept within a shard
+        self.assertFalse(self.store.create_user("foo", "other"))
+        self.assertEqual(self.store.get_passhash("foo"), "h1")
+        self.assertIsNone(self.store.get_passhash("baz"))
+        self.assertCountEqual(self.store.list_users(), ["foo", "bar"])
+
+    def test_routing(self):
+        # both directions of a conversation land on one shard, and ids say which
+        pairs = [(f"user{i}", f"user{i + 1}") for i in range(12)]
+        for a, b in pairs:
+            shard = self.store.conversation_shard(a, b)
+            self.assertEqual(shard, self.store.conversation_shard(b, a))
+            self.assertEqual(self.store.send_message(a, b, "x") % 3, shard)
+            self.assertEqual(self.store.send_message(b, a, "y") % 3, shard)
+        self.assertGreater(len({self.store.conversation_shard(a, b) for a, b in pairs}), 1)
+
+    def test_cursor_below_shard(self):
+        # a cursor at or below the first global id of the shard is past the oldest message
+        other = next(f"user{i}" for i in range(100) if self.store.conversation_shard("foo", f"user{i}"))
+        shard = self.store.conversation_shard("foo", other)
+        first = self.store.send_message("foo", other, "first")
+        self.assertEqual([row[3] for row in self.store.load_chat("foo", other, before_message_id=first + 1)], [first])
+        self.assertEqual(self.store.load_chat("foo", other, before_message_id=first), [])
+        self.assertEqual(self.store.load_chat("foo", other, before_message_id=shard), [])
+
+    def test_undelivered_across_shards(self):
+        ids = [self.store.send_message(f"user{i}", "bar", str(i)) for i in range(6)]
+        self.assertEqual(self.store.count_undelivered("bar"), 6)
+
+        rows = self.store.view_undelivered("bar", 4)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(self.store.count_undelivered("bar"), 2)
+
+        self.store.mark_delivered([i for i in ids if i not in [row[3] for row in rows]])
+        self.store.flush()
+        self.assertEqual(self.store.count_undelivered("bar"), 0)
+
+
 if __name__ == "__main__":
     unittest.main()
     # delete data/test_database.db
@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import deque
+
+
+class UserDirectory:
+    """
+    UserDirectory class for the cached list of registered users
+
+    Holds every username in memory with a version number that goes up by one on each
+    registration or deletion. A client that remembers the version of its last list can ask
+    for just the usernames added and removed since then. Versions start from the current
+    time, so a version handed out by an earlier server process is always treated as stale.
+    """
+
+    def __init__(self, max_changes=1000):
+        """
+        Parameters:
+        ----------
+        max_changes : int
+            number of recent changes remembered for delta sync, older versions get a full list
+        """
+        # dict used as an insertion ordered set
+        self._users = {}
+        self._snapshot = None
+        self._changes = deque(maxlen=max_changes)
+        self._lock = threading.Lock()
+        self.version = time.time_ns() // 1000
+
+    def load(self, usernames):
+        """
+        Fill the directory with every registered user.
+
+        Parameters:
+        ----------
+        usernames : iterable of str
+            all usernames, as returned by MessageStore.list_users
+        """
+        with self._lock:
+            self._users = dict.fromkeys(usernames)
+            self._snapshot = None
+            self._changes.clear()
+            self.version += 1
+
+    def __contains__(self, username):
+        return username in self._users
+
+    def _change(self, op, username):
+        self.version += 1
+        self._changes.append((self.version, op, username))
+        self._snapshot = None
+        return self.version
+
+    def add(self, username) -> int:
+        """
+        Record a new user. Returns the new directory version.
+        """
+        with self._lock:
+            self._users[username] = None
+            return self._change("add", username)
+
+    def remove(self, username) -> int:
+        """
+        Record a deleted user. Returns the new directory version.
+        """
+        with self._lock:
+            self._users.pop(username, None)
+            return self._change("remove", username)
+
+    def snapshot(self):
+        """
+        Get the full list of usernames and the version it corresponds to.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = tuple(self._users)
+            return self._snapshot, self.version
+
+    def delta(self, since):
+        """
+        Get the changes made after version `since`.
+
+        Returns:
+        ----------
+        tuple or None
+            (added, removed, version), or None if `since` is too old or unknown and the
+            client needs the full list instead
+        """
+        with self._lock:
+            if since == self.version:
+                return [], [], self.version
+            if since > self.version or not self._changes:
+                return None
+            # the oldest remembered change must directly follow the client's version
+            if self._changes[0][0] > since + 1:
+                return None
+
+            # net effect per user: first and last change since the client's version
+            changed = {}
+            for version, op, username in self._changes:
+                if version > since:
+                    first, _ = changed.get(username, (op, op))
+                    changed[username] = (first, op)
+
+            # a user added then removed again (or the reverse) looks the same to the client
+            added = [u for u, (first, last) in changed.items() if first == last == "add"]
+            removed = [u for u, (first, last) in changed.items() if first == last == "remove"]
+            return added, removed, self.version